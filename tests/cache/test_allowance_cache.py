@@ -1,7 +1,9 @@
+import pytest
+
 from vakt.storage.memory import MemoryStorage
-from vakt import Policy, Inquiry, RulesChecker, ALLOW_ACCESS
-from vakt.cache import create_cached_guard
-from vakt.rules import Eq
+from vakt import Policy, Inquiry, Guard, RulesChecker, ALLOW_ACCESS, DENY_ACCESS
+from vakt.cache import create_cached_guard, SelectiveAllowanceCache, TTLLRUCache, LFUCache, ARCCache
+from vakt.rules import Eq, Any
 
 
 class TestAllowanceCache:
@@ -55,3 +57,248 @@ class TestAllowanceCache:
         assert_after_modification()
         storage.delete(p2)
         assert_after_modification()
+
+
+class TestSelectiveAllowanceCache:
+
+    def test_same_inquiries_are_cached(self):
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), selective=True, maxsize=256)
+        assert isinstance(cache, SelectiveAllowanceCache)
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jamey')
+        for _ in range(5):
+            assert guard.is_allowed(inq1)
+        assert not guard.is_allowed(inq2)
+        assert (4, 2, 256, 2) == cache.info()
+
+    def test_only_affected_answers_are_invalidated(self):
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), selective=True, maxsize=256)
+        max_book = Inquiry(action='get', resource='book', subject='Max')
+        max_tv = Inquiry(action='get', resource='TV', subject='Max')
+        jim_book = Inquiry(action='get', resource='book', subject='Jim')
+        p1 = Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
+        p2 = Policy(2, actions=[Eq('get')], resources=[Eq('TV')], subjects=[Eq('Max')], effect=ALLOW_ACCESS)
+        storage.add(p1)
+        storage.add(p2)
+        assert guard.is_allowed(max_book)
+        assert guard.is_allowed(max_tv)
+        assert not guard.is_allowed(jim_book)
+        assert 3 == cache.info().currsize
+        # p2 is not a candidate for other inquiries and doesn't fit them
+        p2.effect = DENY_ACCESS
+        storage.update(p2)
+        assert 2 == cache.info().currsize
+        assert guard.is_allowed(max_book)
+        assert not guard.is_allowed(max_tv)
+        assert not guard.is_allowed(jim_book)
+        assert (2, 4, 256, 3) == cache.info()
+        # new policy fits an inquiry it was not a candidate for
+        storage.add(Policy(3, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Jim')], effect=ALLOW_ACCESS))
+        assert 2 == cache.info().currsize
+        assert guard.is_allowed(jim_book)
+        # policy stops fitting an inquiry it was a candidate for
+        p1.subjects = [Eq('Jim')]
+        storage.update(p1)
+        assert 1 == cache.info().currsize
+        assert not guard.is_allowed(max_book)
+        assert guard.is_allowed(jim_book)
+        storage.delete(3)
+        assert guard.is_allowed(jim_book)
+        storage.delete(1)
+        assert not guard.is_allowed(jim_book)
+        assert not guard.is_allowed(max_tv)
+        assert 3 == cache.info().currsize
+        cache.invalidate()
+        assert 0 == cache.info().currsize
+
+    def test_answers_are_the_same_as_without_cache(self):
+        inquiries = [Inquiry(action=a, resource=r, subject=s)
+                     for a in ('get', 'put') for r in ('book', 'TV') for s in ('Max', 'Jim')]
+        policies = [
+            Policy(1, actions=[Eq('get')], resources=[Any()], subjects=[Eq('Max')], effect=ALLOW_ACCESS),
+            Policy(2, actions=[Any()], resources=[Eq('TV')], subjects=[Any()], effect=ALLOW_ACCESS),
+            Policy(3, actions=[Eq('put')], resources=[Any()], subjects=[Eq('Jim')], effect=DENY_ACCESS),
+        ]
+        for deny_first in (False, True):
+            guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), selective=True, maxsize=5)
+            guard.deny_first = deny_first
+            plain = Guard(storage, RulesChecker(), deny_first=deny_first)
+            modifications = [lambda p=p: storage.add(p) for p in policies] + [
+                lambda: storage.update(Policy(3, actions=[Any()], resources=[Any()], subjects=[Eq('Jim')],
+                                              effect=DENY_ACCESS)),
+                lambda: storage.update(Policy(1, actions=[Eq('put')], resources=[Any()], subjects=[Any()],
+                                              effect=ALLOW_ACCESS)),
+                lambda: storage.delete(2),
+                lambda: storage.delete(3),
+            ]
+            for modify in modifications:
+                modify()
+                for _ in range(2):
+                    assert [plain.is_allowed(i) for i in inquiries] == [guard.is_allowed(i) for i in inquiries]
+            assert cache.info().hits > 0
+            assert 5 == cache.info().currsize
+
+    def test_bulk_modification_is_matched_in_one_pass(self):
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), selective=True, maxsize=256)
+        inquiries = [Inquiry(action='get', resource='book', subject=s) for s in ('Max', 'Jim', 'Nina')]
+        assert [False, False, False] == [guard.is_allowed(i) for i in inquiries]
+        matched = []
+        fits = guard.fits
+
+        def counting_fits(policy, inquiry):
+            # cache readers aren't held off while inquiries are matched
+            assert cache._lock.acquire(blocking=False)
+            cache._lock.release()
+            matched.append((policy.uid, inquiry.subject))
+            return fits(policy, inquiry)
+
+        guard.fits = counting_fits
+        storage.add_many([Policy(i, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq(s)], effect=ALLOW_ACCESS)
+                          for i, s in enumerate(('Max', 'Jim'))])
+        assert 1 == cache.info().currsize
+        # each cached inquiry is matched until the first fitting policy
+        assert [(0, 'Max'), (0, 'Jim'), (1, 'Jim'), (0, 'Nina'), (1, 'Nina')] == matched
+        guard.fits = fits
+        assert [True, True, False] == [guard.is_allowed(i) for i in inquiries]
+        storage.delete_many([0, 1])
+        assert 1 == cache.info().currsize
+        assert [False, False, False] == [guard.is_allowed(i) for i in inquiries]
+
+    def test_failed_checks_are_not_cached(self):
+        class BadStorage(MemoryStorage):
+            def find_for_inquiry(self, inquiry, checker=None):
+                raise Exception('boom')
+
+        guard, storage, cache = create_cached_guard(BadStorage(), RulesChecker(), selective=True)
+        assert not guard.is_allowed(Inquiry())
+        assert not guard.is_allowed(Inquiry())
+        assert (0, 2, 1024, 0) == cache.info()
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def cached_func(backend):
+    calls = []
+
+    def func(x):
+        calls.append(x)
+        return x * 2
+    return backend.wrap(func), calls
+
+
+@pytest.mark.parametrize('backend_cls', [TTLLRUCache, LFUCache, ARCCache])
+class TestEvictingCacheBackends:
+
+    def test_guard_is_cached(self, backend_cls):
+        backend = backend_cls(maxsize=256)
+        guard, storage, cache = create_cached_guard(MemoryStorage(), RulesChecker(), cache=backend)
+        assert backend is cache.cache
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jamey')
+        for _ in range(5):
+            assert guard.is_allowed(inq1)
+        assert not guard.is_allowed(inq2)
+        assert (4, 2, 256, 2) == cache.info()
+        storage.add(Policy(2, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Jamey')],
+                           effect=ALLOW_ACCESS))
+        assert 0 == cache.info().currsize
+        assert guard.is_allowed(inq2)
+
+    def test_entries_expire(self, backend_cls):
+        timer = FakeTimer()
+        func, calls = cached_func(backend_cls(maxsize=10, ttl=5, timer=timer))
+        assert 2 == func(1)
+        timer.now = 4
+        assert 4 == func(2)
+        assert 2 == func(1)
+        assert [1, 2] == calls
+        timer.now = 5
+        assert 2 == func(1)
+        assert 4 == func(2)
+        assert [1, 2, 1] == calls
+        timer.now = 9
+        assert 4 == func(2)
+        assert [1, 2, 1, 2] == calls
+
+    def test_value_computed_during_invalidation_is_not_cached(self, backend_cls):
+        backend = backend_cls(maxsize=10)
+        calls = []
+
+        def func(x):
+            calls.append(x)
+            if len(calls) == 1:
+                backend.invalidate()
+            return x * 2
+
+        func = backend.wrap(func)
+        assert 2 == func(1)
+        assert 0 == backend.info().currsize
+        assert 2 == func(1)
+        assert 2 == func(1)
+        assert [1, 1] == calls
+
+    def test_entries_never_expire_without_ttl(self, backend_cls):
+        timer = FakeTimer()
+        func, calls = cached_func(backend_cls(maxsize=10, timer=timer))
+        func(1)
+        timer.now = 10 ** 9
+        func(1)
+        assert [1] == calls
+
+    def test_size_is_bounded(self, backend_cls):
+        backend = backend_cls(maxsize=8)
+        func, calls = cached_func(backend)
+        for i in range(1000):
+            assert (i % 50) * 2 == func(i % 50)
+            assert backend.info().currsize <= 8
+        assert 8 == backend.info().currsize
+        backend.invalidate()
+        assert 0 == backend.info().currsize
+        func(1)
+        assert 1 == backend.info().currsize
+
+    def test_keyword_arguments(self, backend_cls):
+        func, calls = cached_func(backend_cls())
+        assert 2 == func(x=1)
+        assert 2 == func(1)
+        assert 2 == func(x=1)
+        assert [1, 1] == calls
+
+    def test_bad_maxsize(self, backend_cls):
+        with pytest.raises(ValueError):
+            backend_cls(maxsize=0)
+
+
+def test_ttl_lru_evicts_least_recently_used():
+    func, calls = cached_func(TTLLRUCache(maxsize=2))
+    func(1), func(2), func(1), func(3)
+    func(1)
+    func(2)
+    assert [1, 2, 3, 2] == calls
+
+
+def test_lfu_evicts_least_frequently_used():
+    func, calls = cached_func(LFUCache(maxsize=2))
+    func(1), func(1), func(2), func(3)
+    func(1)
+    func(2)
+    assert [1, 2, 3, 2] == calls
+
+
+def test_arc_keeps_frequent_entries_on_scan():
+    func, calls = cached_func(ARCCache(maxsize=4))
+    for _ in range(3):
+        func('a'), func('b')
+    for i in range(100):
+        func(i)
+    del calls[:]
+    func('a'), func('b')
+    assert [] == calls
@@ -2,6 +2,7 @@ from unittest.mock import Mock, patch
 
 import pytest
 
+from vakt.storage.abc import BulkResult
 from vakt.storage.memory import MemoryStorage
 from vakt.storage.mongo import MongoStorage
 from vakt import Policy, Inquiry, RulesChecker
@@ -164,6 +165,27 @@ class TestEnfoldCache:
         assert [p1, p2] == back_storage.get_all(1000, 0)
         assert [p1, p2] == cache_storage.get_all(1000, 0)
 
+    def test_bulk_modifications_are_applied_to_cache_only_for_succeeded_policies(self):
+        cache_storage = MemoryStorage()
+        back_storage = MemoryStorage()
+        back_storage.add(Policy(2, description='back'))
+        ec = EnfoldCache(back_storage, cache=cache_storage, populate=False)
+        p1, p2, p3 = Policy(1), Policy(2, description='new'), Policy(3)
+        res = ec.add_many(iter([p1, p2, p3]))
+        assert [1, 3] == res.succeeded
+        assert isinstance(res.errors[2], PolicyExistsError)
+        assert [p1, p3] == cache_storage.get_all(100, 0)
+        back_res = BulkResult()
+        back_res.succeed(1)
+        back_res.fail(3, Exception('error!'))
+        back_storage.update_many = Mock(return_value=back_res)
+        assert back_res is ec.update_many([Policy(1, description='upd'), Policy(3, description='upd')])
+        assert ['upd', None] == [p.description for p in cache_storage.get_all(100, 0)]
+        res = ec.delete_many(iter([1, 3]))
+        assert [1, 3] == res.succeeded
+        assert [] == cache_storage.get_all(100, 0)
+        assert ['back'] == [p.description for p in back_storage.get_all(100, 0)]
+
     def test_get_return_value(self):
         cache_storage = MemoryStorage()
         back_storage = MemoryStorage()
@@ -315,6 +337,17 @@ class TestEnfoldCache:
         assert [p4, p5] == list(ec.retrieve_all(batch=1))
         assert [p4, p5] == list(ec.retrieve_all())
 
+    def test_get_after_is_done_by_backend(self):
+        cache_storage = MemoryStorage()
+        cache_storage.add(Policy(1))
+        back_storage = Mock(spec=MongoStorage, **{'get_after.return_value': [Policy(2)]})
+        ec = EnfoldCache(back_storage, cache=cache_storage, populate=False)
+        assert [2] == [p.uid for p in ec.get_after(1, 10)]
+        back_storage.get_after.assert_called_once_with(1, 10)
+        assert ec.supports_get_after
+        ec = EnfoldCache(MemoryStorageYieldingExample2(), cache=cache_storage, populate=False)
+        assert not ec.supports_get_after
+
     @pytest.mark.parametrize('storage', [
         MemoryStorage(),
         MemoryStorageYieldingExample2(),
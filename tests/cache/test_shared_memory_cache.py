@@ -0,0 +1,116 @@
+import multiprocessing
+import sys
+
+import pytest
+
+from vakt.storage.memory import MemoryStorage
+from vakt import Policy, Inquiry, RulesChecker, ALLOW_ACCESS
+from vakt.cache import create_cached_guard, SharedMemoryCache
+from vakt.rules import Eq
+
+
+def allow_max(inquiry):
+    return inquiry.subject == 'Max'
+
+
+def worker(path, subjects, invalidate, queue):
+    cache = SharedMemoryCache(path, capacity=64)
+    func = cache.wrap(allow_max)
+    answers = [func(Inquiry(subject=s)) for s in subjects]
+    if invalidate:
+        cache.invalidate()
+    queue.put((answers, cache.hits, cache.misses))
+    cache.close()
+
+
+class TestSharedMemoryCache:
+
+    @pytest.fixture()
+    def path(self, tmp_path):
+        return str(tmp_path / 'vakt-cache')
+
+    def test_guard_is_cached(self, path):
+        cache = SharedMemoryCache(path, capacity=256)
+        guard, storage, allowance = create_cached_guard(MemoryStorage(), RulesChecker(), cache=cache)
+        storage.add(Policy(1, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Max')], effect=ALLOW_ACCESS))
+        inq1 = Inquiry(action='get', resource='book', subject='Max')
+        inq2 = Inquiry(action='get', resource='book', subject='Jamey')
+        for _ in range(5):
+            assert guard.is_allowed(inq1)
+        assert not guard.is_allowed(inq2)
+        assert (4, 2, 256, 2) == allowance.info()
+        storage.add(Policy(2, actions=[Eq('get')], resources=[Eq('book')], subjects=[Eq('Jamey')],
+                           effect=ALLOW_ACCESS))
+        assert 0 == allowance.info().currsize
+        assert guard.is_allowed(inq2)
+        cache.close()
+
+    def test_answers_are_shared_by_instances(self, path):
+        c1, c2 = SharedMemoryCache(path, capacity=16), SharedMemoryCache(path, capacity=16)
+        f1, f2 = c1.wrap(allow_max), c2.wrap(allow_max)
+        assert f1(Inquiry(subject='Max'))
+        assert not f1(Inquiry(subject='Jim'))
+        assert f2(Inquiry(subject='Max'))
+        assert not f2(Inquiry(subject='Jim'))
+        assert (2, 0) == (c2.hits, c2.misses)
+        c2.invalidate()
+        assert 0 == c1.info().currsize
+        assert f1(Inquiry(subject='Max'))
+        assert (0, 3) == (c1.hits, c1.misses)
+        c1.close()
+        c2.close()
+
+    def test_size_is_bounded_and_answers_are_correct(self, path):
+        cache = SharedMemoryCache(path, capacity=8)
+        func = cache.wrap(allow_max)
+        for i in range(200):
+            subject = 'Max' if i % 3 == 0 else str(i % 40)
+            assert (subject == 'Max') == func(Inquiry(subject=subject))
+        assert cache.info().currsize <= 8
+        assert cache.hits > 0
+        cache.close()
+
+    def test_non_boolean_answers_are_not_cached(self, path):
+        cache = SharedMemoryCache(path, capacity=8)
+        func = cache.wrap(lambda inquiry: None)
+        assert None is func(Inquiry())
+        assert None is func(Inquiry())
+        assert (0, 2, 8, 0) == cache.info()
+        cache.close()
+
+    def test_torn_slot_is_a_miss(self, path):
+        cache = SharedMemoryCache(path, capacity=1)
+        func = cache.wrap(allow_max)
+        func(Inquiry(subject='Max'))
+        assert 1 == cache.info().currsize
+        # corrupt the stored answer
+        cache._mm[SharedMemoryCache.HEADER.size + 24] = 0
+        assert 0 == cache.info().currsize
+        assert func(Inquiry(subject='Max'))
+        assert 0 == cache.hits
+        cache.close()
+
+    def test_capacity_mismatch(self, path):
+        SharedMemoryCache(path, capacity=8).close()
+        with pytest.raises(ValueError) as excinfo:
+            SharedMemoryCache(path, capacity=16)
+        assert 'has capacity 8, not 16' in str(excinfo.value)
+        with pytest.raises(ValueError):
+            SharedMemoryCache(path, capacity=0)
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason='fork start method is needed')
+    def test_answers_are_shared_by_processes(self, path):
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+
+        def run(subjects, invalidate=False):
+            process = ctx.Process(target=worker, args=(path, subjects, invalidate, queue))
+            process.start()
+            result = queue.get(timeout=10)
+            process.join(timeout=10)
+            assert 0 == process.exitcode
+            return result
+
+        assert ([True, False], 0, 2) == run(['Max', 'Jim'])
+        assert ([True, False, True], 3, 0) == run(['Max', 'Jim', 'Max'], invalidate=True)
+        assert ([True, False], 0, 2) == run(['Max', 'Jim'])
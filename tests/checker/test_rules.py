@@ -199,6 +199,17 @@ from vakt.rules.operator import *
         False
     ),
 ])
-def test_fits(policy, field, what, result):
-    c = RulesChecker()
+@pytest.mark.parametrize('compiled', [False, True])
+def test_fits(policy, field, what, result, compiled):
+    c = RulesChecker(compiled=compiled)
     assert result == c.fits(policy, field, what)
+    assert result == c.fits(policy, field, what)
+
+
+def test_fits_recompiles_reassigned_fields():
+    c = RulesChecker(compiled=True)
+    p = Policy(1, subjects=[{'name': Eq('Max')}])
+    assert c.fits(p, 'subjects', {'name': 'Max'})
+    p.subjects = [{'name': Eq('Jim')}]
+    assert not c.fits(p, 'subjects', {'name': 'Max'})
+    assert c.fits(p, 'subjects', {'name': 'Jim'})
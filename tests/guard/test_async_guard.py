@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from vakt.checker import RegexChecker, StringExactChecker
+from vakt.effects import DENY_ACCESS, ALLOW_ACCESS
+from vakt.guard import Guard, AsyncGuard, Inquiry
+from vakt.policy import Policy
+from vakt.rules.net import CIDR
+from vakt.storage.memory import MemoryStorage, AsyncMemoryStorage
+
+
+POLICIES = [
+    Policy('1', effect=ALLOW_ACCESS, subjects=['<Max|Nina>'], actions=['<get|put>'], resources=['books:<.*>']),
+    Policy('2', effect=DENY_ACCESS, subjects=['Max'], actions=['put'], resources=['books:secret']),
+    Policy('3', effect=ALLOW_ACCESS, subjects=['Jim'], actions=['watch'], resources=['TV'],
+           context={'ip': CIDR('127.0.0.1/32')}),
+]
+
+INQUIRIES = [
+    Inquiry(subject='Max', action='get', resource='books:Hobbit'),
+    Inquiry(subject='Max', action='put', resource='books:secret'),
+    Inquiry(subject='Nina', action='put', resource='books:secret'),
+    Inquiry(subject='Jim', action='watch', resource='TV', context={'ip': '127.0.0.1'}),
+    Inquiry(subject='Jim', action='watch', resource='TV', context={'ip': '127.0.0.2'}),
+    Inquiry(subject='Jim', action='get', resource='books:Hobbit'),
+    Inquiry(),
+]
+
+
+def create_storages():
+    st, async_st = MemoryStorage(), AsyncMemoryStorage()
+    for p in POLICIES:
+        st.add(p)
+        asyncio.run(async_st.add(p))
+    return st, async_st
+
+
+@pytest.mark.parametrize('checker', [RegexChecker(), StringExactChecker()])
+@pytest.mark.parametrize('deny_first', [False, True])
+def test_async_guard_gives_the_same_answers_as_guard(checker, deny_first):
+    st, async_st = create_storages()
+    g = Guard(st, checker, deny_first=deny_first)
+    ag = AsyncGuard(async_st, checker, deny_first=deny_first)
+
+    async def run():
+        return (
+            [await ag.is_allowed(i) for i in INQUIRIES],
+            await ag.is_allowed_many(INQUIRIES),
+            await ag.is_allowed_many(INQUIRIES, batch_audit=True),
+        )
+
+    single, many, many_audited = asyncio.run(run())
+    expected = [g.is_allowed(i) for i in INQUIRIES]
+    assert expected == single
+    assert expected == many
+    assert expected == many_audited
+
+
+def test_async_guard_serves_inquiries_concurrently():
+    class SlowStorage(AsyncMemoryStorage):
+        def __init__(self):
+            super().__init__()
+            self.running, self.max_running = 0, 0
+
+        async def find_for_inquiry(self, inquiry, checker=None):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            return await super().find_for_inquiry(inquiry, checker)
+
+        def inquiry_filter_key(self, inquiry, checker=None):
+            return inquiry
+
+    st = SlowStorage()
+    ag = AsyncGuard(st, RegexChecker())
+
+    async def run():
+        for p in POLICIES:
+            await st.add(p)
+        return await asyncio.gather(*[ag.is_allowed(i) for i in INQUIRIES[:3]]), await ag.is_allowed_many(INQUIRIES)
+
+    single, many = asyncio.run(run())
+    assert [True, False, True] == single
+    assert [True, False, True, True, False, False, False] == many
+    assert st.max_running > 1
+
+
+def test_async_guard_does_not_fail_on_storage_errors():
+    class BadStorage(AsyncMemoryStorage):
+        async def find_for_inquiry(self, inquiry, checker=None):
+            if inquiry.subject == 'Max':
+                raise Exception('boom')
+            if inquiry.subject == 'Nina':
+                return None
+            return await super().find_for_inquiry(inquiry, checker)
+
+        def inquiry_filter_key(self, inquiry, checker=None):
+            return inquiry.subject
+
+    st = BadStorage()
+    ag = AsyncGuard(st, RegexChecker())
+
+    async def run():
+        for p in POLICIES:
+            await st.add(p)
+        return (
+            await ag.is_allowed(INQUIRIES[0]),
+            await ag.is_allowed(INQUIRIES[2]),
+            await ag.is_allowed_many(INQUIRIES),
+        )
+
+    max_answer, nina_answer, many = asyncio.run(run())
+    assert not max_answer
+    assert not nina_answer
+    assert [False, False, False, True, False, False, False] == many
+
+
+def test_async_guard_check_inquiry():
+    st, async_st = create_storages()
+    g, ag = Guard(st, RegexChecker()), AsyncGuard(async_st, RegexChecker())
+    assert not isinstance(ag, Guard)
+
+    async def run():
+        return [await ag.check_inquiry(i) for i in INQUIRIES]
+
+    for inquiry, decision in zip(INQUIRIES, asyncio.run(run())):
+        expected = g.check_inquiry(inquiry)
+        assert expected.effect == decision.effect
+        assert [p.uid for p in expected.candidates] == [p.uid for p in decision.candidates]
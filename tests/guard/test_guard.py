@@ -2,6 +2,7 @@ import logging
 import io
 import re
 import sys
+from functools import partial
 
 import pytest
 
@@ -12,6 +13,7 @@ from vakt.rules.inquiry import SubjectEqual, SubjectMatch, ResourceMatch
 from vakt.effects import DENY_ACCESS, ALLOW_ACCESS
 from vakt.policy import Policy
 from vakt.guard import Guard, Inquiry
+from vakt.compiled import CompiledGuard
 from vakt.rules.operator import Eq
 from vakt.rules.string import RegexMatch
 from vakt.rules.logic import Not, And, Any
@@ -252,7 +254,13 @@ def logger():
         RegexChecker(),
     ),
 ])
-def test_is_allowed(desc, inquiry, should_be_allowed, checker):
+@pytest.mark.parametrize('guard_cls', [
+    Guard,
+    CompiledGuard,
+    partial(Guard, deny_first=True),
+    partial(CompiledGuard, deny_first=True),
+])
+def test_is_allowed(desc, inquiry, should_be_allowed, checker, guard_cls):
     # Create all required test policies
     st = MemoryStorage()
     policies = [
@@ -309,7 +317,7 @@ def test_is_allowed(desc, inquiry, should_be_allowed, checker):
     ]
     for p in policies:
         st.add(p)
-    g = Guard(st, checker)
+    g = guard_cls(st, checker)
     assert should_be_allowed == g.is_allowed(inquiry)
 
 
@@ -598,10 +606,11 @@ def test_guard_if_unexpected_exception_raised():
         False,
     ),
 ])
-def test_is_allowed_for_inquiry_match_rules(desc, policy, inquiry, result):
+@pytest.mark.parametrize('guard_cls', [Guard, CompiledGuard])
+def test_is_allowed_for_inquiry_match_rules(desc, policy, inquiry, result, guard_cls):
     storage = MemoryStorage()
     storage.add(policy)
-    g = Guard(storage, RulesChecker())
+    g = guard_cls(storage, RulesChecker())
     assert result == g.is_allowed(inquiry), 'Failed for case: ' + desc
 
 
@@ -667,3 +676,105 @@ def test_guard_does_not_fail_if_storage_returns_none(logger):
     assert not g.is_allowed(Inquiry(subject='Max', action='watch', resource='TV'))
     assert 'Storage returned None, but is supposed to return at least an empty list' == \
            log_capture_str.getvalue().strip()
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self, key_fields=()):
+        super().__init__()
+        self.key_fields = key_fields
+        self.calls = 0
+
+    def find_for_inquiry(self, inquiry, checker=None):
+        self.calls += 1
+        # return all the policies, as the storage filter key is defined by `key_fields`
+        return super().find_for_inquiry(inquiry)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return tuple(getattr(inquiry, f) for f in self.key_fields)
+
+
+def test_is_allowed_many_returns_answers_in_order():
+    storage = CountingStorage()
+    storage.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['read'], resources=['<book:.*>']))
+    storage.add(Policy('2', effect=DENY_ACCESS, subjects=['Max'], actions=['read'], resources=['book:secret']))
+    g = Guard(storage, RegexChecker())
+    inquiries = [
+        Inquiry(subject='Max', action='read', resource='book:1'),
+        Inquiry(subject='Max', action='read', resource='book:secret'),
+        Inquiry(subject='Max', action='read', resource='magazine:1'),
+        Inquiry(subject='Max', action='read', resource='book:2'),
+    ]
+    assert [True, False, False, True] == g.is_allowed_many(inquiries)
+    assert [True, False, False, True] == g.is_allowed_check_many(inquiries)
+    assert [g.is_allowed(i) for i in inquiries] == g.is_allowed_many(inquiries)
+    assert [] == g.is_allowed_many([])
+
+
+@pytest.mark.parametrize('key_fields, expected_calls', [
+    ((), 1),
+    (('subject',), 2),
+    (('subject', 'resource'), 4),
+])
+def test_is_allowed_many_fetches_policies_once_per_group(key_fields, expected_calls):
+    storage = CountingStorage(key_fields)
+    storage.add(Policy('1', effect=ALLOW_ACCESS, subjects=['<Max|Jim>'], actions=['read'], resources=['<.*>']))
+    g = Guard(storage, RegexChecker())
+    inquiries = [
+        Inquiry(subject='Max', action='read', resource='book:1'),
+        Inquiry(subject='Max', action='read', resource='book:2'),
+        Inquiry(subject='Jim', action='read', resource='book:1'),
+        Inquiry(subject='Jim', action='read', resource='book:3'),
+        Inquiry(subject='Max', action='read', resource='book:2'),
+    ]
+    assert [True] * 5 == g.is_allowed_many(inquiries)
+    assert expected_calls == storage.calls
+
+
+def test_is_allowed_many_rejects_group_if_storage_fails(logger):
+    class BadStorage(CountingStorage):
+        def find_for_inquiry(self, inquiry, checker=None):
+            if inquiry.subject == 'Jim':
+                raise Exception('boom')
+            return super().find_for_inquiry(inquiry, checker)
+
+    storage = BadStorage(('subject',))
+    storage.add(Policy('1', effect=ALLOW_ACCESS, subjects=['<.*>'], actions=['<.*>'], resources=['<.*>']))
+    g = Guard(storage, RegexChecker())
+    inquiries = [
+        Inquiry(subject='Jim', action='read', resource='book'),
+        Inquiry(subject='Max', action='read', resource='book'),
+        Inquiry(subject='Jim', action='get', resource='book'),
+    ]
+    assert [False, True, False] == g.is_allowed_many(inquiries)
+
+
+def test_deny_first_stops_on_first_matching_deny_policy():
+    class YieldingStorage(MemoryStorage):
+        def __init__(self):
+            super().__init__()
+            self.yielded = []
+
+        def find_for_inquiry(self, inquiry, checker=None):
+            for p in super().find_for_inquiry(inquiry):
+                self.yielded.append(p.uid)
+                yield p
+
+    st = YieldingStorage()
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['<.*>'], resources=['<.*>']))
+    st.add(Policy('2', effect=DENY_ACCESS, subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    st.add(Policy('3', effect=DENY_ACCESS, subjects=['Max'], actions=['delete'], resources=['<.*>']))
+    st.add(Policy('4', effect=DENY_ACCESS, subjects=['Max'], actions=['<.*>'], resources=['<.*>']))
+    st.add(Policy('5', effect=ALLOW_ACCESS, subjects=['Max'], actions=['<.*>'], resources=['<.*>']))
+    g = Guard(st, RegexChecker(), deny_first=True)
+    assert not g.is_allowed(Inquiry(subject='Max', action='delete', resource='book'))
+    assert ['1', '2', '3'] == st.yielded
+    st.yielded = []
+    assert g.is_allowed(Inquiry(subject='Jim', action='get', resource='book')) is False
+    assert ['1', '2'] == st.yielded
+    st.yielded = []
+    assert not g.is_allowed(Inquiry(subject='Max', action='get', resource='book'))
+    assert ['1', '2', '3', '4'] == st.yielded
+    st.delete('4')
+    st.yielded = []
+    assert g.is_allowed(Inquiry(subject='Max', action='get', resource='book'))
+    assert ['1', '2', '3', '5'] == st.yielded
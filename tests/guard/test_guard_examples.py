@@ -7,6 +7,7 @@ from vakt.rules.logic import Any
 from vakt.effects import DENY_ACCESS, ALLOW_ACCESS
 from vakt.policy import Policy
 from vakt.guard import Guard, Inquiry
+from vakt.compiled import CompiledGuard
 
 
 @pytest.mark.parametrize('desc, policy, inquiry, checker, should_be_allowed', [
@@ -110,8 +111,9 @@ from vakt.guard import Guard, Inquiry
         False,
     ),
 ])
-def test_policy_inquiry_checker_examples(desc, policy, inquiry, checker, should_be_allowed):
+@pytest.mark.parametrize('guard_cls', [Guard, CompiledGuard])
+def test_policy_inquiry_checker_examples(desc, policy, inquiry, checker, should_be_allowed, guard_cls):
     storage = MemoryStorage()
     storage.add(policy)
-    g = Guard(storage, checker)
+    g = guard_cls(storage, checker)
     assert should_be_allowed == g.is_allowed(inquiry)
@@ -1,6 +1,8 @@
+import pickle
+
 import pytest
 
-from vakt.guard import Inquiry
+from vakt.guard import Inquiry, FrozenInquiry
 
 
 def test_default_values():
@@ -102,3 +104,70 @@ def test_equals_and_equals_by_hash(first, second, must_equal):
     else:
         assert first != second
         assert hash(first) != hash(second)
+
+
+@pytest.mark.parametrize('first, second', [
+    (Inquiry(subject={'a': 1}), Inquiry(subject={'a': True})),
+    (Inquiry(subject={'a': 1}), Inquiry(subject={'a': 1.0})),
+    (Inquiry(subject={'a': 1}), Inquiry(subject={'a': '1'})),
+    (Inquiry(subject={'a': None}), Inquiry(subject={'a': ''})),
+    (Inquiry(subject=[1, 2]), Inquiry(subject=(1, 2))),
+    (Inquiry(subject=['ab', 'c']), Inquiry(subject=['a', 'bc'])),
+    (Inquiry(subject={'a': 'b'}), Inquiry(subject=['a', 'b'])),
+    (Inquiry(subject={'a': {'b': 'c'}}), Inquiry(subject={'a': 'b', 'c': {}})),
+    (Inquiry(subject='Max'), Inquiry(action='Max')),
+])
+def test_not_equal_for_different_structures(first, second):
+    assert first != second
+    assert first.cache_key != second.cache_key
+    assert hash(first) != hash(second)
+
+
+def test_cache_key():
+    i = Inquiry(resource={'b': [1, 2], 'a': {3, 4}}, action='get', subject='Max', context={'ip': '127.0.0.1'})
+    key = i.cache_key
+    assert 16 == len(key)
+    assert key is i.cache_key
+    assert key == Inquiry(subject='Max', action='get', context={'ip': '127.0.0.1'},
+                          resource={'a': {4, 3}, 'b': [1, 2]}).cache_key
+    assert key == Inquiry.from_json(i.to_json()).cache_key
+    assert '_cache_key' not in i.to_json()
+    assert '_cache_key' not in str(i)
+    # key is recomputed when inquiry is changed
+    i.subject = 'Jim'
+    assert key != i.cache_key
+    assert i == Inquiry(resource={'b': [1, 2], 'a': {3, 4}}, action='get', subject='Jim', context={'ip': '127.0.0.1'})
+
+
+def test_cache_key_is_stable_across_processes():
+    # pinned value: the key must not depend on a process (e.g. on strings hash randomization)
+    i = Inquiry(resource='book', action='get', subject='Max', context={'ip': '127.0.0.1'})
+    assert '16f7aac4c65755e77eade35cdecfc4da' == i.cache_key.hex()
+
+
+def test_not_equal_to_other_types():
+    assert Inquiry() != 'Inquiry'
+    assert Inquiry() != {}
+
+
+def test_frozen_inquiry():
+    data = dict(resource={'name': 'books', 'tags': ['a', 'b']}, action='get', subject='Max', context={'ip': '1.1.1.1'})
+    i, frozen = Inquiry(**data), FrozenInquiry(**data)
+    assert not hasattr(frozen, '__dict__')
+    assert i == frozen
+    assert frozen == i
+    assert hash(i) == hash(frozen)
+    assert i.cache_key == frozen.cache_key
+    assert i.to_json_sorted() == frozen.to_json_sorted()
+    assert frozen == FrozenInquiry.from_json(i.to_json())
+    assert frozen == pickle.loads(pickle.dumps(frozen))
+    assert frozen != FrozenInquiry(**dict(data, subject='Jim'))
+    assert "'subject': 'Max'" in str(frozen)
+    assert {'ip': '1.1.1.1'} == frozen.context
+    with pytest.raises(AttributeError):
+        frozen.subject = 'Jim'
+    with pytest.raises(TypeError):
+        frozen.context['ip'] = '127.0.0.1'
+    empty = FrozenInquiry()
+    assert ('', '', '', {}) == (empty.resource, empty.action, empty.subject, empty.context)
+    assert Inquiry() == empty
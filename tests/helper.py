@@ -5,6 +5,8 @@ from vakt.util import Observer
 # todo - move all helper and unit-test example classes and functions here
 
 class MemoryStorageYieldingExample(MemoryStorage):
+    supports_get_after = False
+
     def get_all(self, limit, offset):
         self._check_limit_and_offset(limit, offset)
         result = [v for v in self.policies.values()]
@@ -23,6 +25,8 @@ class MemoryStorageYieldingExample2(MemoryStorageYieldingExample):
 class CountObserver(Observer):
     def __init__(self):
         self.count = 0
+        self.events = []
 
-    def update(self):
+    def update(self, event=None):
         self.count += 1
+        self.events.append(event)
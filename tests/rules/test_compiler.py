@@ -0,0 +1,99 @@
+import pytest
+
+from vakt.guard import Guard, Inquiry
+from vakt.checker import RulesChecker
+from vakt.policy import Policy
+from vakt.rules.base import Rule
+from vakt.rules.compiler import compile_rule, compile_definition, compile_context
+from vakt.rules.inquiry import SubjectMatch
+from vakt.rules.list import In, NotIn, AllIn, AllNotIn, AnyIn, AnyNotIn
+from vakt.rules.logic import Truthy, Falsy, And, Or, Not, Any, Neither
+from vakt.rules.net import CIDR
+from vakt.rules.operator import Eq, NotEq, Greater, Less, GreaterOrEqual, LessOrEqual
+from vakt.rules.string import Equal, PairsEqual, RegexMatch, StartsWith, EndsWith, Contains
+
+
+class Odd(Rule):
+    def satisfied(self, what, inquiry=None):
+        return what % 2 == 1
+
+
+class EqPlusOne(Eq):
+    def satisfied(self, what, inquiry=None):
+        return self.val + 1 == what
+
+
+RULES = [
+    Eq(2), Eq('a'), Eq((1, 2)), NotEq(2), NotEq((1, 2)),
+    Greater(2), Less(2), GreaterOrEqual(2), LessOrEqual(2),
+    Truthy(), Falsy(), Any(), Neither(),
+    And(), And(Greater(1), Less(3)), And(Eq(2), Odd()), Or(), Or(Eq(1), Eq('a')), Or(Eq('a'), Greater(1)),
+    Not(Eq(2)), Not(And(Eq(5), Greater(1))), Not(Or(Eq(5), Odd())),
+    In(1, 2, 'a'), NotIn(1, 2, 'a'), AllIn(1, 2), AllNotIn(1, 2), AnyIn(1, 2), AnyNotIn(1, 2),
+    Equal('Max'), Equal('max', ci=True), StartsWith('Ma'), StartsWith('ma', ci=True),
+    EndsWith('ax'), EndsWith('AX', ci=True), Contains('a'), Contains('A', ci=True),
+    RegexMatch(r'[0-9]+'), PairsEqual(),
+    CIDR('127.0.0.1/24'), CIDR('::1/128'), CIDR('not-a-net'),
+    SubjectMatch(), Odd(), EqPlusOne(1),
+]
+
+VALUES = [
+    None, 0, 1, 2, 3, -1.5, 'a', 'Max', 'MAX', 'xmax', '123', '', [], [1, 2], [1, 3], [3, 4], [['a', 'a']],
+    [['a', 'b']], {'a': 1}, '127.0.0.2', '127.0.1.1', '::1', 'not-an-ip', lambda: 0, lambda: 1,
+]
+
+
+def outcome(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize('rule', RULES)
+def test_compile_rule_behaves_as_rule(rule):
+    compiled = compile_rule(rule)
+    inquiry = Inquiry(subject=2)
+    for what in VALUES:
+        assert outcome(rule.satisfied, what, inquiry) == outcome(compiled, what, inquiry), what
+
+
+def test_compile_rule_uses_satisfied_of_unknown_rules():
+    rule = EqPlusOne(1)
+    assert rule.satisfied == compile_rule(rule)
+
+
+@pytest.mark.parametrize('items', [
+    [],
+    [{}],
+    [Eq('Max')],
+    [{'name': Eq('Max')}],
+    [{'name': Eq('Max'), 'stars': Greater(10)}, {'name': Eq('Jim')}],
+    [{'stars': Greater(10)}, Eq({'stars': 5})],
+    [{'name': Not(Greater(10))}],
+    [{'name': 'Max'}, {'name': Eq('Max')}],
+])
+@pytest.mark.parametrize('what', [
+    'Max', {}, {'name': 'Max'}, {'name': 'Jim'}, {'name': 'Max', 'stars': 11}, {'name': 'Max', 'stars': 10},
+    {'stars': 5}, {'stars': 11},
+])
+def test_compile_definition_gives_the_same_answer_as_rules_checker(items, what):
+    policy = Policy(1, subjects=items)
+    inquiry = Inquiry(subject=what)
+    assert RulesChecker().fits(policy, 'subjects', what, inquiry) == compile_definition(items)(what, inquiry)
+
+
+@pytest.mark.parametrize('context', [
+    {},
+    {'ip': CIDR('127.0.0.1/32')},
+    {'ip': CIDR('127.0.0.1/32'), 'level': Greater(3)},
+    {'level': Or(Eq(1), Greater(3))},
+])
+@pytest.mark.parametrize('inquiry_context', [
+    {}, {'ip': '127.0.0.1'}, {'ip': '127.0.0.2'}, {'ip': '127.0.0.1', 'level': 5}, {'ip': '127.0.0.1', 'level': 1},
+    {'level': 'a'},
+])
+def test_compile_context_gives_the_same_answer_as_guard(context, inquiry_context):
+    policy = Policy(1, context=context)
+    inquiry = Inquiry(context=inquiry_context)
+    assert outcome(Guard.check_context_restriction, policy, inquiry) == outcome(compile_context(context), inquiry)
@@ -4,6 +4,7 @@ import types
 import unittest
 import uuid
 from operator import attrgetter
+from unittest.mock import Mock
 
 import pytest
 from sqlalchemy.orm import sessionmaker, scoped_session
@@ -153,6 +154,25 @@ class TestSQLStorage:
         expected_uids = sorted(list(map(str, range(1, 20))))
         assert expected_uids == list(map(attrgetter('uid'), st.get_all(30, 0)))
 
+    def test_get_after(self, st):
+        for i in range(1, 12):
+            st.add(Policy(i))
+        assert ['1', '10', '11'] == [p.uid for p in st.get_after(None, 3)]
+        assert ['2', '3'] == [p.uid for p in st.get_after('11', 2)]
+        assert ['4', '5'] == [p.uid for p in st.get_after(3, 2)]
+        assert ['9'] == [p.uid for p in st.get_after('8', 10)]
+        assert [] == list(st.get_after('9', 10))
+        assert [] == list(st.get_after(None, 0))
+        with pytest.raises(ValueError) as e:
+            list(st.get_after(None, -1))
+        assert "Limit can't be negative" == str(e.value)
+
+    def test_retrieve_all_pages_by_uid(self, st):
+        for i in range(1, 12):
+            st.add(Policy(i))
+        st.get_all = Mock(side_effect=Exception('get_after should be used'))
+        assert sorted(str(i) for i in range(1, 12)) == [p.uid for p in st.retrieve_all(batch=3)]
+
     @pytest.mark.parametrize('checker, expect_number', [
         (None, 6),
         (RulesChecker(), 2),
@@ -321,6 +341,28 @@ class TestSQLStorage:
         with pytest.raises(UnknownCheckerType):
             list(st.find_for_inquiry(inquiry, Inquiry()))
 
+    @pytest.mark.parametrize('checker, same_key', [
+        (None, True),
+        (RulesChecker(), True),
+        (StringExactChecker(), False),
+        (StringFuzzyChecker(), False),
+    ])
+    def test_inquiry_filter_key(self, st, checker, same_key):
+        inq1 = Inquiry(subject='sam', action='get', resource='books')
+        inq2 = Inquiry(subject='max', action='get', resource='books')
+        assert st.inquiry_filter_key(inq1, checker) == st.inquiry_filter_key(Inquiry.from_json(inq1.to_json()), checker)
+        assert same_key == (st.inquiry_filter_key(inq1, checker) == st.inquiry_filter_key(inq2, checker))
+
+    @pytest.mark.parametrize('checker', [
+        StringExactChecker(),
+        StringFuzzyChecker(),
+    ])
+    def test_inquiry_filter_key_ignores_context(self, st, checker):
+        inq1 = Inquiry(subject='sam', action='get', resource='books', context={'ip': '127.0.0.1'})
+        inq2 = Inquiry(subject='sam', action='get', resource='books', context={'ip': '10.0.0.1'})
+        assert ('sam', 'get', 'books') == st.inquiry_filter_key(inq1, checker)
+        assert st.inquiry_filter_key(inq1, checker) == st.inquiry_filter_key(inq2, checker)
+
     def test_find_for_inquiry_returns_generator(self, st):
         st.add(Policy('1', subjects=['max', 'bob'], actions=['get'], resources=['comics']))
         st.add(Policy('2', subjects=['max', 'bob'], actions=['get'], resources=['comics']))
@@ -371,6 +413,51 @@ class TestSQLStorage:
         st.delete(uid)
         assert None is st.get(uid)
 
+    def test_add_many(self, st):
+        st.bulk_size = 2
+        st.add(Policy('2'))
+        res = st.add_many(Policy(str(i), subjects=['Max'], actions=[str(i)]) for i in range(5))
+        assert ['0', '1', '3', '4'] == res.succeeded
+        assert ['2'] == list(res.errors)
+        assert isinstance(res.errors['2'], PolicyExistsError)
+        assert ['0', '1', '2', '3', '4'] == [p.uid for p in st.get_all(10, 0)]
+        assert ['3'] == st.get('3').actions
+        res = st.add_many([Policy('5'), Policy('5'), Policy('6', actions=[Eq('get')])])
+        assert ['5', '6'] == res.succeeded
+        assert isinstance(res.errors['5'], PolicyExistsError)
+        assert 'get' == st.get('6').actions[0].val
+
+    def test_update_many(self, st):
+        st.bulk_size = 2
+        st.add_many([Policy('1'), Policy('2'), Policy('3')])
+        res = st.update_many([
+            Policy('1', description='foo', actions=['get']),
+            Policy('x', description='bar'),
+            Policy('3', actions=[Eq('put')]),
+        ])
+        assert ['1', 'x', '3'] == res.succeeded
+        assert not res.errors
+        assert 'foo' == st.get('1').description
+        assert ['get'] == st.get('1').actions
+        assert None is st.get('x')
+        assert 'put' == st.get('3').actions[0].val
+
+    def test_update_many_reports_failed_policy_without_aborting_others(self, st):
+        st.add_many([Policy('1'), Policy('2'), Policy('3')])
+        # description can't be stored to a text column
+        broken = Policy('2', description=object())
+        res = st.update_many([Policy('1', description='foo'), broken, Policy('3', description='bar')])
+        assert ['1', '3'] == res.succeeded
+        assert ['2'] == list(res.errors)
+        assert ['foo', None, 'bar'] == [p.description for p in st.get_all(10, 0)]
+
+    def test_delete_many(self, st):
+        st.bulk_size = 2
+        st.add_many([Policy('1'), Policy('2'), Policy('3'), Policy('4')])
+        res = st.delete_many(['1', 'x', '3', '4'])
+        assert ['1', 'x', '3', '4'] == res.succeeded
+        assert ['2'] == [p.uid for p in st.get_all(10, 0)]
+
     @pytest.mark.parametrize('effect', [
         ALLOW_ACCESS,
         DENY_ACCESS,
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import pytest
+from sqlalchemy.engine import make_url
+
+from vakt.checker import StringExactChecker, RegexChecker
+from vakt.exceptions import PolicyExistsError
+from vakt.guard import Inquiry
+from vakt.policy import Policy
+from vakt.rules.string import Equal
+from vakt.storage.sql import AsyncSQLStorage
+from vakt.storage.sql.model import Base
+
+sqlalchemy_asyncio = pytest.importorskip('sqlalchemy.ext.asyncio')
+
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def run_with_storage(test):
+    """
+    Runs a coroutine function `test` with AsyncSQLStorage created on a fresh database schema.
+    """
+    dsn = os.getenv('DATABASE_DSN')
+    if not dsn:
+        pytest.exit('Please set DATABASE_DSN env variable with the target database DSN, ex: sqlite:///:memory:')
+    url = make_url(dsn)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+    async def run():
+        engine = sqlalchemy_asyncio.create_async_engine(url)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session = sqlalchemy_asyncio.AsyncSession(engine, expire_on_commit=False)
+        try:
+            await test(AsyncSQLStorage(session))
+        finally:
+            await session.close()
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+            await engine.dispose()
+    asyncio.run(run())
+
+
+@pytest.mark.sql_integration
+class TestAsyncSQLStorage:
+
+    def test_add_get_update_delete(self):
+        async def test(st):
+            await st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book'],
+                                context={'secret': Equal('xyz')}))
+            await st.add(Policy('2', subjects=['Nina'], actions=['<.*>'], resources=['book']))
+            with pytest.raises(PolicyExistsError):
+                await st.add(Policy('1'))
+            back = await st.get('1')
+            assert '1' == back.uid
+            assert isinstance(back.context['secret'], Equal)
+            assert await st.get('3') is None
+            await st.update(Policy('2', subjects=['Jim'], actions=['get'], resources=['book']))
+            assert ['Jim'] == (await st.get('2')).subjects
+            await st.delete('1')
+            assert await st.get('1') is None
+            await st.delete('1')
+        run_with_storage(test)
+
+    def test_bulk_add_update_delete(self):
+        async def test(st):
+            st.bulk_size = 2
+            await st.add(Policy('2'))
+            res = await st.add_many(Policy(str(i), subjects=['Max'], actions=[str(i)]) for i in range(5))
+            assert ['0', '1', '3', '4'] == res.succeeded
+            assert isinstance(res.errors['2'], PolicyExistsError)
+            assert ['0', '1', '2', '3', '4'] == [p.uid for p in await st.get_all(10, 0)]
+            res = await st.update_many([Policy('1', subjects=['Jim']), Policy('x'), Policy('3', description='foo')])
+            assert ['1', 'x', '3'] == res.succeeded
+            assert ['Jim'] == (await st.get('1')).subjects
+            assert 'foo' == (await st.get('3')).description
+            assert await st.get('x') is None
+            res = await st.delete_many(['0', '1', 'x', '4'])
+            assert ['0', '1', 'x', '4'] == res.succeeded
+            assert ['2', '3'] == [p.uid for p in await st.get_all(10, 0)]
+        run_with_storage(test)
+
+    def test_get_all_and_retrieve_all(self):
+        async def test(st):
+            for i in range(5):
+                await st.add(Policy(str(i)))
+            assert ['0', '1', '2'] == [p.uid for p in await st.get_all(3, 0)]
+            assert ['3', '4'] == [p.uid for p in await st.get_all(3, 3)]
+            assert [] == await st.get_all(3, 10)
+            assert ['0', '1', '2', '3', '4'] == [p.uid async for p in st.retrieve_all(batch=2)]
+            assert ['2', '3'] == [p.uid for p in await st.get_after('1', 2)]
+            assert ['0'] == [p.uid for p in await st.get_after(None, 1)]
+            assert [] == await st.get_after('4', 2)
+            with pytest.raises(ValueError):
+                await st.get_all(-1, 0)
+        run_with_storage(test)
+
+    @pytest.mark.parametrize('checker, expected', [
+        (StringExactChecker(), ['1']),
+        (RegexChecker(), ['1', '2']),
+        (None, ['1', '2', '3']),
+    ])
+    def test_find_for_inquiry(self, checker, expected):
+        async def test(st):
+            await st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book']))
+            await st.add(Policy('2', subjects=['<[A-Z]ax>'], actions=['get'], resources=['book']))
+            await st.add(Policy('3', subjects=['Nina'], actions=['get'], resources=['book']))
+            inquiry = Inquiry(subject='Max', action='get', resource='book')
+            found = await st.find_for_inquiry(inquiry, checker)
+            # storage may return more policies than needed if DB can't filter them (e.g. no regex support)
+            assert set(expected).issubset(p.uid for p in found)
+        run_with_storage(test)
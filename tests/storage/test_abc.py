@@ -1,8 +1,14 @@
-import pytest
+import asyncio
 from operator import attrgetter
+from unittest.mock import Mock
+
+import pytest
 
-from vakt.storage.memory import MemoryStorage
+from vakt.storage.abc import Storage, AsyncStorage, BulkResult
+from vakt.storage.memory import MemoryStorage, AsyncMemoryStorage
 from vakt.policy import Policy
+from vakt.guard import Inquiry
+from vakt.exceptions import PolicyExistsError
 from ..helper import MemoryStorageYieldingExample
 
 
@@ -32,3 +38,168 @@ def test_retrieve_all_for_returning_storage(st):
     res = list(st.retrieve_all(100000))
     assert 5 == len(res)
     assert expected_ids == sorted(map(attrgetter('uid'), res))
+
+
+@pytest.mark.parametrize('cls, st', [
+    (Storage, MemoryStorage()),
+    (AsyncStorage, AsyncMemoryStorage()),
+])
+def test_default_inquiry_filter_key_ignores_context(cls, st):
+    inq1 = Inquiry(subject='Max', action='get', resource='books', context={'ip': '127.0.0.1'})
+    inq2 = Inquiry(subject='Max', action='get', resource='books', context={'ip': '127.0.0.2'})
+    inq3 = Inquiry(subject='Max', action='get', resource='TV', context={'ip': '127.0.0.1'})
+    assert ('Max', 'get', 'books') == cls.inquiry_filter_key(st, inq1)
+    assert cls.inquiry_filter_key(st, inq1) == cls.inquiry_filter_key(st, inq2)
+    assert cls.inquiry_filter_key(st, inq1) != cls.inquiry_filter_key(st, inq3)
+    assert hash(cls.inquiry_filter_key(st, Inquiry(subject={'name': 'Max'})))
+
+
+class KeysetStorage(MemoryStorage):
+    """
+    Storage that pages by UID and counts calls of paging methods.
+    """
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def get_all(self, limit, offset):
+        self.calls.append(('get_all', limit, offset))
+        return super().get_all(limit, offset)
+
+    def get_after(self, last_uid, limit):
+        self.calls.append(('get_after', last_uid, limit))
+        policies = sorted(self.policies.values(), key=attrgetter('uid'))
+        return [p for p in policies if last_uid is None or p.uid > last_uid][:limit]
+
+
+def test_retrieve_all_uses_get_after():
+    st = KeysetStorage()
+    for uid in 'ecadb':
+        st.add(Policy(uid))
+    assert ['a', 'b', 'c', 'd', 'e'] == [p.uid for p in st.retrieve_all(2)]
+    assert [('get_after', None, 2), ('get_after', 'b', 2), ('get_after', 'd', 2)] == st.calls
+    assert [] == list(st.retrieve_all(0))
+    st.calls = []
+    assert 5 == len(list(st.retrieve_all(5)))
+    assert [('get_after', None, 5), ('get_after', 'e', 5)] == st.calls
+
+
+class ScanStorage(MemoryStorage):
+    """
+    Uses default get_after of Storage
+    """
+    supports_get_after = False
+    get_after = Storage.get_after
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def get_all(self, limit, offset):
+        self.calls.append(('get_all', limit, offset))
+        return super().get_all(limit, offset)
+
+
+def test_get_after_default_implementation():
+    st = ScanStorage()
+    for uid in [3, 'b', 'a', 20, 'c']:
+        st.add(Policy(uid))
+    assert [20, 3] == [p.uid for p in st.get_after(None, 2)]
+    assert ['a', 'b'] == [p.uid for p in st.get_after(3, 2)]
+    assert ['c'] == [p.uid for p in st.get_after('b', 2)]
+    assert [] == list(st.get_after('c', 2))
+    assert [] == list(st.get_after(None, 0))
+    with pytest.raises(ValueError):
+        st.get_after(None, -1)
+    st.calls = []
+    assert 5 == len(list(st.retrieve_all(2)))
+    assert [('get_all', 2, 0), ('get_all', 2, 2), ('get_all', 2, 4), ('get_all', 2, 6)] == st.calls
+
+
+def test_async_get_after_default_implementation():
+    class ScanAsyncStorage(AsyncMemoryStorage):
+        supports_get_after = False
+        get_after = AsyncStorage.get_after
+
+    async def run():
+        st = ScanAsyncStorage()
+        for uid in [3, 'b', 'a', 20, 'c']:
+            await st.add(Policy(uid))
+        assert [20, 3] == [p.uid for p in await st.get_after(None, 2)]
+        assert ['a', 'b', 'c'] == [p.uid for p in await st.get_after(3, 3)]
+        assert ['c'] == [p.uid for p in await st.get_after('b', 2)]
+        assert [] == await st.get_after(None, 0)
+        assert 5 == len([p async for p in st.retrieve_all(1)])
+    asyncio.run(run())
+
+
+def test_retrieve_all_does_not_hide_errors_of_get_after():
+    st = KeysetStorage()
+    st.get_after = Mock(side_effect=NotImplementedError)
+    with pytest.raises(NotImplementedError):
+        list(st.retrieve_all())
+
+
+class OneByOneStorage(MemoryStorage):
+    """
+    Uses default bulk methods of Storage
+    """
+    add_many = Storage.add_many
+    update_many = Storage.update_many
+    delete_many = Storage.delete_many
+
+
+@pytest.mark.parametrize('st', [
+    MemoryStorage(),
+    OneByOneStorage(),
+])
+def test_bulk_methods_report_errors_without_aborting(st):
+    st.add(Policy('b'))
+    res = st.add_many([Policy('a'), Policy('b'), Policy('c'), Policy('a')])
+    assert not res
+    assert ['a', 'c'] == res.succeeded
+    assert ['a', 'b'] == sorted(res.errors)
+    assert all(isinstance(e, PolicyExistsError) for e in res.errors.values())
+    assert ['a', 'b', 'c'] == sorted(map(attrgetter('uid'), st.retrieve_all()))
+    res = st.update_many([Policy('a', description='foo'), Policy('x'), Policy('c', description='bar')])
+    assert res
+    assert ['a', 'x', 'c'] == res.succeeded
+    assert 'foo' == st.get('a').description
+    assert 'bar' == st.get('c').description
+    assert None is st.get('x')
+    res = st.delete_many(iter(['a', 'x', 'b']))
+    assert res
+    assert ['a', 'x', 'b'] == res.succeeded
+    assert ['c'] == list(map(attrgetter('uid'), st.retrieve_all()))
+
+
+def test_async_bulk_methods_default_implementation():
+    class OneByOneAsyncStorage(AsyncMemoryStorage):
+        add_many = AsyncStorage.add_many
+        update_many = AsyncStorage.update_many
+        delete_many = AsyncStorage.delete_many
+
+    async def run():
+        st = OneByOneAsyncStorage()
+        res = await st.add_many([Policy('a'), Policy('b'), Policy('a')])
+        assert ['a', 'b'] == res.succeeded
+        assert isinstance(res.errors['a'], PolicyExistsError)
+        res = await st.update_many([Policy('b', description='foo')])
+        assert ['b'] == res.succeeded
+        assert 'foo' == (await st.get('b')).description
+        res = await st.delete_many(['a'])
+        assert ['a'] == res.succeeded
+        assert ['b'] == [p.uid for p in await st.get_all(10, 0)]
+    asyncio.run(run())
+
+
+def test_bulk_result_filter_succeeded():
+    res = BulkResult()
+    res.succeed('a')
+    res.fail('a', PolicyExistsError('a'))
+    res.succeed('b')
+    policies = [Policy('a'), Policy('a'), Policy('c'), Policy('b')]
+    assert [policies[0], policies[3]] == res.filter_succeeded(policies)
+    assert ['a', 'b'] == res.filter_succeeded(['a', 'c', 'b'], uid_of=lambda uid: uid)
+    assert not res
+    assert 'BulkResult(succeeded=2, errors=1)' == repr(res)
@@ -0,0 +1,149 @@
+import pytest
+
+from vakt.checker import RegexChecker
+from vakt.guard import Inquiry
+from vakt.parser import compile_regex, get_literal_affixes
+from vakt.policy import Policy
+from vakt.storage.index import PolicyIndex, RegexSet, RegexTrie, SubstringIndex
+
+
+def test_regex_set_finds_all_matching_regexps():
+    rs = RegexSet()
+    regexps = [compile_regex('<%s[0-9]+>' % i, '<', '>') for i in range(1000)]
+    for i, regex in enumerate(regexps):
+        rs.add(regex, i)
+        rs.add(regex, 'x%s' % i)
+    rs.add(compile_regex('<.*7>', '<', '>'), 'any-7')
+    for what in ['1', '17', '107', '99999', 'abc', '']:
+        expected = {uid for uid, regex in enumerate(regexps) if regex.match(what)}
+        expected |= {'x%s' % uid for uid in expected}
+        if what.endswith('7'):
+            expected.add('any-7')
+        assert expected == rs.match(what)
+
+
+def test_regex_set_handles_regexps_that_can_not_be_combined():
+    rs = RegexSet()
+    rs.add(compile_regex('<(?P<x>b)(?P=x)>', '<', '>'), 'named-backref')
+    rs.add(compile_regex('<(?P<n>[a-z]+)>', '<', '>'), 'named-1')
+    rs.add(compile_regex('<(?P<n>[0-9]+)>', '<', '>'), 'named-2')
+    for i in range(RegexSet.fanout * 2):
+        rs.add(compile_regex('<(c)%s>' % i, '<', '>'), i)
+    assert {'named-1'} == rs.match('aa')
+    assert {'named-backref', 'named-1'} == rs.match('bb')
+    assert {'named-2'} == rs.match('12')
+    assert {5, 'named-1'} == rs.match('c5') | rs.match('c')
+    assert set() == rs.match('a1')
+
+
+def test_regex_set_add_remove():
+    rs = RegexSet()
+    r1, r2 = compile_regex('<a.*>', '<', '>'), compile_regex('<.*z>', '<', '>')
+    rs.add(r1, 1)
+    rs.add(r1, 2)
+    rs.add(r2, 3)
+    assert {1, 2, 3} == rs.match('abz')
+    rs.remove(r1, 1)
+    assert {2, 3} == rs.match('abz')
+    rs.remove(r1, 2)
+    rs.remove(r1, 2)
+    assert {3} == rs.match('abz')
+    assert set() == rs.match('ab')
+    rs.remove(r2, 3)
+    assert {} == rs.regexps
+
+
+def test_regex_set_accepts_regex_sources():
+    rs = RegexSet()
+    for i in range(RegexSet.fanout * 3):
+        rs.add('^%s[0-9]+$' % i, i)
+    rs.add(r'^(a)\1$', 'backref')
+    rs.add(compile_regex('<a.*>', '<', '>'), 'compiled')
+    assert {1, 12} == rs.match('123')
+    assert {'backref', 'compiled'} == rs.match('aa')
+    rs.remove('^1[0-9]+$', 1)
+    assert {12} == rs.match('123')
+
+
+@pytest.mark.parametrize('subject, expected', [
+    ('Max', ['1', '2', '3', '4']),
+    ('Nina', ['2', '3', '4']),
+    ('max', ['3', '4']),
+])
+def test_policy_index_keeps_policies_with_broken_regexps_as_potential(subject, expected):
+    index = PolicyIndex()
+    index.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book']))
+    index.add(Policy('2', subjects=['<[A-Z][a-z]+>'], actions=['get'], resources=['book']))
+    index.add(Policy('3', subjects=['<[broken>'], actions=['get'], resources=['book']))
+    index.add(Policy('4', subjects=['<(?i)max>'], actions=['get'], resources=['book']))
+    assert expected == index.find(Inquiry(subject=subject, action='get', resource='book'), RegexChecker())
+
+
+def add_to_trie(trie, phrase, uid):
+    entry = (compile_regex(phrase, '<', '>'), ) + get_literal_affixes(phrase, '<', '>')
+    trie.add(entry, uid)
+    return entry
+
+
+def test_regex_trie_finds_matching_regexps_by_literal_affixes():
+    trie = RegexTrie()
+    add_to_trie(trie, 'library:books:<.+>', 1)
+    add_to_trie(trie, 'library:<.+>', 2)
+    add_to_trie(trie, 'library:<.+>:pdf', 3)
+    add_to_trie(trie, 'office:magazines:<.+>', 4)
+    add_to_trie(trie, '<.*>', 5)
+    add_to_trie(trie, '<.*>:pdf', 6)
+    assert {1, 2, 5} == trie.match('library:books:Hobbit')
+    assert {1, 2, 3, 5, 6} == trie.match('library:books:Hobbit:pdf')
+    assert {2, 3, 5, 6} == trie.match('library:magazines:pdf')
+    assert {4, 5} == trie.match('office:magazines:1')
+    assert {5} == trie.match('library:')
+    assert {5} == trie.match('')
+    assert {5, 6} == trie.match(':pdf\n')
+
+
+def test_regex_trie_removes_regexps_and_prunes_nodes():
+    trie = RegexTrie()
+    e1 = add_to_trie(trie, 'library:books:<.+>', 1)
+    e2 = add_to_trie(trie, 'library:books:<.+>', 2)
+    e3 = add_to_trie(trie, 'library:<.+>', 3)
+    trie.remove(e1, 1)
+    assert {2, 3} == trie.match('library:books:Hobbit')
+    trie.remove(e2, 2)
+    assert {3} == trie.match('library:books:Hobbit')
+    trie.remove(e2, 2)
+    trie.remove(add_to_trie(RegexTrie(), 'office:<.*>', 4), 4)
+    assert ['l'] == list(trie.root.children)
+    trie.remove(e3, 3)
+    assert {} == trie.root.children
+    assert set() == trie.match('library:books:Hobbit')
+
+
+def test_substring_index_finds_values_containing_a_string():
+    index = SubstringIndex()
+    values = ['library:books:Hobbit', 'library:magazines', 'books', 'b', 'Книги', '']
+    for i, value in enumerate(values):
+        index.add(value, i)
+    index.add('books', 'other')
+    for what in ['', 'b', 'bo', 'boo', 'books', 'ooks:H', 'library:', 'ниг', 'x', 'booksy']:
+        expected = {i for i, value in enumerate(values) if what in value}
+        if what in 'books':
+            expected.add('other')
+        assert expected == index.match(what)
+
+
+def test_substring_index_add_remove():
+    index = SubstringIndex()
+    index.add('books', 1)
+    index.add('books', 2)
+    index.add('magazines', 3)
+    assert {1, 2} == index.match('ok')
+    index.remove('books', 1)
+    assert {2} == index.match('ok')
+    index.remove('books', 2)
+    index.remove('books', 2)
+    assert set() == index.match('ok')
+    assert {3} == index.match('')
+    index.remove('magazines', 3)
+    assert {} == index.values
+    assert {} == index.grams
@@ -1,11 +1,20 @@
+import asyncio
+import threading
+import types
+
 import pytest
 
-from vakt.storage.memory import MemoryStorage
-from vakt.policy import Policy
-from vakt.guard import Inquiry
+from vakt.storage.memory import MemoryStorage, AsyncMemoryStorage
+from vakt.policy import Policy, FrozenPolicy
+from vakt.guard import Guard, Inquiry, FrozenInquiry
+from vakt.compiled import CompiledGuard
+from vakt.effects import ALLOW_ACCESS
+from vakt.rules.net import CIDR
 from vakt.exceptions import PolicyExistsError
 from vakt.rules.operator import Eq
 from vakt.rules.logic import Any
+from vakt.rules.list import In
+from vakt.checker import RulesChecker, RegexChecker, StringExactChecker, StringFuzzyChecker
 
 
 @pytest.fixture
@@ -84,6 +93,19 @@ def test_get_all_with_incorrect_args(st):
     assert "Offset can't be negative" == str(e.value)
 
 
+def test_get_after(st):
+    for uid in ['2', 11, '1', 'b', 'a']:
+        st.add(Policy(uid))
+    st.delete('b')
+    assert ['1', 11] == [p.uid for p in st.get_after(None, 2)]
+    assert ['2', 'a'] == [p.uid for p in st.get_after('11', 5)]
+    assert ['a'] == [p.uid for p in st.get_after(2, 5)]
+    assert [] == list(st.get_after('a', 5))
+    assert [] == list(st.get_after(None, 0))
+    with pytest.raises(ValueError):
+        st.get_after(None, -1)
+
+
 def test_find_for_inquiry(st):
     st.add(Policy('1', subjects=['max', 'bob']))
     st.add(Policy('2', subjects=['sam', 'nina']))
@@ -128,3 +150,210 @@ def test_delete(st):
     st.delete('1')
     assert None is st.get('1')
     st.delete('1000000')
+
+
+def test_inquiry_filter_key(st):
+    inq1 = Inquiry(subject='sam', action='get', resource='books')
+    inq2 = Inquiry(subject={'name': 'max'}, action='get', resource='books')
+    inq3 = Inquiry(subject='sam', action='get', resource='books')
+    assert st.inquiry_filter_key(inq1) == st.inquiry_filter_key(inq2)
+    for checker in [RegexChecker(), StringExactChecker(), StringFuzzyChecker(), RulesChecker()]:
+        assert st.inquiry_filter_key(inq1, checker) == st.inquiry_filter_key(inq3, checker)
+        assert st.inquiry_filter_key(inq1, checker) != st.inquiry_filter_key(inq2, checker)
+
+
+@pytest.mark.parametrize('checker, inquiry, expected', [
+    (StringExactChecker(), Inquiry(subject='Max', action='get', resource='book'), ['1', '2', '6']),
+    (StringExactChecker(), Inquiry(subject='Nina', action='get', resource='book'), ['1', '6']),
+    (StringExactChecker(), Inquiry(subject='Max', action='put', resource='book'), ['6']),
+    (StringExactChecker(), Inquiry(subject='Jim', action='get', resource='.*'), ['4', '6']),
+    (StringExactChecker(), Inquiry(subject='Max', action='get', resource={'id': 1}), ['1', '2', '3', '4', '5', '6']),
+    (RegexChecker(), Inquiry(subject='Max', action='get', resource='book'), ['1', '2', '3', '4', '6']),
+    (RegexChecker(), Inquiry(subject='Nina', action='get', resource='book'), ['1', '4', '6']),
+    (RegexChecker(), Inquiry(subject='Bob', action='get', resource='book'), ['4', '6']),
+    (RegexChecker(), Inquiry(subject='<Max>', action='get', resource='book'), ['6']),
+    (RegexChecker(), Inquiry(subject='Max', action='delete', resource='book'), ['6']),
+    (RegexChecker(), Inquiry(subject='Max', action='put', resource='book'), ['3', '6']),
+    (RegexChecker(), Inquiry(subject='Nina', action='put', resource='magazine'), ['6']),
+    (StringFuzzyChecker(), Inquiry(subject='Max', action='get', resource='book'), ['1', '2', '3', '6']),
+    (StringFuzzyChecker(), Inquiry(subject='a', action='t', resource='o'), ['1', '2', '3', '6']),
+    (StringFuzzyChecker(), Inquiry(subject='', action='', resource=''), ['1', '2', '3', '4', '6']),
+    (StringFuzzyChecker(), Inquiry(subject='A-Z', action='get', resource='.*'), ['4', '6']),
+    (StringFuzzyChecker(), Inquiry(subject='Max', action='et|p', resource='book'), ['3', '6']),
+    (StringFuzzyChecker(), Inquiry(subject='Maxi', action='get', resource='book'), ['6']),
+    (RulesChecker(), Inquiry(subject='Max', action='get', resource='book'), ['5', '6']),
+    (None, Inquiry(subject='Max', action='get', resource='book'), ['1', '2', '3', '4', '5', '6']),
+])
+def test_find_for_inquiry_uses_index(st, checker, inquiry, expected):
+    st.add(Policy('1', subjects=['Max', 'Nina'], actions=['get'], resources=['book']))
+    st.add(Policy('2', subjects=['<Max>'], actions=['get', 'list'], resources=['book']))
+    st.add(Policy('3', subjects=['Max'], actions=['<get|put>'], resources=['book']))
+    st.add(Policy('4', subjects=['<[A-Z][a-z]+>', 'Jim'], actions=['get'], resources=['<.*>']))
+    st.add(Policy('5', subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('book')]))
+    st.add(Policy('6'))
+    assert expected == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+
+
+@pytest.mark.parametrize('subject, expected', [
+    ({'name': 'Max', 'role': 'admin'}, ['1', '3', '4', '5', '6', '7']),
+    ({'name': 'Max', 'role': 'user'}, ['1', '2', '3', '4', '5', '6', '7']),
+    ({'name': 'Jim', 'role': 'user'}, ['2', '4', '5', '6', '7']),
+    ({'name': 'Jim', 'role': 'user', 'tags': ['a']}, ['2', '4', '5', '6', '7']),
+    ({'name': ('Nina', 'Bob'), 'role': 'user'}, ['2', '4', '5', '6', '7']),
+    ({'name': 'Nina'}, ['4', '5', '6', '7']),
+    ({}, ['4', '5', '6', '7']),
+    ('Max', ['4', '5', '6', '7']),
+])
+def test_find_for_inquiry_uses_index_of_pinned_rules(st, subject, expected):
+    st.add(Policy('1', subjects=[{'name': Eq('Max'), 'role': In('admin', 'user')}], actions=[Any()]))
+    st.add(Policy('2', subjects=[{'name': In('Jim', 'Bob'), 'role': Eq('user')}], actions=[Any()]))
+    st.add(Policy('3', subjects=[{'name': Eq('Max')}, {'role': Eq('admin')}], actions=[Any()]))
+    st.add(Policy('4', subjects=[{'name': Eq('Max')}, {'role': Any()}], actions=[Any()]))
+    st.add(Policy('5', subjects=[Any()], actions=[Any()]))
+    st.add(Policy('6', subjects=[{'name': Eq(('Nina', 'Bob'))}, {'name': Eq(['Nina', 'Bob'])}], actions=[Any()]))
+    st.add(Policy('7', subjects=[], actions=[Any()]))
+    st.add(Policy('8', subjects=[{}, {'name': In()}], actions=[Any()]))
+    inquiry = Inquiry(subject=subject, action='get')
+    assert expected == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+
+
+def test_find_for_inquiry_index_is_maintained_on_modifications(st):
+    inquiry = Inquiry(subject='Max', action='get', resource='book')
+    checker = StringExactChecker()
+    p1 = Policy('1', subjects=['Max'], actions=['get'], resources=['book'])
+    st.add(p1)
+    st.add(Policy('2', subjects=['Max'], actions=['get'], resources=['book']))
+    assert ['1', '2'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    p1.subjects = ['Nina']
+    st.update(p1)
+    assert ['2'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    p1.subjects = ['Nina', 'Max']
+    st.update(p1)
+    assert ['1', '2'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    st.update(Policy('3', subjects=['Max'], actions=['get'], resources=['book']))
+    assert ['1', '2'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    st.delete('1')
+    assert ['2'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book']))
+    assert ['2', '1'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    st.delete('1')
+    st.delete('2')
+    assert [] == st.find_for_inquiry(inquiry, checker)
+    assert {} == st.index.buckets
+
+
+def test_find_for_inquiry_index_is_maintained_on_bulk_modifications(st):
+    inquiry = Inquiry(subject='Max', action='get', resource='book')
+    checker = StringExactChecker()
+    res = st.add_many(Policy(str(i), subjects=['Max'], actions=['get'], resources=['book']) for i in range(5))
+    assert ['0', '1', '2', '3', '4'] == res.succeeded
+    assert ['0', '1', '2', '3', '4'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    res = st.update_many([Policy('1', subjects=['Nina']), Policy('3', subjects=['Nina']), Policy('5')])
+    assert ['1', '3', '5'] == res.succeeded
+    assert ['0', '2', '4'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+    res = st.delete_many(['0', '2', '4', '5'])
+    assert ['0', '2', '4', '5'] == res.succeeded
+    assert [] == st.find_for_inquiry(inquiry, checker)
+    assert ['1', '3'] == [p.uid for p in st.retrieve_all()]
+    assert 0 == st.version % 2
+
+
+def test_bulk_add_reports_policy_that_fails_indexing(st):
+    res = st.add_many([Policy('1'), types.SimpleNamespace(uid='2', subjects=['Max']), Policy('3')])
+    assert ['1', '3'] == res.succeeded
+    assert ['2'] == list(res.errors)
+    assert isinstance(res.errors['2'], AttributeError)
+    assert ['1', '3'] == [p.uid for p in st.retrieve_all()]
+    assert '2' not in st.index.seq
+    assert 0 == st.version % 2
+
+
+def test_async_memory_storage():
+    async def run():
+        st = AsyncMemoryStorage()
+        await st.add(Policy('1', subjects=['Max'], actions=['get']))
+        await st.add(Policy('2', subjects=['Nina'], actions=['get']))
+        with pytest.raises(PolicyExistsError):
+            await st.add(Policy('1'))
+        assert '1' == (await st.get('1')).uid
+        assert await st.get('3') is None
+        assert ['1', '2'] == [p.uid for p in await st.get_all(10, 0)]
+        assert ['1', '2'] == [p.uid async for p in st.retrieve_all(batch=1)]
+        assert ['2'] == [p.uid for p in await st.get_after('1', 5)]
+        assert 2 == len(await st.find_for_inquiry(Inquiry(subject='Max')))
+        await st.update(Policy('2', subjects=['Jim']))
+        assert ['Jim'] == (await st.get('2')).subjects
+        await st.delete('1')
+        assert ['2'] == [p.uid for p in await st.get_all(10, 0)]
+        assert ['1'] == (await st.add_many([Policy('1'), Policy('2')])).succeeded
+        assert ['1', '2'] == (await st.update_many([Policy('1'), Policy('2')])).succeeded
+        assert ['1'] == (await st.delete_many(['1'])).succeeded
+        assert ['2'] == [p.uid for p in await st.get_all(10, 0)]
+        with pytest.raises(ValueError):
+            await st.get_all(-1, 0)
+    asyncio.run(run())
+
+
+def test_frozen_policies_and_inquiries():
+    st = MemoryStorage()
+    st.add(FrozenPolicy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['<book.*>']))
+    st.add(FrozenPolicy('2', effect=ALLOW_ACCESS, subjects=[{'name': Eq('Max')}], actions=[Eq('get')],
+                        resources=[Any()], context={'ip': CIDR('127.0.0.1/32')}))
+    inquiry = FrozenInquiry(subject='Max', action='get', resource='books')
+    assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, RegexChecker())]
+    assert Guard(st, RegexChecker()).is_allowed(inquiry)
+    inquiry = FrozenInquiry(subject={'name': 'Max'}, action='get', resource='books', context={'ip': '127.0.0.1'})
+    assert ['2'] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+    assert Guard(st, RulesChecker()).is_allowed(inquiry)
+    assert CompiledGuard(st, RulesChecker()).is_allowed(inquiry)
+
+
+@pytest.mark.parametrize('checker', [None, RegexChecker(), StringExactChecker(), StringFuzzyChecker(), RulesChecker()])
+def test_reads_are_consistent_with_concurrent_modifications(checker):
+    st = MemoryStorage()
+    # permanent policies that should always be found
+    st.add(Policy('p1', subjects=['Max'], actions=['<get|put>'], resources=['books'], effect=ALLOW_ACCESS))
+    st.add(Policy('p2', subjects=[{'name': Eq('Max')}], actions=[Any()], resources=[Any()], effect=ALLOW_ACCESS))
+    inquiries = [Inquiry(subject='Max', action='get', resource='books'),
+                 Inquiry(subject={'name': 'Max'}, action='get', resource='books')]
+    expected = [{p.uid for p in st.find_for_inquiry(inquiry, checker)} for inquiry in inquiries]
+    stop, errors = threading.Event(), []
+
+    def write():
+        i = 0
+        try:
+            while not stop.is_set():
+                uid = 'w%d' % (i % 7)
+                if i % 3 == 0:
+                    st.delete(uid)
+                elif uid not in st.policies:
+                    st.add(Policy(uid, subjects=['Max', '<M.*>'], actions=['get'], resources=['<book.*>']))
+                else:
+                    st.update(Policy(uid, subjects=[{'name': In('Max', 'Nina')}], actions=[Eq('get')],
+                                     resources=[Any()]))
+                i += 1
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(300):
+                for inquiry, uids in zip(inquiries, expected):
+                    found = list(st.find_for_inquiry(inquiry, checker))
+                    assert uids <= {p.uid for p in found}
+                    assert all(p is not None for p in found)
+                assert len(st.get_all(1000, 0)) >= 2
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=write)
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    writer.start()
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join()
+    stop.set()
+    writer.join()
+    assert [] == errors
+    assert {'p1', 'p2'} <= {p.uid for p in st.retrieve_all()}
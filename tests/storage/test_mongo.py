@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 import random
 import types
@@ -14,9 +15,11 @@ from vakt.storage.mongo import *
 from vakt.storage.memory import MemoryStorage
 from vakt.effects import ALLOW_ACCESS
 from vakt.policy import Policy
-from vakt.rules.string import Equal
+from vakt.rules.string import Equal, StartsWith, RegexMatch
 from vakt.rules.logic import Any
-from vakt.rules.operator import Eq
+from vakt.rules.operator import Eq, Greater, Less, GreaterOrEqual, LessOrEqual
+from vakt.rules.list import In
+from vakt.rules.net import CIDR
 from vakt.exceptions import PolicyExistsError, UnknownCheckerType
 from vakt.guard import Inquiry, Guard
 from vakt.checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
@@ -163,10 +166,20 @@ class TestMongoStorage:
             st.add(Policy(i))
         assert list(range(1, 20)) == list(map(attrgetter('uid'), st.get_all(30, 0)))
 
+    def test_get_after(self, st):
+        for uid in [3, 1, 2, 'b', 'a']:
+            st.add(Policy(uid))
+        assert [1, 2] == [p.uid for p in st.get_after(None, 2)]
+        assert [3, 'a'] == [p.uid for p in st.get_after(2, 2)]
+        assert ['b'] == [p.uid for p in st.get_after('a', 2)]
+        assert [] == list(st.get_after('b', 2))
+        assert [] == list(st.get_after(None, 0))
+        assert [1, 2, 3, 'a', 'b'] == [p.uid for p in st.retrieve_all(batch=2)]
+
     @pytest.mark.parametrize('checker, expect_number', [
         (None, 6),
         (RegexChecker(), 2),
-        (RulesChecker(), 2),
+        (RulesChecker(), 0),
         (StringExactChecker(), 1),
         (StringFuzzyChecker(), 1),
     ])
@@ -339,16 +352,69 @@ class TestMongoStorage:
 
     def test_find_for_inquiry_with_rules_checker(self, st):
         assertions = unittest.TestCase('__init__')
-        st.add(Policy(1, subjects=[{'name': Equal('Max')}], actions=[{'foo': Equal('bar')}]))
-        st.add(Policy(2, subjects=[{'name': Equal('Max')}], actions=[{'foo': Equal('bar2')}]))
+        st.add(Policy(1, subjects=[{'name': Equal('Max')}], actions=[{'foo': Equal('bar')}], resources=[Any()]))
+        st.add(Policy(2, subjects=[{'name': Equal('Max', ci=True)}], actions=[{'foo': Equal('bar2')}],
+                      resources=[Any()]))
         st.add(Policy(3, subjects=['sam', 'nina']))
         st.add(Policy(4, actions=[r'<\d+>'], effect=ALLOW_ACCESS, resources=[r'<\w{1,3}>'], subjects=[r'<\w{2}-\d+>']))
-        st.add(Policy(5, subjects=[{'name': Equal('Jim')}], actions=[{'foo': Equal('bar3')}]))
+        st.add(Policy(5, subjects=[{'name': Equal('max')}], actions=[Any()], resources=[Eq('books')]))
+        st.add(Policy(6, subjects=[{'name': RegexMatch('m.*')}], actions=[Eq('get')], resources=[Any()]))
         inquiry = Inquiry(subject={'name': 'max'}, action='get', resource='books')
         found = st.find_for_inquiry(inquiry, RulesChecker())
         found = list(found)
-        assert 3 == len(found)
-        assertions.assertListEqual([1, 2, 5], list(map(operator.attrgetter('uid'), found)))
+        assertions.assertListEqual([5, 6], list(map(operator.attrgetter('uid'), found)))
+        inquiry = Inquiry(subject={'name': 'max'}, action={'foo': 'bar2'}, resource='books')
+        assert [2, 5] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+
+    @pytest.mark.parametrize('rule, what, found', [
+        (Eq('Max'), 'Max', True),
+        (Eq('Max'), 'Nina', False),
+        (Eq(1), 1.0, True),
+        (Eq(1), True, True),
+        (Eq(1), '1', False),
+        (In('get', 'put'), 'put', True),
+        (In('get', 'put'), 'delete', False),
+        (In(), 'get', False),
+        (Greater(18), 30, True),
+        (Greater(18), 18, False),
+        (Greater(18), 'a', True),
+        (Less(18), 17.5, True),
+        (Less(18), 18, False),
+        (GreaterOrEqual('b'), 'b', True),
+        (GreaterOrEqual('b'), 'a', False),
+        (LessOrEqual(1), 2, False),
+        (StartsWith('/books'), '/books/1', True),
+        (StartsWith('/books'), '/Books/1', False),
+        (StartsWith('/books', ci=True), '/Books/1', True),
+        (StartsWith('/books'), 1, False),
+        (Equal('Max', ci=True), 'MAX', True),
+        (Equal('Max', ci=True), 'Nina', False),
+        (RegexMatch('M.*'), 'Nina', True),
+    ])
+    def test_find_for_inquiry_with_rules_checker_filters_by_rules(self, st, rule, what, found):
+        st.add(Policy(1, subjects=[{'name': rule}], actions=[rule], resources=[Any()]))
+        inquiry = Inquiry(subject={'name': what, 'age': 20}, action=what, resource='books')
+        assert found == (1 == len(list(st.find_for_inquiry(inquiry, RulesChecker()))))
+
+    def test_find_for_inquiry_with_rules_checker_requires_all_keys(self, st):
+        st.add(Policy(1, subjects=[{'name': Eq('Max'), 'ip': CIDR('127.0.0.1/32')}], actions=[Any()],
+                      resources=[Any()]))
+        st.add(Policy(2, subjects=[{'name': Eq('Max')}, Eq('Max')], actions=[Any()], resources=[Any()]))
+        inquiry = Inquiry(subject={'name': 'Max'}, action='get', resource='books')
+        assert [2] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+        inquiry = Inquiry(subject={'name': 'Max', 'ip': '10.0.0.1'}, action='get', resource='books')
+        assert [1, 2] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+        inquiry = Inquiry(subject='Max', action='get', resource='books')
+        assert [2] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+
+    def test_find_for_inquiry_with_rules_checker_returns_policies_without_projections(self, st):
+        st.add(Policy(1, subjects=[{'name': Eq('Max')}], actions=[Any()], resources=[Any()]))
+        st.add(Policy(2, subjects=[{'name': Eq('Nina')}], actions=[Any()], resources=[Any()]))
+        st.collection.update_one({'_id': 2}, {'$unset': {'subjects_rules': ''}})
+        inquiry = Inquiry(subject={'name': 'Max'}, action='get', resource='books')
+        assert [1, 2] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
+        inquiry = Inquiry(subject={'name': 'Jim'}, action='get', resource='books')
+        assert [2] == [p.uid for p in st.find_for_inquiry(inquiry, RulesChecker())]
 
     def test_find_for_inquiry_with_unknown_checker(self, st):
         st.add(Policy('1'))
@@ -356,6 +422,22 @@ class TestMongoStorage:
         with pytest.raises(UnknownCheckerType):
             list(st.find_for_inquiry(inquiry, Inquiry()))
 
+    @pytest.mark.parametrize('checker', [
+        StringExactChecker(),
+        StringFuzzyChecker(),
+        RegexChecker(),
+        RulesChecker(),
+    ])
+    def test_inquiry_filter_key_ignores_context(self, st, checker):
+        inq1 = Inquiry(subject='sam', action='get', resource='books', context={'ip': '127.0.0.1'})
+        inq2 = Inquiry(subject='sam', action='get', resource='books', context={'ip': '10.0.0.1'})
+        inq3 = Inquiry(subject={'name': 'sam'}, action='get', resource='books', context={'ip': '10.0.0.1'})
+        inq4 = Inquiry(subject={'name': 'max'}, action='get', resource='books')
+        assert st.inquiry_filter_key(inq1, checker) == st.inquiry_filter_key(inq2, checker)
+        assert st.inquiry_filter_key(inq1, checker) != st.inquiry_filter_key(inq3, checker)
+        assert st.inquiry_filter_key(inq3, checker) != st.inquiry_filter_key(inq4, checker)
+        assert None is st.inquiry_filter_key(inq1)
+
     def test_find_for_inquiry_returns_generator(self, st):
         st.add(Policy('1', subjects=['max', 'bob'], actions=['get'], resources=['comics']))
         st.add(Policy('2', subjects=['max', 'bob'], actions=['get'], resources=['comics']))
@@ -405,6 +487,34 @@ class TestMongoStorage:
         st.delete(uid)
         assert None is st.get(uid)
 
+    def test_add_many(self, st):
+        st.add(Policy('2'))
+        res = st.add_many(Policy(str(i), actions=[str(i)]) for i in range(5))
+        assert ['0', '1', '3', '4'] == res.succeeded
+        assert ['2'] == list(res.errors)
+        assert isinstance(res.errors['2'], PolicyExistsError)
+        assert ['0', '1', '2', '3', '4'] == [p.uid for p in st.get_all(10, 0)]
+        assert ['3'] == st.get('3').actions
+        res = st.add_many([Policy('5'), Policy('5')])
+        assert ['5'] == res.succeeded
+        assert isinstance(res.errors['5'], PolicyExistsError)
+        assert st.add_many([])
+
+    def test_update_many(self, st):
+        st.add_many([Policy('1'), Policy('2')])
+        res = st.update_many([Policy('1', description='foo'), Policy('x'), Policy('2', actions=[Eq('get')])])
+        assert ['1', 'x', '2'] == res.succeeded
+        assert 'foo' == st.get('1').description
+        assert None is st.get('x')
+        assert 'get' == st.get('2').actions[0].val
+
+    def test_delete_many(self, st):
+        st.bulk_size = 2
+        st.add_many([Policy('1'), Policy('2'), Policy('3')])
+        res = st.delete_many(['1', 'x', '3'])
+        assert ['1', 'x', '3'] == res.succeeded
+        assert ['2'] == [p.uid for p in st.get_all(10, 0)]
+
     def test_returned_condition(self, st):
         uid = str(uuid.uuid4())
         p = Policy(
@@ -419,3 +529,64 @@ class TestMongoStorage:
         context = st.get(uid).context
         assert context['secret'].satisfied('i-am-a-teacher')
         assert context['secret2'].satisfied('i-am-a-husband')
+
+
+@pytest.mark.integration
+class TestAsyncMongoStorage:
+
+    def run(self, test):
+        async_client_cls = pytest.importorskip('pymongo').AsyncMongoClient
+
+        async def run():
+            client = async_client_cls(MONGO_HOST, MONGO_PORT)
+            try:
+                await test(AsyncMongoStorage(client, DB_NAME, collection=COLLECTION))
+            finally:
+                await client[DB_NAME][COLLECTION].delete_many({})
+                await client.close()
+        asyncio.run(run())
+
+    def test_add_get_update_delete(self):
+        async def test(st):
+            await st.add(Policy('1', subjects=['Max'], context={'secret': Equal('xyz')}))
+            await st.add(Policy('2', subjects=['Nina']))
+            with pytest.raises(PolicyExistsError):
+                await st.add(Policy('1'))
+            assert isinstance((await st.get('1')).context['secret'], Equal)
+            assert await st.get('3') is None
+            await st.update(Policy('2', subjects=['Jim']))
+            assert ['Jim'] == (await st.get('2')).subjects
+            await st.delete('1')
+            assert await st.get('1') is None
+        self.run(test)
+
+    def test_bulk_add_update_delete(self):
+        async def test(st):
+            await st.add(Policy('2'))
+            res = await st.add_many(Policy(str(i)) for i in range(5))
+            assert ['0', '1', '3', '4'] == res.succeeded
+            assert isinstance(res.errors['2'], PolicyExistsError)
+            res = await st.update_many([Policy('1', subjects=['Jim']), Policy('x')])
+            assert ['1', 'x'] == res.succeeded
+            assert ['Jim'] == (await st.get('1')).subjects
+            assert await st.get('x') is None
+            res = await st.delete_many(['0', '1', 'x'])
+            assert ['0', '1', 'x'] == res.succeeded
+            assert ['2', '3', '4'] == [p.uid for p in await st.get_all(10, 0)]
+        self.run(test)
+
+    @pytest.mark.parametrize('checker, expected', [
+        (StringExactChecker(), ['1']),
+        (RegexChecker(), ['1', '2']),
+        (RulesChecker(), ['1', '2', '3']),
+    ])
+    def test_find_for_inquiry(self, checker, expected):
+        async def test(st):
+            await st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['book']))
+            await st.add(Policy('2', subjects=['<[A-Z]ax>'], actions=['get'], resources=['book']))
+            await st.add(Policy('3', subjects=['Nina'], actions=['get'], resources=['book']))
+            found = await st.find_for_inquiry(Inquiry(subject='Max', action='get', resource='book'), checker)
+            assert expected == sorted(p.uid for p in found)
+            assert ['1', '2', '3'] == [p.uid async for p in st.retrieve_all(batch=2)]
+            assert ['2'] == [p.uid for p in await st.get_after('1', 1)]
+        self.run(test)
@@ -33,9 +33,9 @@ class TestMongoMigrationSet:
     def test_up_and_down(self, migration_set):
         migration_set.save_applied_number(0)
         migration_set.up()
-        assert 4 == migration_set.last_applied()
+        assert 5 == migration_set.last_applied()
         migration_set.up()
-        assert 4 == migration_set.last_applied()
+        assert 5 == migration_set.last_applied()
         migration_set.down()
         assert 0 == migration_set.last_applied()
         migration_set.down()
@@ -629,9 +629,10 @@ class TestMigration1x2x0To1x4x0:
                 "type": 2, "uid" : 40 }
                 """,
                 """
-                { "_id" : 40, "actions" : [ ], "context" : { },
-                "description" : null, "effect" : "allow", "resources" : [ ],
+                { "_id" : 40, "actions" : [ ], "actions_rules" : [ ], "context" : { },
+                "description" : null, "effect" : "allow", "resources" : [ ], "resources_rules" : [ ],
                 "subjects" : [ { "name" : {"py/object": "vakt.rules.string.StartsWith", "val": "Max" } } ],
+                "subjects_rules" : [ { "constraints" : [ ], "keys" : [ "name" ] } ],
                 "type": 2, "uid" : 40 }
                 """
             ),
@@ -753,3 +754,74 @@ class TestMigration1x2x0To1x4x0:
         for (doc, expected_doc) in docs:
             new_doc = storage.collection.find_one({'uid': json.loads(doc)['uid']})
             assertions.assertDictEqual(json.loads(expected_doc), new_doc)
+
+
+@pytest.mark.integration
+class TestMigration1x4x0To1x7x0:
+    @pytest.fixture()
+    def storage(self):
+        client = create_client()
+        storage = MongoStorage(client, DB_NAME, collection=COLLECTION)
+        yield storage
+        client[DB_NAME][COLLECTION].delete_many({})
+        client.close()
+
+    def test_order(self, storage):
+        migration = Migration1x4x0To1x7x0(storage)
+        assert 5 == migration.order
+
+    def test_up_leaves_malformed_policies_as_is(self, storage):
+        migration = Migration1x4x0To1x7x0(storage)
+        storage.collection.insert_one({'_id': 10, 'uid': 10, 'type': 2, 'context': 'foo', 'effect': 'allow',
+                                       'actions': [], 'resources': [], 'subjects': []})
+        storage.add(Policy(20, subjects=[{'name': Eq('Max')}]))
+        migration.up()
+        assert 'subjects_rules' not in storage.collection.find_one({'_id': 10})
+        assert 'foo' == storage.collection.find_one({'_id': 10})['context']
+        assert 'subjects_rules' in storage.collection.find_one({'_id': 20})
+
+    def test_up_and_down(self, storage):
+        migration = Migration1x4x0To1x7x0(storage)
+        # prepare docs that might have been saved by users in v 1.4.0
+        docs = [
+            """
+            { "_id" : 10, "actions" : [ "get" ], "actions_compiled_regex" : [ "get" ],
+            "context" : { }, "description" : null, "effect" : "allow",
+            "resources" : [ "<.*>" ], "resources_compiled_regex" : [ "^(.*)$" ],
+            "subjects" : [ "Max" ], "subjects_compiled_regex" : [ "Max" ], "type": 1, "uid" : 10 }
+            """,
+            """
+            { "_id" : 20, "actions" : [ {"py/object": "vakt.rules.list.In", "data": {"py/set": ["get", "put"]}} ],
+            "context" : { }, "description" : null, "effect" : "allow",
+            "resources" : [ {"py/object": "vakt.rules.logic.Any"} ],
+            "subjects" : [ { "name" : {"py/object": "vakt.rules.operator.Eq", "val": "Max" },
+            "ip" : {"py/object": "vakt.rules.net.CIDR", "cidr": "127.0.0.1/32"} } ],
+            "type": 2, "uid" : 20 }
+            """,
+            """
+            { "_id" : 30, "actions" : [ {"py/object": "vakt.rules.logic.Any"} ],
+            "context" : { }, "description" : null, "effect" : "allow",
+            "resources" : [ {"py/object": "vakt.rules.logic.Any"} ],
+            "subjects" : [ { "name" : {"py/object": "vakt.rules.operator.Eq", "val": "Nina" } } ],
+            "type": 2, "uid" : 30 }
+            """,
+        ]
+        for doc in docs:
+            storage.collection.insert_one(b_json.loads(doc))
+        inquiry = Inquiry(subject={'name': 'Max', 'ip': '127.0.0.1'}, action='get', resource='books')
+        # policies without projections are returned for any inquiry
+        assert [20, 30] == [p.uid for p in storage.find_for_inquiry(inquiry, RulesChecker())]
+
+        migration.up()
+        assert {'keys': [], 'constraints': [{'key': None, 'in': ['get', 'put']}]} == \
+            storage.collection.find_one({'_id': 20})['actions_rules'][0]
+        assert [{'keys': ['name'], 'constraints': [{'key': 'name', 'eq': 'Nina'}]}] == \
+            storage.collection.find_one({'_id': 30})['subjects_rules']
+        assert 'subjects_rules' not in storage.collection.find_one({'_id': 10})
+        assert [20] == [p.uid for p in storage.find_for_inquiry(inquiry, RulesChecker())]
+        assert len(docs) == len(list(storage.retrieve_all()))
+
+        migration.down()
+        for doc in storage.collection.find({}):
+            assert not [field for field in doc if field.endswith('_rules')]
+        assert [20, 30] == [p.uid for p in storage.find_for_inquiry(inquiry, RulesChecker())]
@@ -1,7 +1,9 @@
+from unittest.mock import Mock
+
 import pytest
 
 from vakt.storage.memory import MemoryStorage
-from vakt.storage.observable import ObservableMutationStorage
+from vakt.storage.observable import ObservableMutationStorage, PolicyMutation
 from ..helper import CountObserver
 from vakt import Policy, Inquiry
 
@@ -93,6 +95,15 @@ class TestObservableMutationStorage:
         st.get_all(888, 0)
         assert 1 == observer.count
 
+    def test_get_after(self):
+        back = Mock(spec=MemoryStorage, **{'get_after.return_value': [Policy('b')]})
+        st = ObservableMutationStorage(back)
+        assert ['b'] == [p.uid for p in st.get_after('a', 2)]
+        back.get_after.assert_called_once_with('a', 2)
+        back.supports_get_after = False
+        assert not st.supports_get_after
+        assert ObservableMutationStorage(MemoryStorage()).supports_get_after
+
     def test_find_for_inquiry(self, factory):
         st, mem, observer = factory()
         inq = Inquiry(action='get', subject='foo', resource='bar')
@@ -108,3 +119,70 @@ class TestObservableMutationStorage:
         st.find_for_inquiry(inq)
         st.find_for_inquiry(inq)
         assert 2 == observer.count
+
+    def test_mutation_events(self, factory):
+        st, mem, observer = factory()
+        p1 = Policy('a')
+        st.add(p1)
+        p2 = Policy('a', description='new')
+        st.update(p2)
+        st.delete('a')
+        st.delete('a')
+        assert [PolicyMutation.ADD, PolicyMutation.UPDATE, PolicyMutation.DELETE, PolicyMutation.DELETE] == \
+            [e.action for e in observer.events]
+        assert ['a', 'a', 'a', 'a'] == [e.uid for e in observer.events]
+        assert [None, p1, p2, None] == [e.old for e in observer.events]
+        assert [p1, p2, None, None] == [e.new for e in observer.events]
+
+    def test_mutation_is_not_prevented_by_failed_get(self, factory):
+        st, mem, observer = factory()
+        st.add(Policy('a'))
+        mem.get = Mock(side_effect=Exception('boom'))
+        st.delete('a')
+        assert [] == list(mem.retrieve_all())
+        assert None is observer.events[-1].old
+
+    def test_bulk_mutation_events(self, factory):
+        st, mem, observer = factory()
+        p1, p2 = Policy('a'), Policy('b')
+        res = st.add_many(iter([p1, Policy('a'), p2]))
+        assert ['a', 'b'] == res.succeeded
+        assert 1 == observer.count
+        assert [(PolicyMutation.ADD, 'a', None, p1), (PolicyMutation.ADD, 'b', None, p2)] == \
+            [(e.action, e.uid, e.old, e.new) for e in observer.events[0]]
+        p3 = Policy('b', description='new')
+        st.update_many([p3])
+        st.delete_many(iter(['a', 'b']))
+        assert 3 == observer.count
+        assert [(PolicyMutation.UPDATE, 'b', p2, p3)] == [(e.action, e.uid, e.old, e.new) for e in observer.events[1]]
+        assert [(PolicyMutation.DELETE, 'a', p1, None), (PolicyMutation.DELETE, 'b', p3, None)] == \
+            [(e.action, e.uid, e.old, e.new) for e in observer.events[2]]
+        assert [] == list(mem.retrieve_all())
+
+    def test_bulk_mutation_without_modified_policies_sends_no_event(self, factory):
+        st, mem, observer = factory()
+        st.add(Policy('a'))
+        st.add_many([Policy('a')])
+        st.update_many([])
+        st.delete_many([])
+        assert 1 == observer.count
+
+    def test_bulk_mutation_does_not_get_old_policies_without_listeners(self):
+        mem = MemoryStorage()
+        st = ObservableMutationStorage(mem)
+        st.add_many([Policy('a'), Policy('b')])
+        mem.get = Mock()
+        st.update_many([Policy('a', description='new')])
+        st.delete_many(['b'])
+        assert not mem.get.called
+        assert ['a'] == [p.uid for p in mem.retrieve_all()]
+
+    def test_mutation_does_not_get_old_policy_without_listeners(self):
+        mem = MemoryStorage()
+        st = ObservableMutationStorage(mem)
+        st.add_many([Policy('a'), Policy('b')])
+        mem.get = Mock()
+        st.update(Policy('a', description='new'))
+        st.delete('b')
+        assert not mem.get.called
+        assert ['a'] == [p.uid for p in mem.retrieve_all()]
@@ -1,3 +1,4 @@
+import asyncio
 import uuid
 import random
 import types
@@ -7,8 +8,12 @@ from unittest.mock import Mock
 
 import pytest
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
-from vakt.storage.redis import RedisStorage, JSONSerializer, PickleSerializer
+from vakt.storage.redis import RedisStorage, AsyncRedisStorage, MirroredRedisStorage, AsyncMirroredRedisStorage, \
+    JSONSerializer, PickleSerializer, RedisMigrationSet, Migration0To1x7x0
+from vakt.storage.migration import Migrator
+from vakt.storage.abc import Storage
 from vakt.policy import Policy
 from vakt.rules.string import Equal
 from vakt.rules.logic import Any, And
@@ -16,6 +21,11 @@ from vakt.rules.operator import Eq, Greater
 from vakt.exceptions import PolicyExistsError
 from vakt.guard import Inquiry
 from vakt.checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
+from vakt.storage.memory import MemoryStorage
+from vakt.storage.snapshot import export_snapshot
+from vakt.cache import EnfoldCache
+from vakt.compiled import CompiledGuard
+from vakt.effects import ALLOW_ACCESS
 
 
 REDIS_HOST = '127.0.0.1'
@@ -174,14 +184,88 @@ class TestRedisStorage:
             pols.append(p.uid)
         assert 2 == len(pols)
 
+    def test_retrieve_all_scans_hash(self, st):
+        st.add_many(Policy(str(i)) for i in range(250))
+        st.client = Mock(wraps=st.client)
+        found = st.retrieve_all(batch=20)
+        assert isinstance(found, types.GeneratorType)
+        assert sorted(str(i) for i in range(250)) == sorted(p.uid for p in found)
+        assert not st.client.hgetall.called
+
+    def test_retrieve_all_returns_policies_as_hscan_does(self, st):
+        st.sr = PickleSerializer()
+        data = [(b'1', st.sr.serialize(Policy('1'))), (b'2', st.sr.serialize(Policy('2')))]
+        st.client = Mock(spec=Redis, **{'hscan_iter.return_value': iter(data + data[:1])})
+        assert ['1', '2', '1'] == [p.uid for p in st.retrieve_all()]
+        st.client.hscan_iter.assert_called_once_with(COLLECTION, count=50)
+
+    def test_policies_repeated_by_hscan_are_skipped_by_consumers(self, st, tmp_path):
+        st.sr = PickleSerializer()
+        data = [(b'1', st.sr.serialize(Policy('1', subjects=['Max'], actions=['get'], resources=['books'],
+                                              effect=ALLOW_ACCESS))),
+                (b'2', st.sr.serialize(Policy('2')))]
+        st.client = Mock(spec=Redis)
+        st.client.hscan_iter.side_effect = lambda *args, **kwargs: iter(data + data[:1])
+        cache = MemoryStorage()
+        EnfoldCache(st, cache=cache)
+        assert ['1', '2'] == [p.uid for p in cache.retrieve_all()]
+        assert 2 == export_snapshot(st, str(tmp_path / 'policies.snapshot'))
+        assert ['1', '2'] == [p.uid for p in MemoryStorage.from_snapshot(str(tmp_path / 'policies.snapshot'))
+                              .retrieve_all()]
+        guard = CompiledGuard(st, RegexChecker())
+        assert guard.is_allowed(Inquiry(subject='Max', action='get', resource='books'))
+
+    @pytest.mark.parametrize('limit, offset, result', [
+        (3, 0, ['a', 'b', 'c']),
+        (3, 3, ['d', 'e']),
+        (10, 1, ['b', 'c', 'd', 'e']),
+        (0, 0, []),
+        (2, 10, []),
+    ])
+    def test_ordered_get_all(self, st, limit, offset, result):
+        st.ordered = True
+        st.add_many([Policy('d'), Policy('b'), Policy('x')])
+        st.add(Policy('e'))
+        st.add(Policy('a'))
+        st.add(Policy('c'))
+        st.delete('x')
+        assert result == [p.uid for p in st.get_all(limit, offset)]
+
+    def test_ordered_retrieve_all_of_base_class(self, st):
+        st.ordered = True
+        st.add_many(Policy(str(i)) for i in range(10, 30))
+        found = Storage.retrieve_all(st, batch=7)
+        assert [str(i) for i in range(10, 30)] == [p.uid for p in found]
+
+    def test_get_after(self, st):
+        st.add_many([Policy('2'), Policy(11), Policy('1'), Policy('b'), Policy('a')])
+        st.delete('b')
+        found = st.get_after(None, 2)
+        assert isinstance(found, types.GeneratorType)
+        assert ['1', 11] == [p.uid for p in found]
+        assert ['2', 'a'] == [p.uid for p in st.get_after('11', 5)]
+        assert ['a'] == [p.uid for p in st.get_after(2, 5)]
+        assert [] == list(st.get_after('a', 5))
+        assert [] == list(st.get_after(None, 0))
+        with pytest.raises(ValueError):
+            st.get_after(None, -1)
+
+    def test_ordered_retrieve_all_pages_by_uids(self, st):
+        st.ordered = True
+        st.add_many(Policy(str(i)) for i in range(10, 30))
+        st.client = Mock(wraps=st.client)
+        st.scripts.pager = Mock(side_effect=Exception('get_after should be used'))
+        assert [str(i) for i in range(10, 30)] == [p.uid for p in st.retrieve_all(batch=7)]
+        assert not st.client.hscan_iter.called
+
     @pytest.mark.parametrize('checker, expect_number', [
         (None, 6),
-        (RegexChecker(), 6),
+        (RegexChecker(), 2),
         (RulesChecker(), 6),
-        (StringExactChecker(), 6),
+        (StringExactChecker(), 1),
         (StringFuzzyChecker(), 6),
     ])
-    def test_find_for_inquiry_returns_all_policies_for_any_checker_and_inquiry(self, st, checker, expect_number):
+    def test_find_for_inquiry_with_checker(self, st, checker, expect_number):
         st.add(Policy('1', subjects=['<[mM]ax>', '<.*>']))
         st.add(Policy('2', subjects=['sam<.*>', 'foo']))
         st.add(Policy('3', subjects=['Jim'], actions=['delete'], resources=['server']))
@@ -192,6 +276,118 @@ class TestRedisStorage:
         found = st.find_for_inquiry(inquiry, checker)
         assert expect_number == len(list(found))
 
+    @pytest.mark.parametrize('checker, inquiry, expect_uids', [
+        (StringExactChecker(), Inquiry(subject='Max', action='get', resource='books'), ['1', '2']),
+        (StringExactChecker(), Inquiry(subject='<Max>', action='get', resource='books'), []),
+        (StringExactChecker(), Inquiry(subject='Nina', action='get', resource='books'), ['2']),
+        (StringExactChecker(), Inquiry(subject='Max', action='list', resource='books'), ['2']),
+        (StringExactChecker(), Inquiry(subject='Max', action='get', resource={'name': 'books'}), ['1', '2', '3', '4']),
+        (RegexChecker(), Inquiry(subject='Max', action='get', resource='books'), ['1', '2', '3']),
+        # regex of policy 2 is not matched server-side, so it is returned as a candidate
+        (RegexChecker(), Inquiry(subject='Jim', action='get', resource='books'), ['2', '3']),
+        (RegexChecker(), Inquiry(subject='Max', action='delete', resource='books'), []),
+        (RegexChecker(), Inquiry(subject='Max', action='get', resource='comics'), ['2', '3']),
+        (RulesChecker(), Inquiry(subject='Max', action='get', resource='books'), ['1', '2', '3', '4']),
+    ])
+    def test_find_for_inquiry_filters_by_index(self, st, checker, inquiry, expect_uids):
+        st.add(Policy('1', subjects=['Max'], actions=['get'], resources=['books']))
+        st.add(Policy('2', subjects=['<Max>', 'Nina'], actions=['get', 'list'], resources=['books', 'comics']))
+        st.add(Policy('3', subjects=['<[A-Z].*>'], actions=['get'], resources=['<.*>']))
+        st.add(Policy('4', subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('books')]))
+        found = st.find_for_inquiry(inquiry, checker)
+        assert expect_uids == sorted(p.uid for p in found)
+
+    def test_index_is_maintained_on_changes(self, st):
+        client = st.client
+        st.add(Policy('1', subjects=['Max', '<Nina>'], actions=['<get|list>'], resources=['books']))
+        st.add(Policy('2', subjects=[Eq('Max')]))
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Max')
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Nina')
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:regex')
+        assert {b'1'} == client.smembers(COLLECTION + ':index:actions:regex')
+        assert {b'1'} == client.smembers(COLLECTION + ':index:resources:value:books')
+        st.update(Policy('1', subjects=['Jim'], actions=['get'], resources=['books']))
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Jim')
+        assert set() == client.smembers(COLLECTION + ':index:subjects:value:Max')
+        assert set() == client.smembers(COLLECTION + ':index:actions:regex')
+        st.update_many([Policy('1', subjects=['Max'], actions=['get'], resources=['books'])])
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Max')
+        st.delete('1')
+        keys = [COLLECTION.encode(), (COLLECTION + ':index').encode(), (COLLECTION + ':uids').encode()]
+        assert keys == sorted(client.keys(COLLECTION + '*'))
+        st.add_many([Policy('1', subjects=['Max'])])
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Max')
+        st.delete_many(['1'])
+        assert set() == client.smembers(COLLECTION + ':index:subjects:value:Max')
+
+    @pytest.mark.parametrize('checker', [StringExactChecker(), RegexChecker()])
+    def test_policy_with_empty_value_is_found_for_any_inquiry(self, st, checker):
+        st.add(Policy('1', subjects=[''], actions=['get'], resources=['books']))
+        st.add(Policy('2', subjects=['Nina'], actions=['get'], resources=['books']))
+        inquiry = Inquiry(subject='Max', action='get', resource='books')
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, checker)]
+        st.update(Policy('1', subjects=['Max'], actions=['get'], resources=['books']))
+        assert [] == st.client.keys(COLLECTION + ':index:subjects:scan')
+
+    def test_scripts_get_all_index_keys_they_touch(self, st):
+        st.add(Policy('1', subjects=['Max', '<Nina>'], actions=['get'], resources=['books']))
+        stored = st.client.hget(COLLECTION + ':index', '1')
+        keys, args = st._policy_call(Policy('1', subjects=['Jim']), stored)
+        assert [COLLECTION, COLLECTION + ':index', COLLECTION + ':uids',
+                COLLECTION + ':index:subjects:value:Jim',
+                COLLECTION + ':index:actions:value:get', COLLECTION + ':index:resources:value:books',
+                COLLECTION + ':index:subjects:regex', COLLECTION + ':index:subjects:value:Max',
+                COLLECTION + ':index:subjects:value:Nina'] == keys
+        assert ['1', '["%s:index:subjects:value:Jim"]' % COLLECTION, stored] == args[:3]
+
+    def test_modification_is_retried_if_index_keys_were_changed_concurrently(self, st):
+        client = st.client
+        st.add(Policy('1', subjects=['Max']))
+        st.add(Policy('2', subjects=['Max']))
+        hget, hmget = client.hget, client.hmget
+        # index keys are read before a concurrent modification, so the first script run finds them stale
+        client.hget = Mock(side_effect=lambda key, uid: None if client.hget.call_count == 1 else hget(key, uid))
+        client.hmget = Mock(side_effect=lambda key, uids: [None] * len(uids) if client.hmget.call_count == 1
+                            else hmget(key, uids))
+        st.update(Policy('1', subjects=['Jim']))
+        assert 2 == client.hget.call_count
+        assert ['Jim'] == st.get('1').subjects
+        assert ['2'] == st.delete_many(['2']).succeeded
+        assert 2 == client.hmget.call_count
+        assert set() == client.smembers(COLLECTION + ':index:subjects:value:Max')
+        assert {b'1'} == client.smembers(COLLECTION + ':index:subjects:value:Jim')
+
+    def test_inquiry_filter_key(self, st):
+        inquiry = Inquiry(subject='Max', action='get', resource='books', context={'ip': '127.0.0.1'})
+        assert ('Max', 'get', 'books') == st.inquiry_filter_key(inquiry, RegexChecker())
+        assert ('Max', 'get', 'books') == st.inquiry_filter_key(inquiry, StringExactChecker())
+        assert None is st.inquiry_filter_key(inquiry, StringFuzzyChecker())
+        assert None is st.inquiry_filter_key(inquiry, RulesChecker())
+        assert None is st.inquiry_filter_key(inquiry)
+        assert None is st.inquiry_filter_key(Inquiry(subject={'name': 'Max'}), RegexChecker())
+
+    def test_migration_builds_and_drops_index(self, st):
+        client = st.client
+        for p in [Policy('1', subjects=['Max'], actions=['get'], resources=['<.*>']),
+                  Policy('2', subjects=['Nina'], actions=['get'], resources=['books'])]:
+            client.hset(COLLECTION, p.uid, st.sr.serialize(p))
+        client.hset(COLLECTION, 'broken', b'broken')
+        migration_set = RedisMigrationSet(st, key=COLLECTION + ':migration')
+        assert 0 == migration_set.last_applied()
+        inquiry = Inquiry(subject='Max', action='get', resource='books')
+        assert [] == list(st.find_for_inquiry(inquiry, RegexChecker()))
+        Migrator(migration_set).up()
+        assert 1 == migration_set.last_applied()
+        assert ['1'] == [p.uid for p in st.find_for_inquiry(inquiry, RegexChecker())]
+        assert {b'1', b'2'} == client.smembers(COLLECTION + ':index:actions:value:get')
+        assert [b'1', b'2', b'broken'] == client.zrange(COLLECTION + ':uids', 0, -1)
+        # migration is idempotent
+        Migration0To1x7x0(st).up()
+        assert {b'1', b'2'} == client.smembers(COLLECTION + ':index:actions:value:get')
+        Migrator(migration_set).down()
+        assert 0 == migration_set.last_applied()
+        assert [COLLECTION.encode(), (COLLECTION + ':migration').encode()] == sorted(client.keys(COLLECTION + '*'))
+
     def test_find_for_inquiry_for_empty_database(self, st):
         assert [] == list(st.find_for_inquiry(Inquiry(), RegexChecker()))
 
@@ -272,6 +468,31 @@ class TestRedisStorage:
         assert 'Nothing to delete by UID=123456789_not_here' == log_capture_str.getvalue().strip()
         assert None is st.get(uid)
 
+    def test_add_many(self, st):
+        st.bulk_size = 2
+        st.add(Policy('2'))
+        res = st.add_many(Policy(str(i), actions=[str(i)]) for i in range(5))
+        assert ['0', '1', '3', '4'] == res.succeeded
+        assert ['2'] == list(res.errors)
+        assert isinstance(res.errors['2'], PolicyExistsError)
+        assert ['3'] == st.get('3').actions
+        assert 5 == len(list(st.get_all(10, 0)))
+
+    def test_update_many(self, st):
+        st.add_many([Policy('1'), Policy('2')])
+        res = st.update_many([Policy('1', description='foo'), Policy('x'), Policy('2', actions=[Eq('get')])])
+        assert ['1', 'x', '2'] == res.succeeded
+        assert 'foo' == st.get('1').description
+        assert None is st.get('x')
+        assert 'get' == st.get('2').actions[0].val
+
+    def test_delete_many(self, st):
+        st.bulk_size = 2
+        st.add_many([Policy('1'), Policy('2'), Policy('3')])
+        res = st.delete_many(['1', 'x', '3'])
+        assert ['1', 'x', '3'] == res.succeeded
+        assert ['2'] == [p.uid for p in st.get_all(10, 0)]
+
     def test_returned_condition(self, st):
         uid = str(uuid.uuid4())
         p = Policy(
@@ -294,3 +515,205 @@ class TestRedisStorage:
         assert '1' == st.get('1').uid
         assert 2 == st.get(2).uid
         assert 'some text' == st.get(2).description
+
+
+@pytest.mark.integration
+class TestAsyncRedisStorage:
+
+    def run(self, test):
+        async def run():
+            client = AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=DB)
+            try:
+                await test(AsyncRedisStorage(client, collection=COLLECTION, serializer=JSONSerializer()))
+            finally:
+                await client.flushdb()
+                await client.close()
+        asyncio.run(run())
+
+    def test_add_get_update_delete(self):
+        async def test(st):
+            await st.add(Policy('1', subjects=['Max'], context={'secret': Equal('xyz')}))
+            await st.add(Policy('2', subjects=['Nina']))
+            with pytest.raises(PolicyExistsError):
+                await st.add(Policy('1'))
+            assert isinstance((await st.get('1')).context['secret'], Equal)
+            assert await st.get('3') is None
+            await st.update(Policy('2', subjects=['Jim']))
+            assert ['Jim'] == (await st.get('2')).subjects
+            await st.delete('1')
+            assert await st.get('1') is None
+        self.run(test)
+
+    def test_bulk_add_update_delete(self):
+        async def test(st):
+            st.bulk_size = 2
+            await st.add(Policy('2'))
+            res = await st.add_many(Policy(str(i)) for i in range(5))
+            assert ['0', '1', '3', '4'] == res.succeeded
+            assert isinstance(res.errors['2'], PolicyExistsError)
+            res = await st.update_many([Policy('1', subjects=['Jim']), Policy('x')])
+            assert ['1', 'x'] == res.succeeded
+            assert ['Jim'] == (await st.get('1')).subjects
+            assert await st.get('x') is None
+            res = await st.delete_many(['0', '1', 'x'])
+            assert ['0', '1', 'x'] == res.succeeded
+            assert 3 == len(await st.get_all(10, 0))
+        self.run(test)
+
+    def test_get_all_and_find_for_inquiry(self):
+        async def test(st):
+            for i in range(5):
+                await st.add(Policy(str(i)))
+            assert 3 == len(await st.get_all(3, 0))
+            assert 2 == len(await st.get_all(3, 3))
+            assert 5 == len([p async for p in st.retrieve_all(batch=2)])
+            st.ordered = True
+            assert ['3', '4'] == [p.uid for p in await st.get_all(3, 3)]
+            assert ['0', '1', '2', '3', '4'] == [p.uid async for p in st.retrieve_all(batch=2)]
+            assert ['2', '3'] == [p.uid for p in await st.get_after('1', 2)]
+            assert [] == await st.get_after('4', 2)
+            assert 5 == len(await st.find_for_inquiry(Inquiry(subject='Max'), RulesChecker()))
+            assert 0 == len(await st.find_for_inquiry(Inquiry(subject='Max'), RegexChecker()))
+            await st.add(Policy('5', subjects=['<M.*>'], actions=['get'], resources=['books']))
+            inquiry = Inquiry(subject='Max', action='get', resource='books')
+            assert ['5'] == [p.uid for p in await st.find_for_inquiry(inquiry, RegexChecker())]
+            assert [] == await st.find_for_inquiry(inquiry, StringExactChecker())
+        self.run(test)
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.integration
+class TestMirroredRedisStorage:
+
+    @pytest.fixture()
+    def clients(self):
+        writer, reader = create_client(), create_client()
+        yield writer, reader
+        writer.flushdb()
+        writer.close()
+        reader.close()
+
+    @pytest.fixture()
+    def timer(self):
+        return FakeTimer()
+
+    @pytest.fixture(params=[JSONSerializer(), PickleSerializer()])
+    def storages(self, request, clients, timer):
+        writer = MirroredRedisStorage(clients[0], collection=COLLECTION, serializer=request.param)
+        reader = MirroredRedisStorage(clients[1], collection=COLLECTION, serializer=request.param,
+                                      refresh_interval=10, timer=timer)
+        return writer, reader
+
+    def test_reads_are_served_from_mirror(self, storages, clients, timer):
+        writer, reader = storages
+        writer.add(Policy('1', description='foo'))
+        writer.add(Policy(2, actions=[Eq('get')]))
+        assert ['1', 2] == [p.uid for p in reader.find_for_inquiry(Inquiry(), RulesChecker())]
+        clients[1].hgetall = Mock(side_effect=Exception('mirror should be used'))
+        clients[1].get = Mock(side_effect=Exception('mirror should be used'))
+        assert 'foo' == reader.get('1').description
+        assert 'get' == reader.get(2).actions[0].val
+        assert None is reader.get('3')
+        assert [2] == [p.uid for p in reader.get_all(1, 1)]
+        assert [] == reader.get_all(0, 0)
+        clients[1].hscan = Mock(side_effect=Exception('mirror should be used'))
+        assert ['1', 2] == [p.uid for p in reader.retrieve_all(batch=1)]
+
+    def test_changes_are_seen_after_refresh_interval(self, storages, timer):
+        writer, reader = storages
+        writer.add(Policy('1', description='foo'))
+        writer.add(Policy('2'))
+        assert ['1', '2'] == [p.uid for p in reader.get_all(10, 0)]
+        writer.update(Policy('1', description='bar'))
+        writer.delete('2')
+        writer.add(Policy('3'))
+        assert 'foo' == reader.get('1').description
+        assert ['1', '2'] == [p.uid for p in reader.get_all(10, 0)]
+        timer.now = 11
+        assert 'bar' == reader.get('1').description
+        assert ['1', '3'] == [p.uid for p in reader.get_all(10, 0)]
+        assert 5 == reader.mirror_version
+
+    def test_only_changed_policies_are_fetched(self, storages, clients, timer):
+        writer, reader = storages
+        writer.add_many([Policy(str(i)) for i in range(10)])
+        assert 10 == len(reader.find_for_inquiry(Inquiry()))
+        writer.update_many([Policy('1', description='foo'), Policy('x')])
+        writer.delete_many(['2', '3'])
+        clients[1].hgetall = Mock(side_effect=Exception('only changes should be fetched'))
+        timer.now = 11
+        assert 8 == len(reader.find_for_inquiry(Inquiry()))
+        assert 'foo' == reader.get('1').description
+        assert None is reader.get('2')
+
+    def test_own_writes_are_seen_right_away(self, storages):
+        _, st = storages
+        assert [] == st.get_all(10, 0)
+        st.add(Policy('1'))
+        assert ['1'] == [p.uid for p in st.get_all(10, 0)]
+        with pytest.raises(PolicyExistsError):
+            st.add(Policy('1'))
+        st.update(Policy('1', description='foo'))
+        assert 'foo' == st.get('1').description
+        st.delete('1')
+        assert None is st.get('1')
+
+    def test_refresh(self, storages):
+        writer, reader = storages
+        assert [] == reader.get_all(10, 0)
+        writer.add(Policy('1'))
+        assert [] == reader.get_all(10, 0)
+        reader.refresh()
+        assert ['1'] == [p.uid for p in reader.get_all(10, 0)]
+
+    def test_recreated_collection_is_reloaded(self, storages, clients, timer):
+        writer, reader = storages
+        writer.add(Policy('1'))
+        writer.add(Policy('2'))
+        assert 2 == len(reader.get_all(10, 0))
+        clients[0].flushdb()
+        writer.add(Policy('3'))
+        timer.now = 11
+        assert ['3'] == [p.uid for p in reader.get_all(10, 0)]
+
+
+@pytest.mark.integration
+def test_async_mirrored_redis_storage():
+    async def run():
+        writer_client = AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=DB)
+        reader_client = AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=DB)
+        timer = FakeTimer()
+        try:
+            writer = AsyncMirroredRedisStorage(writer_client, collection=COLLECTION, serializer=JSONSerializer())
+            reader = AsyncMirroredRedisStorage(reader_client, collection=COLLECTION, serializer=JSONSerializer(),
+                                               refresh_interval=10, timer=timer)
+            await writer.add(Policy('1', subjects=['Max']))
+            await writer.add(Policy(2))
+            with pytest.raises(PolicyExistsError):
+                await writer.add(Policy('1'))
+            assert ['1', 2] == [p.uid for p in await reader.find_for_inquiry(Inquiry())]
+            await writer.update(Policy('1', subjects=['Jim']))
+            await writer.delete(2)
+            assert (await writer.add_many([Policy('3'), Policy('4')]))
+            await writer.update_many([Policy('3', description='foo')])
+            await writer.delete_many(['4'])
+            assert ['Max'] == (await reader.get('1')).subjects
+            timer.now = 11
+            assert ['Jim'] == (await reader.get('1')).subjects
+            assert ['1', '3'] == [p.uid for p in await reader.get_all(10, 0)]
+            assert 'foo' == (await reader.get('3')).description
+            await writer.delete('1')
+            await reader.refresh()
+            assert ['3'] == [p.uid for p in await reader.get_all(10, 0)]
+        finally:
+            await writer_client.flushdb()
+            await writer_client.close()
+            await reader_client.close()
+    asyncio.run(run())
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import struct
+
+import pytest
+
+from vakt.storage.memory import MemoryStorage, AsyncMemoryStorage
+from vakt.storage.snapshot import export_snapshot, read_snapshot, SnapshotPolicies, HEADER, MAGIC
+from vakt.policy import Policy
+from vakt.guard import Guard, Inquiry
+from vakt.effects import ALLOW_ACCESS
+from vakt.rules import Eq, In, Any, StartsWith, CIDR
+from vakt.checker import RulesChecker, RegexChecker, StringExactChecker, StringFuzzyChecker
+
+
+POLICIES = [
+    Policy('1', subjects=['Max', 'Nina'], actions=['get', 'put'], resources=['books:<\\d+>'], effect=ALLOW_ACCESS),
+    Policy('2', subjects=['<[A-Z][a-z]+>'], actions=['<get|list>'], resources=['books:<.*>:pdf'],
+           effect=ALLOW_ACCESS),
+    Policy('3', subjects=['<[broken>'], actions=['get'], resources=['<.*>']),
+    Policy(4, subjects=[{'name': Eq('Max')}, {'role': In('admin', (1, 2))}], actions=[Any()],
+           resources=[StartsWith('books')], context={'ip': CIDR('127.0.0.1/32')}, effect=ALLOW_ACCESS),
+    Policy(5, subjects=[{'name': Eq('Nina'), 'age': Eq(30)}], actions=[Eq('get')], resources=[Any()],
+           description='ф'),
+    Policy('6'),
+]
+
+INQUIRIES = [
+    (Inquiry(subject='Max', action='get', resource='books:1'), RegexChecker()),
+    (Inquiry(subject='Nina', action='list', resource='books:a:pdf'), RegexChecker()),
+    (Inquiry(subject='Max', action='get', resource='books:1'), StringExactChecker()),
+    (Inquiry(subject='ax', action='et', resource='ooks'), StringFuzzyChecker()),
+    (Inquiry(subject={'name': 'Max'}, action='get', resource='books:1'), RulesChecker()),
+    (Inquiry(subject={'role': (1, 2)}, action='get', resource='books:1'), RulesChecker()),
+    (Inquiry(subject={'name': 'Nina', 'age': 30}, action='get', resource='x'), RulesChecker()),
+]
+
+
+def dump(policies):
+    """
+    JSON of policies. Sets are dumped in their iteration order that differs between equal sets, so it's sorted.
+    """
+    def normalize(obj):
+        if isinstance(obj, list):
+            return [normalize(x) for x in obj]
+        if not isinstance(obj, dict):
+            return obj
+        obj = {k: normalize(v) for k, v in obj.items()}
+        if 'py/set' in obj:
+            obj['py/set'] = sorted(obj['py/set'], key=json.dumps)
+        return obj
+    return [normalize(json.loads(p.to_json())) for p in policies]
+
+
+@pytest.fixture
+def storage():
+    st = MemoryStorage()
+    for p in POLICIES:
+        st.add(p)
+    return st
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'policies.snapshot')
+
+
+def test_loaded_storage_finds_the_same_policies(storage, path):
+    assert len(POLICIES) == export_snapshot(storage, path, batch=2)
+    loaded = MemoryStorage.from_snapshot(path)
+    for inquiry, checker in INQUIRIES:
+        assert dump(storage.find_for_inquiry(inquiry, checker)) == dump(loaded.find_for_inquiry(inquiry, checker))
+        assert storage.inquiry_filter_key(inquiry, checker) == loaded.inquiry_filter_key(inquiry, checker)
+        assert Guard(storage, checker).is_allowed(inquiry) == Guard(loaded, checker).is_allowed(inquiry)
+    assert dump(POLICIES) == dump(loaded.get_all(100, 0))
+
+
+def test_policies_are_decoded_lazily(storage, path):
+    export_snapshot(storage, path)
+    loaded = MemoryStorage.from_snapshot(path)
+    assert isinstance(loaded.policies, SnapshotPolicies)
+    assert 0 == loaded.policies.decoded()
+    policy = loaded.get(4)
+    assert 1 == loaded.policies.decoded()
+    assert policy is loaded.get(4)
+    assert isinstance(policy.subjects[1]['role'], In)
+    assert {'admin', (1, 2)} == policy.subjects[1]['role'].data
+    assert None is loaded.get(100)
+    assert [5, '6'] == [p.uid for p in loaded.find_for_inquiry(*INQUIRIES[-1])]
+    assert 3 == loaded.policies.decoded()
+
+
+def test_loaded_storage_can_be_modified(storage, path):
+    export_snapshot(storage, path)
+    loaded = MemoryStorage.from_snapshot(path)
+    inquiry, checker = INQUIRIES[0]
+    loaded.delete('1')
+    loaded.update(Policy('2', subjects=['Max'], actions=['get'], resources=['books:<\\d+>']))
+    loaded.add(Policy('7', subjects=['Max'], actions=['get'], resources=['books:1']))
+    assert ['2', '3', '6', '7'] == [p.uid for p in loaded.find_for_inquiry(inquiry, checker)]
+    assert ['2', '3', 4, 5, '6', '7'] == [p.uid for p in loaded.retrieve_all()]
+
+
+def test_export_of_empty_storage(path):
+    assert 0 == export_snapshot(MemoryStorage(), path)
+    loaded = MemoryStorage.from_snapshot(path)
+    assert [] == loaded.get_all(10, 0)
+    assert [] == list(loaded.find_for_inquiry(Inquiry(subject='Max'), RegexChecker()))
+
+
+def test_export_replaces_existing_snapshot(storage, path):
+    export_snapshot(MemoryStorage(), path)
+    export_snapshot(storage, path)
+    policies, index_data = read_snapshot(path)
+    assert len(POLICIES) == len(policies)
+    assert ['1', '2', '3', 4, 5, '6'] == [uid for uid, _, _ in index_data]
+
+
+@pytest.mark.parametrize('header, error', [
+    (b'', 'is not a policy snapshot'),
+    (b'VAKTSMC1' + b'\0' * 20, 'is not a policy snapshot'),
+    (HEADER.pack(MAGIC, 2, 0, HEADER.size) + b'[]', 'has version 2, but only version 1 is supported'),
+    (HEADER.pack(MAGIC, 1, 3, HEADER.size) + b'[]', 'is corrupted: 3 policies expected, 0 found'),
+])
+def test_read_fails_for_incorrect_file(path, header, error):
+    with open(path, 'wb') as f:
+        f.write(header)
+    with pytest.raises(ValueError) as excinfo:
+        read_snapshot(path)
+    assert error in str(excinfo.value)
+
+
+def test_header_layout(storage, path):
+    export_snapshot(storage, path)
+    with open(path, 'rb') as f:
+        magic, version, count, table_offset = struct.unpack('<8sIQQ', f.read(28))
+    assert (b'VAKTSNAP', 1, len(POLICIES)) == (magic, version, count)
+    assert table_offset > 28
+
+
+def test_async_memory_storage_from_snapshot(storage, path):
+    export_snapshot(storage, path)
+
+    async def run():
+        st = AsyncMemoryStorage.from_snapshot(path)
+        assert '1' == (await st.get('1')).uid
+        inquiry, checker = INQUIRIES[0]
+        assert ['1', '3', '6'] == [p.uid for p in await st.find_for_inquiry(inquiry, checker)]
+    asyncio.run(run())
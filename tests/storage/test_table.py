@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from vakt.storage.table import PolicyTable, _read_consistent
+
+
+def test_mapping_interface():
+    table = PolicyTable([('a', 1), ('b', 2)])
+    table['c'] = 3
+    table['a'] = 10
+    assert ['a', 'b', 'c'] == list(table)
+    assert [10, 2, 3] == table.values()
+    assert 3 == len(table)
+    assert 'b' in table
+    del table['b']
+    assert 'b' not in table
+    assert None is table.get('b')
+    assert 'x' == table.get('b', 'x')
+    with pytest.raises(KeyError):
+        table['b']
+    with pytest.raises(KeyError):
+        del table['b']
+    table['b'] = 20
+    assert [('a', 10), ('c', 3), ('b', 20)] == list(table.items())
+    assert {'a': 10, 'c': 3, 'b': 20} == dict(table)
+
+
+def test_iteration_is_not_broken_by_modifications():
+    table = PolicyTable((i, i) for i in range(10))
+    seen = []
+    for uid in table:
+        seen.append(uid)
+        if uid < 5:
+            del table[uid + 5]
+            table[uid + 100] = uid
+    assert [0, 1, 2, 3, 4, 100, 101, 102, 103, 104] == seen
+    values = table.values()
+    table.clear()
+    assert [0, 1, 2, 3, 4, 0, 1, 2, 3, 4] == values
+    assert 0 == len(table)
+
+
+def test_empty_slots_are_compacted():
+    table = PolicyTable((i, i) for i in range(1000))
+    slots = table._state[0]
+    for i in range(900):
+        del table[i]
+    assert table._state[0] is not slots
+    assert len(table._state[0]) < 1000
+    # slots of the old list are emptied, but never removed
+    assert 1000 == len(slots)
+    assert list(range(900, 1000)) == list(table)
+    assert list(range(900, 1000)) == table.values()
+    assert 950 == table[950]
+    table[950] = 'x'
+    assert 'x' == table[950]
+    assert 100 == len(table)
+
+
+class Versioned:
+    read_attempts = 3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.calls = 0
+
+
+def test_read_consistent_retries_read_overlapped_with_modification():
+    owner = Versioned()
+
+    def read():
+        owner.calls += 1
+        if owner.calls == 1:
+            owner.version += 2
+            raise KeyError('a')
+        return owner.lock.locked()
+
+    assert False is _read_consistent(owner, read)
+    assert 2 == owner.calls
+
+
+def test_read_consistent_reads_under_lock_after_unsuccessful_attempts():
+    owner = Versioned()
+    owner.version = 1
+
+    def read():
+        owner.calls += 1
+        return owner.lock.locked()
+
+    assert True is _read_consistent(owner, read)
+    assert 1 == owner.calls
+
+
+def test_read_consistent_raises_errors_of_not_overlapped_read():
+    owner = Versioned()
+
+    def read():
+        owner.calls += 1
+        raise KeyError('a')
+
+    with pytest.raises(KeyError):
+        _read_consistent(owner, read)
+    assert 1 == owner.calls
@@ -6,7 +6,7 @@ import re
 import pytest
 
 from vakt.audit import (PoliciesUidMsg, PoliciesNopMsg,
-                        PoliciesDescriptionMsg, PoliciesCountMsg)
+                        PoliciesDescriptionMsg, PoliciesCountMsg, InquiriesMsg)
 from vakt.policy import Policy, PolicyAllow, PolicyDeny
 from vakt.effects import ALLOW_ACCESS
 from vakt.guard import Guard, Inquiry
@@ -200,3 +200,56 @@ def test_guard_can_use_specific_policies_message_class(audit_log):
     # Run tests
     g.is_allowed(Inquiry(action='get', subject='Kim', resource='TV'))
     assert 'decs: count = 1, candidates: count = 3' == log_capture_str.getvalue().strip()
+
+
+def test_guard_logs_single_audit_record_for_batch(audit_log):
+    log_capture_str = io.StringIO()
+    h = logging.StreamHandler(log_capture_str)
+    h.setFormatter(logging.Formatter(
+        'msg: %(message)s | effect: %(effect)s | deciders: %(deciders)s | candidates: %(candidates)s'
+    ))
+    h.setLevel(logging.INFO)
+    audit_log.setLevel(logging.INFO)
+    audit_log.addHandler(h)
+    st = MemoryStorage()
+    st.add(PolicyAllow(uid='a', subjects=['Max'], actions=['<.*>'], resources=['<.*>']))
+    st.add(PolicyAllow(uid='c', subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    st.add(PolicyDeny(uid='d', subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    g = Guard(st, RegexChecker())
+    inquiries = [
+        Inquiry(action='get', subject='Max', resource='book'),
+        Inquiry(action='get', subject='Jim', resource='book'),
+        Inquiry(action='get', subject='Kim', resource='book'),
+    ]
+    assert [True, False, False] == g.is_allowed_many(inquiries, batch_audit=True)
+    assert "msg: Batch of inquiries was checked | effect: ['allow', 'deny', 'deny'] | " + \
+           'deciders: [a, d] | candidates: [a, c, d]' == log_capture_str.getvalue().strip()
+
+
+def test_inquiries_msg():
+    m = InquiriesMsg([Inquiry(action='get'), Inquiry(action='put')])
+    result = re.sub(r'<Object ID \d+>', '<Object ID some_ID>', str(m))
+    assert "[<class 'vakt.guard.Inquiry'> <Object ID some_ID>: " + \
+           "{'resource': '', 'action': 'get', 'subject': '', 'context': {}}, " + \
+           "<class 'vakt.guard.Inquiry'> <Object ID some_ID>: " + \
+           "{'resource': '', 'action': 'put', 'subject': '', 'context': {}}]" == result
+    assert '[]' == str(InquiriesMsg())
+
+
+def test_guard_logs_short_circuited_decision_in_deny_first_mode(audit_log):
+    log_capture_str = io.StringIO()
+    h = logging.StreamHandler(log_capture_str)
+    h.setFormatter(logging.Formatter(
+        'msg: %(message)s | effect: %(effect)s | deciders: %(deciders)s | candidates: %(candidates)s'
+    ))
+    h.setLevel(logging.INFO)
+    audit_log.setLevel(logging.INFO)
+    audit_log.addHandler(h)
+    st = MemoryStorage()
+    st.add(PolicyAllow(uid='c', subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    st.add(PolicyDeny(uid='d', subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    st.add(PolicyDeny(uid='e', subjects=['Jim'], actions=['<.*>'], resources=['<.*>']))
+    g = Guard(st, RegexChecker(), deny_first=True)
+    assert not g.is_allowed(Inquiry(action='get', subject='Jim', resource='book'))
+    assert 'msg: One of matching policies has deny effect (short-circuited) | effect: deny | ' + \
+           'deciders: [d] | candidates: [d]' == log_capture_str.getvalue().strip()
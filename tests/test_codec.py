@@ -0,0 +1,152 @@
+import json
+
+import jsonpickle
+import pytest
+
+from vakt import codec
+from vakt.policy import Policy
+from vakt.guard import Inquiry
+from vakt.effects import ALLOW_ACCESS
+from vakt.rules.base import Rule
+from vakt.rules import Eq, NotEq, And, Or, Not, Truthy, Any, In, AnyIn, AllNotIn, StartsWith, RegexMatch, CIDR, \
+    SubjectEqual, ActionMatch
+
+
+class Custom(Rule):
+    def __init__(self, val):
+        self.val = val
+
+    def satisfied(self, what, inquiry=None):
+        return self.val == what
+
+
+class CustomEq(Eq):
+    pass
+
+
+def jsonpickle_encode(value, sort=False):
+    jsonpickle.set_encoder_options('json', sort_keys=sort)
+    return jsonpickle.encode(value)
+
+
+VALUES = [
+    None,
+    1,
+    'foo',
+    [1, 2.5, True, None],
+    # sets of integers, so that their order doesn't change after decoding
+    {'a': (1, 2), 'b': {1, 2}, 'ф': 'юникод'},
+    Eq('foo'),
+    NotEq((1, 2, [3])),
+    And(StartsWith('foo', ci=True), Not(In(1, 2, 3)), Or(AnyIn('a'), AllNotIn('b'))),
+    RegexMatch(r'\d+ items?'),
+    CIDR('192.168.0.0/24'),
+    SubjectEqual(),
+    ActionMatch('name'),
+    Truthy(),
+    Any(),
+    Eq(float('inf')),
+    # values below are handled by jsonpickle
+    [Eq(1)] * 2,
+    {1: Eq(1), 2: 'b'},
+    {'py/object': 'x'},
+    Eq(b'bytes'),
+    Custom(Eq(3)),
+    CustomEq(4),
+    [RegexMatch('a'), RegexMatch('a')],
+]
+
+
+@pytest.mark.parametrize('sort', [False, True])
+@pytest.mark.parametrize('value', VALUES)
+def test_encode_is_the_same_as_jsonpickle(value, sort):
+    assert jsonpickle_encode(value, sort) == codec.encode(value, sort=sort)
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_decode_restores_the_same_as_jsonpickle(value):
+    data = jsonpickle_encode(value)
+    assert jsonpickle_encode(jsonpickle.decode(data)) == jsonpickle_encode(codec.decode(data))
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_flatten_and_restore(value):
+    data = codec.flatten(value)
+    assert json.loads(jsonpickle_encode(value)) == json.loads(json.dumps(data))
+    assert jsonpickle_encode(value) == jsonpickle_encode(codec.restore(data))
+
+
+def test_decoded_rules_are_working():
+    rule = codec.decode(codec.encode(And(StartsWith('Max', ci=True), RegexMatch(r'.+ \d$'), Not(Eq('MAXIM 2')))))
+    assert isinstance(rule, And)
+    assert rule.satisfied('max 1')
+    assert not rule.satisfied('MAXIM 2')
+    assert not rule.satisfied('Jimmy 1')
+    assert codec.decode(codec.encode(CIDR('10.0.0.0/8'))).satisfied('10.1.2.3')
+    assert (1, 2) == codec.decode(codec.encode(Eq((1, 2)))).val
+    assert {1, 2} == codec.decode(codec.encode(In(1, 2))).data
+
+
+def test_policy_and_inquiry_json_is_the_same_as_jsonpickle():
+    policy = Policy(1, subjects=[Eq('Max'), {'role': In(1, 2)}], effect=ALLOW_ACCESS,
+                    resources=[RegexMatch('books/.*')], actions=[Any()], context={'ip': CIDR('127.0.0.1/32')},
+                    description='ф')
+    inquiry = Inquiry(subject={'name': 'Max', 'ids': (1, 2)}, action='get', resource='books/1',
+                      context={'ip': '127.0.0.1'})
+    for obj in (policy, inquiry):
+        for sort in (False, True):
+            assert jsonpickle_encode(obj._data(), sort) == obj.to_json(sort=sort)
+            assert jsonpickle_encode(obj._data(), sort) == type(obj).from_json(obj.to_json(sort=sort)).to_json(sort)
+
+
+def test_decode_fails_for_incorrect_json():
+    with pytest.raises(ValueError) as excinfo:
+        codec.decode('{"a":')
+    assert 'Expecting value' in str(excinfo.value)
+
+
+def test_register_rule():
+    rule = Custom([1, (2,)])
+    name = '%s.%s' % (Custom.__module__, Custom.__qualname__)
+    assert name not in codec._RULES
+    assert Custom is codec.register_rule(Custom)
+    try:
+        data = codec.encode(rule)
+        assert jsonpickle_encode(rule) == data
+        restored = codec.decode(data)
+        assert isinstance(restored, Custom)
+        assert [1, (2,)] == restored.val
+    finally:
+        del codec._RULES[name]
+        del codec._RULE_NAMES[Custom]
+
+
+def test_register_rules():
+    class WithState(Rule):
+        def __init__(self, val):
+            self.val = val
+
+        def __getstate__(self):
+            return {'val': self.val}
+
+        def satisfied(self, what, inquiry=None):
+            return self.val == what
+
+    module = type(codec)('test_register_rules_module')
+    WithState.__module__ = module.__name__
+    Custom2 = type('Custom2', (Custom,), {'__module__': module.__name__})
+    module.WithState, module.Custom2, module.Eq = WithState, Custom2, Eq
+    try:
+        codec.register_rules(Rule, module)
+        assert Custom2 in codec._RULE_NAMES
+        # classes with custom state handling and classes defined in other modules are not registered
+        assert WithState not in codec._RULE_NAMES
+        assert 'test_register_rules_module.Eq' not in codec._RULES
+    finally:
+        codec._RULES.pop(codec._RULE_NAMES.pop(Custom2, None), None)
+
+
+def test_vakt_rules_are_registered():
+    for cls in (Eq, NotEq, And, Or, Not, Truthy, Any, In, AnyIn, AllNotIn, StartsWith, RegexMatch, CIDR,
+                SubjectEqual, ActionMatch):
+        assert cls in codec._RULE_NAMES
@@ -0,0 +1,360 @@
+import threading
+
+import pytest
+
+from vakt.checker import RegexChecker, StringExactChecker, StringFuzzyChecker, RulesChecker
+from vakt.compiled import CompiledGuard, CompiledPolicy, CompiledPolicySet, CIDRTree
+from vakt.effects import ALLOW_ACCESS, DENY_ACCESS
+from vakt.guard import Guard, Inquiry
+from vakt.policy import Policy
+from vakt.rules.net import CIDR, ip_network
+from vakt.rules.operator import Eq
+from vakt.rules.list import In
+from vakt.storage.memory import MemoryStorage
+from vakt.storage.observable import ObservableMutationStorage, PolicyMutation
+
+
+POLICIES = [
+    Policy('1', effect=ALLOW_ACCESS, subjects=['Max', 'Nina'], actions=['get', '<put|post>'], resources=['<.*>']),
+    Policy('2', effect=DENY_ACCESS, subjects=['<Max>'], actions=['post'], resources=['secret']),
+    Policy('3', effect=ALLOW_ACCESS, subjects=['<[A-Z][a-z]+>'], actions=['list'], resources=['books:<.*>']),
+    Policy('4', effect=ALLOW_ACCESS, subjects=['Max'], actions=['watch'], resources=['TV'],
+           context={'ip': CIDR('127.0.0.1/32')}),
+    Policy('5', effect=ALLOW_ACCESS, subjects=['Jim'], actions=['get'], resources=['<[invalid>']),
+    Policy('6', effect=ALLOW_ACCESS, subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('TV')]),
+    Policy('7', effect=ALLOW_ACCESS),
+]
+
+POLICY_UIDS = [p.uid for p in POLICIES]
+
+INQUIRIES = [
+    Inquiry(subject='Max', action='get', resource='TV'),
+    Inquiry(subject='Max', action='post', resource='secret'),
+    Inquiry(subject='Nina', action='post', resource='secret'),
+    Inquiry(subject='Nina', action='list', resource='books:Hobbit'),
+    Inquiry(subject='nina', action='list', resource='books:Hobbit'),
+    Inquiry(subject='Max', action='watch', resource='TV', context={'ip': '127.0.0.1'}),
+    Inquiry(subject='Max', action='watch', resource='TV', context={'ip': '127.0.0.2'}),
+    Inquiry(subject='Max', action='watch', resource='TV'),
+    Inquiry(subject='Jim', action='get', resource='[invalid'),
+    Inquiry(subject='ax', action='ge', resource='T'),
+    Inquiry(subject='<Max>', action='post', resource='secret'),
+    Inquiry(),
+]
+
+
+@pytest.mark.parametrize('checker', [
+    RegexChecker(),
+    StringExactChecker(),
+    StringFuzzyChecker(),
+    RulesChecker(),
+])
+@pytest.mark.parametrize('deny_first', [False, True])
+def test_compiled_guard_gives_the_same_answers_as_guard(checker, deny_first):
+    st = MemoryStorage()
+    for p in POLICIES:
+        st.add(p)
+    guard, compiled = Guard(st, checker), CompiledGuard(st, checker, deny_first=deny_first)
+    for inquiry in INQUIRIES:
+        assert guard.is_allowed(inquiry) == compiled.is_allowed(inquiry)
+    assert guard.is_allowed_many(INQUIRIES) == compiled.is_allowed_many(INQUIRIES)
+    assert guard.is_allowed_many(INQUIRIES, batch_audit=True) == compiled.is_allowed_many(INQUIRIES, batch_audit=True)
+
+
+@pytest.mark.parametrize('checker', [
+    RegexChecker(),
+    StringExactChecker(),
+    StringFuzzyChecker(),
+])
+@pytest.mark.parametrize('deny_first', [False, True])
+def test_compiled_guard_gives_the_same_answers_as_guard_for_empty_values(checker, deny_first):
+    st = MemoryStorage()
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max', '', 'Nina'], actions=['get'], resources=['TV']))
+    st.add(Policy('2', effect=DENY_ACCESS, subjects=['Jim'], actions=['', 'get'], resources=['TV']))
+    inquiries = [
+        Inquiry(subject='Max', action='get', resource='TV'),
+        Inquiry(subject='Nina', action='get', resource='TV'),
+        Inquiry(subject='Jim', action='get', resource='TV'),
+        Inquiry(subject='', action='', resource='TV'),
+        Inquiry(subject='Max', action='get', resource='book'),
+    ]
+    guard, compiled = Guard(st, checker), CompiledGuard(st, checker, deny_first=deny_first)
+    assert [guard.is_allowed(i) for i in inquiries] == [compiled.is_allowed(i) for i in inquiries]
+    assert guard.is_allowed_many(inquiries) == compiled.is_allowed_many(inquiries)
+
+
+def test_compiled_guard_gives_the_same_answers_for_custom_checker():
+    class LowerCaseChecker(StringExactChecker):
+        def compare(self, needle, haystack):
+            return needle.lower() == haystack.lower()
+
+    st = MemoryStorage()
+    for p in POLICIES:
+        st.add(p)
+    inquiry = Inquiry(subject='max', action='WATCH', resource='tv', context={'ip': '127.0.0.1'})
+    assert Guard(st, LowerCaseChecker()).is_allowed(inquiry)
+    assert CompiledGuard(st, LowerCaseChecker()).is_allowed(inquiry)
+
+
+@pytest.mark.parametrize('checker, inquiry, expected', [
+    (RegexChecker(), Inquiry(subject='Max', action='get', resource='TV'), ['1', '7']),
+    (RegexChecker(), Inquiry(subject='Jim', action='get', resource='[invalid'), ['5', '7']),
+    (RegexChecker(), Inquiry(subject={'name': 'Max'}, action='get', resource='TV'), POLICY_UIDS),
+    (StringExactChecker(), Inquiry(subject='Max', action='watch', resource='TV'), ['4', '7']),
+    (StringExactChecker(), Inquiry(subject='Nobody', action='get', resource='TV'), ['7']),
+    (StringFuzzyChecker(), Inquiry(subject='Max'), ['1', '2', '4', '7']),
+    (StringFuzzyChecker(), Inquiry(subject='ax', action='ge', resource='T'), ['7']),
+    (RulesChecker(), Inquiry(subject='Max', action='get', resource='TV'), ['6', '7']),
+])
+def test_compiled_policy_set_candidates(checker, inquiry, expected):
+    policy_set = CompiledPolicySet(POLICIES, checker)
+    assert expected == [c.policy.uid for c in policy_set.candidates(inquiry)]
+
+
+def test_compiled_policy_set_candidates_for_custom_checker():
+    class LowerCaseChecker(StringExactChecker):
+        pass
+
+    policy_set = CompiledPolicySet(POLICIES, LowerCaseChecker())
+    assert POLICY_UIDS == [c.policy.uid for c in policy_set.candidates(Inquiry(subject='Max'))]
+
+
+@pytest.mark.parametrize('checker', [
+    RegexChecker(),
+    StringExactChecker(),
+    StringFuzzyChecker(),
+    RulesChecker(),
+])
+def test_compiled_policy_set_apply(checker):
+    policy_set = CompiledPolicySet(POLICIES, checker)
+    replaced = Policy('4', effect=DENY_ACCESS, subjects=['Max'], actions=['get'], resources=['TV'],
+                      context={'ip': CIDR('10.0.0.0/8')})
+    added = Policy('8', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['TV'],
+                   context={'ip': CIDR('127.0.0.0/8')})
+    policy_set.apply([
+        PolicyMutation(PolicyMutation.UPDATE, '4', POLICIES[3], replaced),
+        PolicyMutation(PolicyMutation.DELETE, '1', POLICIES[0], None),
+        PolicyMutation(PolicyMutation.ADD, '8', None, added),
+        # storage had no such policy, so update doesn't add it
+        PolicyMutation(PolicyMutation.UPDATE, '9', None, Policy('9')),
+        PolicyMutation(PolicyMutation.DELETE, '10', None, None),
+    ])
+    expected = CompiledPolicySet(POLICIES[1:3] + [replaced] + POLICIES[4:] + [added], checker)
+    assert [c.policy.uid for c in expected.policies.values()] == [c.policy.uid for c in policy_set.policies.values()]
+    for inquiry in INQUIRIES + [Inquiry(subject='Max', action='get', resource='TV', context={'ip': '10.0.0.1'}),
+                                Inquiry(subject='Max', action='get', resource='TV', context={'ip': '127.0.0.1'})]:
+        assert [c.policy.uid for c in expected.candidates(inquiry)] == \
+               [c.policy.uid for c in policy_set.candidates(inquiry)]
+        for deny_first in (False, True):
+            assert _decide(expected, inquiry, deny_first) == _decide(policy_set, inquiry, deny_first)
+    assert {'ip'} == set(policy_set.networks)
+    assert set() == policy_set.networks['ip'].match('127.0.0.2') - {'8'}
+
+
+def _decide(policy_set, inquiry, deny_first):
+    try:
+        decision = policy_set.decide(inquiry, deny_first)
+    except Exception as e:
+        return type(e)
+    return decision.effect, [p.uid for p in decision.candidates]
+
+
+def test_compiled_guard_is_recompiled_on_storage_changes():
+    st = ObservableMutationStorage(MemoryStorage())
+    g = CompiledGuard(st, RegexChecker())
+    inquiry = Inquiry(subject='Max', action='get', resource='book')
+    assert not g.is_allowed(inquiry)
+    p = Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['<.*>'])
+    st.add(p)
+    assert g.is_allowed(inquiry)
+    p.effect = DENY_ACCESS
+    st.update(p)
+    assert not g.is_allowed(inquiry)
+    st.delete('1')
+    st.add(Policy('2', effect=ALLOW_ACCESS, subjects=['<M.*>'], actions=['get'], resources=['book']))
+    assert g.is_allowed(inquiry)
+
+
+def test_compiled_guard_compiles_only_modified_policies(monkeypatch):
+    st = ObservableMutationStorage(MemoryStorage())
+    for p in POLICIES:
+        st.add(p)
+    g = CompiledGuard(st, RegexChecker())
+    g.compile()
+    compiled = []
+    original = CompiledPolicy.__init__
+
+    def init(self, policy, checker):
+        compiled.append(policy.uid)
+        original(self, policy, checker)
+
+    monkeypatch.setattr(CompiledPolicy, '__init__', init)
+    inquiry = Inquiry(subject='Max', action='watch', resource='TV', context={'ip': '127.0.0.1'})
+    assert g.is_allowed(inquiry)
+    st.update(Policy('4', effect=DENY_ACCESS, subjects=['Max'], actions=['watch'], resources=['TV'],
+                     context={'ip': CIDR('127.0.0.1/32')}))
+    assert not g.is_allowed(inquiry)
+    st.delete('4')
+    st.add(Policy('8', effect=ALLOW_ACCESS, subjects=['Max'], actions=['watch'], resources=['TV']))
+    assert g.is_allowed(inquiry)
+    assert ['4', '8'] == compiled
+    # event without payload makes guard compile all the policies
+    g.update()
+    assert g.is_allowed(inquiry)
+    assert len(st.get_all(100, 0)) + 2 == len(compiled)
+
+
+@pytest.mark.parametrize('checker', [RegexChecker(), StringExactChecker(), RulesChecker()])
+def test_compiled_guard_decisions_are_consistent_with_concurrent_modifications(checker):
+    st = ObservableMutationStorage(MemoryStorage())
+    # permanent policies that should always decide
+    st.add(Policy('p1', subjects=['Max'], actions=['get'], resources=['books'], effect=ALLOW_ACCESS))
+    st.add(Policy('p2', subjects=[{'name': Eq('Max')}], actions=[Eq('get')], resources=[Eq('books')],
+                  effect=ALLOW_ACCESS))
+    st.add(Policy('p3', subjects=['Max'], actions=['post'], resources=['books'], effect=DENY_ACCESS,
+                  context={'ip': CIDR('10.0.0.0/8')}))
+    st.add(Policy('p4', subjects=[{'name': Eq('Max')}], actions=[Eq('post')], resources=[Eq('books')],
+                  effect=DENY_ACCESS, context={'ip': CIDR('10.0.0.0/8')}))
+    g = CompiledGuard(st, checker)
+    inquiries = [Inquiry(subject=subject, action=action, resource='books', context={'ip': '10.1.1.1'})
+                 for subject in ('Max', {'name': 'Max'}) for action in ('get', 'post')]
+    expected = [g.is_allowed(inquiry) for inquiry in inquiries]
+    stop, errors = threading.Event(), []
+
+    def write():
+        i = 0
+        try:
+            while not stop.is_set():
+                uid = 'w%d' % (i % 7)
+                if i % 3 == 0:
+                    st.delete(uid)
+                else:
+                    policy = Policy(uid, subjects=['Max', '<M.*>'], actions=['put'], resources=['<book.*>'],
+                                    context={'ip': CIDR('10.1.0.0/16')})
+                    if i % 2:
+                        policy = Policy(uid, subjects=[{'name': In('Max', 'Nina')}], actions=[Eq('put')],
+                                        resources=[Eq('books')], context={'ip': CIDR('10.1.0.0/16')})
+                    if st.get(uid) is None:
+                        st.add(policy)
+                    else:
+                        st.update(policy)
+                i += 1
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(300):
+                assert expected == [g.is_allowed(inquiry) for inquiry in inquiries]
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=write)
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    writer.start()
+    for t in readers:
+        t.start()
+    for t in readers:
+        t.join()
+    stop.set()
+    writer.join()
+    assert [] == errors
+    assert {True, False} == set(expected)
+
+
+def test_compiled_guard_is_recompiled_if_modification_fails_to_apply(monkeypatch):
+    st = ObservableMutationStorage(MemoryStorage())
+    g = CompiledGuard(st, StringExactChecker())
+    inquiry = Inquiry(subject='Max', action='get', resource='book')
+    assert not g.is_allowed(inquiry)
+
+    def apply(self, mutations):
+        raise Exception('boom')
+
+    monkeypatch.setattr(CompiledPolicySet, 'apply', apply)
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['book']))
+    assert g.is_allowed(inquiry)
+
+
+def test_compiled_guard_needs_explicit_compile_for_non_observable_storage():
+    st = MemoryStorage()
+    g = CompiledGuard(st, StringExactChecker())
+    inquiry = Inquiry(subject='Max', action='get', resource='book')
+    assert not g.is_allowed(inquiry)
+    st.add(Policy('1', effect=ALLOW_ACCESS, subjects=['Max'], actions=['get'], resources=['book']))
+    assert not g.is_allowed(inquiry)
+    g.compile()
+    assert g.is_allowed(inquiry)
+
+
+def test_compiled_guard_does_not_fail_on_unexpected_exception():
+    class BadStorage(MemoryStorage):
+        def get_all(self, limit, offset):
+            raise Exception('boom')
+
+    g = CompiledGuard(BadStorage(), RegexChecker())
+    assert not g.is_allowed(Inquiry(subject='Max', action='get', resource='book'))
+    assert [False, False] == g.is_allowed_many([Inquiry(), Inquiry()])
+
+
+@pytest.mark.parametrize('networks, ip, expected', [
+    ([], '127.0.0.1', set()),
+    (['127.0.0.1/32'], '127.0.0.1', {0}),
+    (['127.0.0.1/32'], '127.0.0.2', set()),
+    (['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.2.0.0/16'], '10.1.2.3', {0, 1, 2, 3}),
+    (['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.2.0.0/16'], '10.2.2.3', {0, 1, 4}),
+    (['0.0.0.0/0', '10.0.0.0/8'], '192.168.0.1', {0}),
+    (['0.0.0.0/0', '::/0'], '::1', {1}),
+    (['2001:db8::/32', '2001:db8:1::/48', '10.0.0.0/8'], '2001:db8:1::1', {0, 1}),
+    (['2001:db8::/32', '2001:db8:1::/48'], '2001:db9::1', set()),
+    (['0.0.0.0/0'], 'not-an-ip', set()),
+    (['0.0.0.0/0'], 127001, set()),
+    (['0.0.0.0/0'], None, set()),
+])
+def test_cidr_tree_match(networks, ip, expected):
+    tree = CIDRTree()
+    for i, network in enumerate(networks):
+        tree.add(ip_network(network), i)
+    assert expected == tree.match(ip)
+
+
+def test_cidr_tree_remove():
+    networks = ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.0/24', '::/0']
+    tree = CIDRTree()
+    for i, network in enumerate(networks):
+        tree.add(ip_network(network), i)
+    tree.remove(ip_network('10.1.2.0/24'), 3)
+    tree.remove(ip_network('10.1.2.0/24'), 5)
+    tree.remove(ip_network('192.168.0.0/16'), 0)
+    assert {0, 1, 2, 4} == tree.match('10.1.2.3')
+    tree.remove(ip_network('10.1.2.0/24'), 4)
+    tree.remove(ip_network('10.1.0.0/16'), 2)
+    assert {0, 1} == tree.match('10.1.2.3')
+    tree.remove(ip_network('10.0.0.0/8'), 1)
+    tree.remove(ip_network('0.0.0.0/0'), 0)
+    assert set() == tree.match('10.1.2.3')
+    # empty nodes are dropped
+    assert [None, None, set()] == tree.roots[4]
+    assert {5} == tree.match('::1')
+
+
+def test_compiled_guard_gives_the_same_answers_as_guard_for_cidr_rules():
+    networks = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3/32', '192.168.0.0/16', '::/0',
+                '2001:db8::/32', '10.1.2.3/24', 'invalid']
+    st = MemoryStorage()
+    for i, network in enumerate(networks):
+        st.add(Policy(str(i), effect=ALLOW_ACCESS if i % 3 else DENY_ACCESS,
+                      subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('book')],
+                      context={'ip': CIDR(network), 'proxy': CIDR(networks[-i - 1])}))
+    st.add(Policy('other', effect=ALLOW_ACCESS, subjects=[Eq('Max')], actions=[Eq('get')], resources=[Eq('book')],
+                  context={'ip': CIDR('10.0.0.0/8'), 'user': Eq('Max')}))
+    guard, compiled = Guard(st, RulesChecker()), CompiledGuard(st, RulesChecker())
+    ips = ['10.1.2.3', '10.1.2.4', '10.1.3.1', '10.2.0.1', '192.168.1.1', '2001:db8::1', '::1', 'invalid', 1, None]
+    for ip in ips:
+        for proxy in ips:
+            for ctx in ({'ip': ip, 'proxy': proxy}, {'ip': ip, 'proxy': proxy, 'user': 'Max'}, {'ip': ip}):
+                inquiry = Inquiry(subject='Max', action='get', resource='book', context=ctx)
+                assert guard.is_allowed(inquiry) == compiled.is_allowed(inquiry)
+                expected = guard.decide(inquiry, st.find_for_inquiry(inquiry, guard.checker))
+                decision = compiled.compile().decide(inquiry)
+                assert [p.uid for p in expected.candidates] == [p.uid for p in decision.candidates]
@@ -1,6 +1,6 @@
 import pytest
 
-from vakt.parser import compile_regex
+from vakt.parser import compile_regex, get_literal_affixes
 from vakt.exceptions import InvalidPatternError
 
 
@@ -53,3 +53,21 @@ def test_compile_regex_output_matches_correctly(phrase, start, end, match_agains
         assert result.match(match_against)
     else:
         assert not result.match(match_against)
+
+
+@pytest.mark.parametrize('phrase, start, end, prefix, suffix', [
+    ('library:books:<.+>', '<', '>', 'library:books:', ''),
+    ('<.+>:books', '<', '>', '', ':books'),
+    ('a<.+>b<[0-9]>c', '<', '>', 'a', 'c'),
+    ('<.*>', '<', '>', '', ''),
+    ('a[[abc]+]b', '[', ']', 'a', 'b'),
+    ('abc', '<', '>', 'abc', ''),
+    ('', '<', '>', '', ''),
+])
+def test_get_literal_affixes(phrase, start, end, prefix, suffix):
+    assert (prefix, suffix) == get_literal_affixes(phrase, start, end)
+
+
+def test_get_literal_affixes_raises_exception_if_unbalanced():
+    with pytest.raises(InvalidPatternError):
+        get_literal_affixes('foo:bar:<.*', '<', '>')
@@ -1,6 +1,9 @@
+import copy
+import pickle
+
 import pytest
 
-from vakt.policy import Policy, PolicyAllow, PolicyDeny
+from vakt.policy import Policy, PolicyAllow, PolicyDeny, FrozenPolicy
 from vakt.effects import ALLOW_ACCESS, DENY_ACCESS
 from vakt.exceptions import PolicyCreationError
 from vakt.rules.net import CIDR
@@ -306,3 +309,89 @@ def test_PolicyAllow_and_PolicyDeny(klass, is_allowed, effect):
                 subjects=['<qwerty>'], description='test', effect=ALLOW_ACCESS if is_allowed else DENY_ACCESS)
     p4 = klass(1, ['<qwerty>'], ['asdf'], ['<foo.bar>'], {}, 'test')
     assert p3.to_json(sort=True) == p4.to_json(sort=True)
+
+
+FROZEN_POLICIES = [
+    Policy(1),
+    Policy('1', effect=ALLOW_ACCESS, subjects=['Max', '<[Nn]ina>'], actions=('get',), resources=['books:<.*>'],
+           context={'ip': CIDR('127.0.0.1/32')}, description='readme'),
+    Policy('2', subjects=[{'name': Eq('Max'), 'rate': Greater(90)}], actions=[Eq('get'), Eq('post')],
+           resources=[Any()], context={'secret': Equal('i-am-a-teacher')}),
+]
+
+
+@pytest.mark.parametrize('policy', FROZEN_POLICIES)
+def test_frozen_policy_is_the_same_as_policy(policy):
+    frozen = FrozenPolicy.from_policy(policy)
+    for attr in ('uid', 'effect', 'description', 'type', 'start_tag', 'end_tag'):
+        assert getattr(policy, attr) == getattr(frozen, attr)
+    for attr in ('subjects', 'actions', 'resources'):
+        assert tuple(getattr(policy, attr)) == getattr(frozen, attr)
+    assert policy.context == dict(frozen.context)
+    assert policy.allow_access() == frozen.allow_access()
+    assert policy.to_json(sort=True) == frozen.to_json(sort=True)
+    assert frozen.to_json(sort=True) == FrozenPolicy.from_json(policy.to_json()).to_json(sort=True)
+    assert policy.to_json(sort=True) == frozen.to_policy().to_json(sort=True)
+    assert frozen.to_json(sort=True) == pickle.loads(pickle.dumps(frozen)).to_json(sort=True)
+    assert frozen.to_json(sort=True) == copy.deepcopy(frozen).to_json(sort=True)
+
+
+def test_frozen_policy_is_compact_and_immutable():
+    p = FrozenPolicy('1', subjects=['Max'], context={'ip': CIDR('127.0.0.1/32')})
+    assert not hasattr(p, '__dict__')
+    with pytest.raises(AttributeError):
+        p.effect = ALLOW_ACCESS
+    with pytest.raises(AttributeError):
+        p.new_attribute = 1
+    with pytest.raises(AttributeError):
+        del p.uid
+    with pytest.raises(TypeError):
+        p.context['ip'] = CIDR('0.0.0.0/0')
+    assert DENY_ACCESS == p.effect
+
+
+def test_frozen_policy_copies_its_arguments():
+    subjects, context = ['Max'], {'ip': CIDR('127.0.0.1/32')}
+    p = FrozenPolicy('1', subjects=subjects, context=context)
+    subjects.append('Nina')
+    context['user'] = Eq('Max')
+    assert ('Max',) == p.subjects
+    assert ['ip'] == list(p.context)
+    assert p.context is not FrozenPolicy('2', context=p.context).context
+
+
+def test_frozen_policy_from_json():
+    p = FrozenPolicy.from_json('{"uid": 1, "subjects": ["Max"], "rules": {}, "type": 2}')
+    assert 1 == p.uid
+    assert ('Max',) == p.subjects
+    assert TYPE_STRING_BASED == p.type
+    assert DENY_ACCESS == p.effect
+    with pytest.raises(PolicyCreationError):
+        FrozenPolicy.from_json('{"subjects": ["Max"]}')
+
+
+def test_frozen_policy_pretty_print():
+    p = FrozenPolicy('1', subjects=['Max'])
+    assert "<class 'vakt.policy.FrozenPolicy'>" in str(p)
+    assert "'subjects': ['Max']" in str(p)
+
+
+@pytest.mark.parametrize('policy_data', [
+    {'uid': 1, 'actions': [{'ip': CIDR('127.0.0.1')}, '<.*>']},
+    {'uid': 1, 'subjects': ['Jane'], 'actions': [Eq('run')]},
+])
+def test_frozen_policy_raises_exception_if_mixed_elements(policy_data):
+    with pytest.raises(PolicyCreationError):
+        FrozenPolicy(**policy_data)
+
+
+@pytest.mark.parametrize('args, msg', [
+    ({'actions': (1, 2)}, 'Field "actions" element must be of `str`, `dict` or `Rule` type.'),
+    ({'subjects': (1, {})}, 'Field "subjects" element must be of `str`, `dict` or `Rule` type'),
+    ({'context': ()}, 'Error creating Policy. Context must be a dictionary'),
+    ({'context': 'data'}, 'Error creating Policy. Context must be a dictionary'),
+])
+def test_frozen_policy_field_type_check(args, msg):
+    with pytest.raises(PolicyCreationError) as excinfo:
+        FrozenPolicy(1, **args)
+    assert msg in str(excinfo.value)
@@ -1,4 +1,6 @@
-from vakt.util import JsonSerializer, Subject
+import pytest
+
+from vakt.util import JsonSerializer, Subject, structural_digest
 from .helper import CountObserver
 
 
@@ -36,6 +38,26 @@ def test_observables():
     assert 2 == o1.count
     assert 2 == o2.count
     subj.remove_listener(o1)
-    subj.notify()
+    subj.notify('event')
     assert 2 == o1.count
     assert 3 == o2.count
+    assert [None, None, 'event'] == o2.events
+
+
+@pytest.mark.parametrize('first, second, must_equal', [
+    ({'a': 1, 'b': [1, 2]}, {'b': [1, 2], 'a': 1}, True),
+    ({'a', 'b', 'c'}, {'c', 'b', 'a'}, True),
+    ([{'x': None}, 1.5, b'ab'], [{'x': None}, 1.5, b'ab'], True),
+    ('абв', 'абв', True),
+    ([1, 2], (1, 2), False),
+    ({1, 2}, [1, 2], False),
+    (1, True, False),
+    (0, 0.0, False),
+    ('1', 1, False),
+    (['a', 'bc'], ['ab', 'c'], False),
+    ({'a': 'b'}, {'b': 'a'}, False),
+    (CD(), CD(), True),
+])
+def test_structural_digest(first, second, must_equal):
+    assert 16 == len(structural_digest(first))
+    assert must_equal == (structural_digest(first) == structural_digest(second))
@@ -10,10 +10,11 @@ import logging
 
 from .version import version_info, __version__
 
-from .policy import Policy, PolicyDeny, PolicyAllow
+from .policy import Policy, PolicyDeny, PolicyAllow, FrozenPolicy
 
 from .guard import (
     Inquiry,
+    FrozenInquiry,
     Guard,
 )
 
@@ -33,6 +34,8 @@ from . import rules
 
 from .storage.memory import MemoryStorage
 
+from .compiled import CompiledGuard
+
 from .cache import (
     EnfoldCache,
     create_cached_guard
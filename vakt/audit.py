@@ -53,3 +53,16 @@ class PoliciesCountMsg(PoliciesUidMsg):
     """
     def __str__(self):
         return 'count = %d' % len(self.policies)
+
+
+class InquiriesMsg:
+    """
+    Class for converting Inquiries collection into a string during logging.
+    Is used for audit records that are logged for a batch of inquiries.
+    Example message: [<Inquiry 1 representation>, <Inquiry 2 representation>]
+    """
+    def __init__(self, inquiries=()):
+        self.inquiries = inquiries
+
+    def __str__(self):
+        return '[%s]' % ', '.join(map(str, self.inquiries))
@@ -3,25 +3,42 @@ Caching mechanisms for vakt
 """
 
 import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
 from functools import lru_cache
 from abc import ABCMeta, abstractmethod
 
 from .storage.observable import ObservableMutationStorage
-from .util import Observer
-from .guard import Guard
+from .util import Observer, structural_digest
+from .guard import Guard, Inquiry, FrozenInquiry
+from .effects import ALLOW_ACCESS
 
 
 __all__ = [
     'create_cached_guard',
     'EnfoldCache',
     'AllowanceCacheBackend',
+    'SelectiveAllowanceCache',
+    'LRUCache',
+    'TTLLRUCache',
+    'LFUCache',
+    'ARCCache',
+    'SharedMemoryCache',
 ]
 
 
 log = logging.getLogger(__name__)
 
 
-def create_cached_guard(storage, checker, cache=None, **kwargs):
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def create_cached_guard(storage, checker, cache=None, selective=False, **kwargs):
     """
     Creates Guard whose `is_allowed` method calls are cached.
     It helps to increase performance for similar Inquiries in case you have static Policies set.
@@ -34,6 +51,8 @@ def create_cached_guard(storage, checker, cache=None, **kwargs):
             It also accepts optional keyword arguments that will be passed to a cache.
             Currently only `maxsize` is available.
     maxsize - argument allows you to specify a maximum size of a default in-memory LRU cache, (preferably a power of 2)
+    selective - if True, SelectiveAllowanceCache is used that invalidates only the answers a policy-set
+                modification could affect. `cache` argument is not used in this case.
 
     :return (storage, guard, cache)
     guard - Guard whose `is_allowed` method will be cached
@@ -43,7 +62,10 @@ def create_cached_guard(storage, checker, cache=None, **kwargs):
     """
     st = ObservableMutationStorage(storage)
     guard = Guard(st, checker)
-    cache = AllowanceCache(guard, cache_backend=cache, **kwargs)
+    if selective:
+        cache = SelectiveAllowanceCache(guard, **kwargs)
+    else:
+        cache = AllowanceCache(guard, cache_backend=cache, **kwargs)
     st.add_listener(cache)
     return guard, st, cache
 
@@ -73,7 +95,12 @@ class EnfoldCache:
             self.populate()
 
     def populate(self):
+        # storage may return a policy more than once (e.g. Redis HSCAN), the first one is kept
+        seen = set()
         for p in self.storage.retrieve_all(self.populate_step_size):
+            if p.uid in seen:
+                continue
+            seen.add(p.uid)
             self.cache.add(p)
 
     def add(self, policy):
@@ -107,6 +134,19 @@ class EnfoldCache:
             return result
         return self.storage.get_all(limit, offset)
 
+    def get_after(self, last_uid, limit):
+        """
+        Backend storage `get_after`
+        """
+        return self.storage.get_after(last_uid, limit)
+
+    @property
+    def supports_get_after(self):
+        """
+        Backend storage `supports_get_after`
+        """
+        return self.storage.supports_get_after
+
     def retrieve_all(self, *args, **kwargs):
         """
         Cache storage `retrieve_all`
@@ -126,6 +166,14 @@ class EnfoldCache:
         log.warning('%s cache miss for find_for_inquiry. Trying it from backend storage', type(self).__name__)
         return self.storage.find_for_inquiry(inquiry, checker)
 
+    def inquiry_filter_key(self, inquiry, checker=None):
+        """
+        Cache storage `inquiry_filter_key`
+        """
+        # backend storage is asked if cache has no policies, so both keys are taken into account
+        return (self.cache.inquiry_filter_key(inquiry, checker),
+                self.storage.inquiry_filter_key(inquiry, checker))
+
     def update(self, policy):
         """
         Cache storage `update`
@@ -142,6 +190,32 @@ class EnfoldCache:
         self.cache.delete(uid)
         return res
 
+    def add_many(self, policies):
+        """
+        Cache storage `add_many`. Only policies that were added to backend storage are added to cache.
+        """
+        policies = list(policies)
+        res = self.storage.add_many(policies)
+        self.cache.add_many(res.filter_succeeded(policies))
+        return res
+
+    def update_many(self, policies):
+        """
+        Cache storage `update_many`. Only policies that were updated in backend storage are updated in cache.
+        """
+        policies = list(policies)
+        res = self.storage.update_many(policies)
+        self.cache.update_many(res.filter_succeeded(policies))
+        return res
+
+    def delete_many(self, uids):
+        """
+        Cache storage `delete_many`. Only policies that were deleted from backend storage are deleted from cache.
+        """
+        res = self.storage.delete_many(uids)
+        self.cache.delete_many(res.succeeded)
+        return res
+
 
 class AllowanceCache(Observer):
     """
@@ -160,9 +234,11 @@ class AllowanceCache(Observer):
         self.options = kwargs
         if cache_backend is None:
             self.cache = LRUCache(maxsize=self.options['maxsize'])
+        else:
+            self.cache = cache_backend
         guard.is_allowed_check = self.cache.wrap(guard.is_allowed_check)
 
-    def update(self):
+    def update(self, event=None):
         """
         Is a callback for fire events on Storage modify actions.
         We need to invalidate cache since policy set is changed with each add/delete/update storage action,
@@ -177,6 +253,131 @@ class AllowanceCache(Observer):
         return self.cache.info()
 
 
+class SelectiveAllowanceCache(Observer):
+    """
+    Caches answers of `is_allowed_check` for a given Inquiry together with UIDs of policies that were candidates
+    or deciders for it. Answer depends only on these policies, so on a policy-set modification (PolicyMutation event)
+    only the answers that the modified policy could affect are invalidated: the ones it was a candidate for
+    before the modification and the ones it fits after the modification.
+    Notification without an event invalidates all the cached answers.
+    Answers for inquiries that failed to be checked are not cached.
+
+    maxsize - maximum number of cached answers, the least recently used ones are evicted first.
+              If it's None the cache can grow without bound.
+    """
+    def __init__(self, guard, maxsize=1024):
+        self.guard = guard
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_policy = {}
+        self._version = 0
+        self._lock = threading.Lock()
+        guard.is_allowed_check = self.wrap(guard.check_inquiry)
+
+    def wrap(self, check_inquiry):
+        """
+        Wrap Guard's `check_inquiry` into a cached version of `is_allowed_check`
+        """
+        def is_allowed_check(inquiry):
+            with self._lock:
+                entry = self._entries.get(inquiry)
+                if entry is not None:
+                    self._entries.move_to_end(inquiry)
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+                version = self._version
+            decision = check_inquiry(inquiry)
+            if decision is None:
+                return False
+            answer = decision.effect == ALLOW_ACCESS
+            uids = set(p.uid for p in decision.candidates).union(p.uid for p in decision.deciders)
+            with self._lock:
+                # policy-set might have been changed while we were checking the inquiry
+                if version == self._version:
+                    self._put(inquiry, answer, uids)
+            return answer
+        return is_allowed_check
+
+    def update(self, event=None):
+        """
+        Is a callback for fire events on Storage modify actions.
+        Invalidates answers the modified policies could affect, or all of them if there is no event.
+        Event is a PolicyMutation or a list of them for a bulk modification.
+
+        Cached inquiries are matched against the modified policies outside the lock, so that cache readers
+        aren't held off, and each of them is matched once per event regardless of the number of policies.
+        """
+        with self._lock:
+            self._version += 1
+            if event is None:
+                self._entries.clear()
+                self._by_policy.clear()
+                return
+            mutations = event if isinstance(event, list) else [event]
+            for mutation in mutations:
+                stale = set(self._by_policy.get(mutation.uid, ()))
+                for policy in (mutation.old, mutation.new):
+                    if policy is not None:
+                        stale.update(self._by_policy.get(policy.uid, ()))
+                for inquiry in stale:
+                    self._remove(inquiry)
+            policies = [mutation.new for mutation in mutations if mutation.new is not None]
+            if not policies:
+                return
+            entries = list(self._entries.items())
+        # answers that are cached from now on were checked against the modified policy-set,
+        # so only the copied entries may be stale
+        stale = [(inquiry, entry) for inquiry, entry in entries
+                 if any(self._fits(policy, inquiry) for policy in policies)]
+        with self._lock:
+            for inquiry, entry in stale:
+                # entry could have been replaced by a fresh one while we were matching
+                if self._entries.get(inquiry) is entry:
+                    self._remove(inquiry)
+
+    def invalidate(self):
+        """
+        Invalidate all the cached answers
+        """
+        self.update()
+
+    def info(self):
+        """
+        Get information about current cache.
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def _fits(self, policy, inquiry):
+        try:
+            return self.guard.fits(policy, inquiry)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # we can't tell whether the answer is affected, so it's safer to treat it as affected
+            log.exception('Error matching Policy with UID=%s for cache invalidation', policy.uid)
+            return True
+
+    def _put(self, inquiry, answer, uids):
+        self._remove(inquiry)
+        self._entries[inquiry] = (answer, uids)
+        for uid in uids:
+            self._by_policy.setdefault(uid, set()).add(inquiry)
+        while self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, inquiry):
+        entry = self._entries.pop(inquiry, None)
+        if entry is None:
+            return
+        for uid in entry[1]:
+            inquiries = self._by_policy.get(uid)
+            if inquiries is not None:
+                inquiries.discard(inquiry)
+                if not inquiries:
+                    del self._by_policy[uid]
+
+
 class AllowanceCacheBackend(metaclass=ABCMeta):
     """
     Interface for backed cache implementations for AllowanceCache.
@@ -227,3 +428,411 @@ class LRUCache(AllowanceCacheBackend):
 
     def info(self):
         return self._wrapped_func.cache_info()
+
+
+class EvictingCache(AllowanceCacheBackend):
+    """
+    Base for thread-safe in-memory cache backends with time-to-live of entries and pluggable eviction.
+    Subclasses decide which entry is evicted when the cache is full.
+
+    maxsize - maximum number of entries the cache can contain
+    ttl - number of seconds an entry is valid for. If it's None, entries never expire
+    timer - function that returns current time in seconds
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        if maxsize <= 0:
+            raise ValueError('maxsize must be a positive number')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            key = _cache_key(args, kwargs)
+            with self._lock:
+                entry = self._get(key)
+                if entry is not _MISSING and entry[1] is not None and entry[1] <= self.timer():
+                    self._pop(key)
+                    entry = _MISSING
+                if entry is not _MISSING:
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+                version = self._version
+            value = func(*args, **kwargs)
+            expires = None if self.ttl is None else self.timer() + self.ttl
+            with self._lock:
+                # cache might have been invalidated while we were computing the value
+                if version == self._version:
+                    self._set(key, (value, expires))
+            return value
+        return wrapper
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._reset()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, self._size())
+
+    @abstractmethod
+    def _get(self, key):
+        """
+        Get entry for key registering the access to it. Returns _MISSING if there is no such entry
+        """
+        pass
+
+    @abstractmethod
+    def _set(self, key, entry):
+        """
+        Put entry for key evicting other entries if the cache is full
+        """
+        pass
+
+    @abstractmethod
+    def _pop(self, key):
+        """
+        Remove entry for key
+        """
+        pass
+
+    @abstractmethod
+    def _reset(self):
+        """
+        Remove all the entries
+        """
+        pass
+
+    @abstractmethod
+    def _size(self):
+        """
+        Get number of entries
+        """
+        pass
+
+
+class TTLLRUCache(EvictingCache):
+    """
+    In-memory cache that evicts the least recently used entry and whose entries expire after `ttl` seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        super().__init__(maxsize, ttl, timer)
+        self._entries = OrderedDict()
+
+    def _get(self, key):
+        entry = self._entries.get(key, _MISSING)
+        if entry is not _MISSING:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _set(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _pop(self, key):
+        self._entries.pop(key, None)
+
+    def _reset(self):
+        self._entries.clear()
+
+    def _size(self):
+        return len(self._entries)
+
+
+class LFUCache(EvictingCache):
+    """
+    In-memory cache that evicts the least frequently used entry (the least recently used one among equally used)
+    and whose entries expire after `ttl` seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        super().__init__(maxsize, ttl, timer)
+        self._entries = {}
+        # usage count -> keys used that many times in order of their last use
+        self._by_count = {}
+        self._min_count = 0
+
+    def _get(self, key):
+        item = self._entries.get(key)
+        if item is None:
+            return _MISSING
+        self._touch(key, item)
+        return item[0]
+
+    def _set(self, key, entry):
+        item = self._entries.get(key)
+        if item is not None:
+            item[0] = entry
+            self._touch(key, item)
+            return
+        if len(self._entries) >= self.maxsize:
+            evicted, _ = self._by_count[self._min_count].popitem(last=False)
+            if not self._by_count[self._min_count]:
+                del self._by_count[self._min_count]
+            del self._entries[evicted]
+        self._entries[key] = [entry, 1]
+        self._by_count.setdefault(1, OrderedDict())[key] = None
+        self._min_count = 1
+
+    def _pop(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        keys = self._by_count[item[1]]
+        del keys[key]
+        if not keys:
+            del self._by_count[item[1]]
+            if self._min_count == item[1]:
+                self._min_count = min(self._by_count, default=0)
+
+    def _reset(self):
+        self._entries.clear()
+        self._by_count.clear()
+        self._min_count = 0
+
+    def _size(self):
+        return len(self._entries)
+
+    def _touch(self, key, item):
+        count = item[1]
+        keys = self._by_count[count]
+        del keys[key]
+        if not keys:
+            del self._by_count[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        item[1] = count + 1
+        self._by_count.setdefault(count + 1, OrderedDict())[key] = None
+
+
+class ARCCache(EvictingCache):
+    """
+    In-memory Adaptive Replacement Cache whose entries expire after `ttl` seconds.
+    It balances between recently used entries (seen once) and frequently used entries (seen at least twice)
+    remembering keys of recently evicted entries in order to adapt to the workload.
+    Is resistant to scans of inquiries that are seen only once.
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        super().__init__(maxsize, ttl, timer)
+        # entries seen once and at least twice
+        self._recent, self._frequent = OrderedDict(), OrderedDict()
+        # keys of entries evicted from the above
+        self._recent_ghosts, self._frequent_ghosts = OrderedDict(), OrderedDict()
+        # target size of recent entries
+        self._target = 0
+
+    def _get(self, key):
+        entry = self._recent.pop(key, _MISSING)
+        if entry is _MISSING:
+            entry = self._frequent.get(key, _MISSING)
+            if entry is not _MISSING:
+                self._frequent.move_to_end(key)
+            return entry
+        self._frequent[key] = entry
+        return entry
+
+    def _set(self, key, entry):
+        size = self.maxsize
+        if key in self._recent or key in self._frequent:
+            self._recent.pop(key, None)
+            self._frequent[key] = entry
+            self._frequent.move_to_end(key)
+        elif key in self._recent_ghosts:
+            ratio = max(len(self._frequent_ghosts) // len(self._recent_ghosts), 1)
+            self._target = min(size, self._target + ratio)
+            self._replace(False)
+            del self._recent_ghosts[key]
+            self._frequent[key] = entry
+        elif key in self._frequent_ghosts:
+            ratio = max(len(self._recent_ghosts) // len(self._frequent_ghosts), 1)
+            self._target = max(0, self._target - ratio)
+            self._replace(True)
+            del self._frequent_ghosts[key]
+            self._frequent[key] = entry
+        else:
+            recent_total = len(self._recent) + len(self._recent_ghosts)
+            total = recent_total + len(self._frequent) + len(self._frequent_ghosts)
+            if recent_total >= size:
+                if len(self._recent) < size:
+                    self._recent_ghosts.popitem(last=False)
+                    self._replace(False)
+                else:
+                    self._recent.popitem(last=False)
+            elif total >= size:
+                if total >= 2 * size:
+                    self._frequent_ghosts.popitem(last=False)
+                self._replace(False)
+            self._recent[key] = entry
+
+    def _replace(self, in_frequent_ghosts):
+        """
+        Evict an entry either from recent or from frequent ones depending on the target size of recent entries
+        """
+        if len(self._recent) + len(self._frequent) < self.maxsize:
+            return
+        recent = len(self._recent)
+        if recent and (recent > self._target or (in_frequent_ghosts and recent == self._target)):
+            key, _ = self._recent.popitem(last=False)
+            self._recent_ghosts[key] = None
+        elif self._frequent:
+            key, _ = self._frequent.popitem(last=False)
+            self._frequent_ghosts[key] = None
+        else:
+            key, _ = self._recent.popitem(last=False)
+            self._recent_ghosts[key] = None
+
+    def _pop(self, key):
+        self._recent.pop(key, None)
+        self._frequent.pop(key, None)
+
+    def _reset(self):
+        self._recent.clear()
+        self._frequent.clear()
+        self._recent_ghosts.clear()
+        self._frequent_ghosts.clear()
+        self._target = 0
+
+    def _size(self):
+        return len(self._recent) + len(self._frequent)
+
+
+class SharedMemoryCache(AllowanceCacheBackend):
+    """
+    Cache of boolean answers shared by processes on the same machine (e.g. workers of a web-server).
+    It's a fixed-size hash table in a memory-mapped file: processes that use the same `path` share cached answers
+    and invalidation of the cache by one of them is seen by all the others.
+
+    Answers are keyed by the inquiry's `cache_key`. Each answer is stored with the generation
+    of the cache it was computed at, invalidation just increments the generation, so old answers become misses.
+    Reads and writes are lock-free: every slot has a checksum and a torn slot is treated as a miss.
+    When all the slots an answer can be put to are occupied, one of them is overwritten.
+    Non-boolean results are not cached.
+
+    path - path of a file to map, preferably on an in-memory file-system, e.g. /dev/shm/vakt-cache
+    capacity - number of slots in the table. All the processes must use the same capacity for the same path
+    """
+    MAGIC = b'VAKTSMC1'
+    HEADER = struct.Struct('<8sQQ')
+    GENERATION = struct.Struct('<Q')
+    SLOT = struct.Struct('<16sQ?3xI')
+    PROBES = 4
+
+    def __init__(self, path, capacity=65536):
+        if capacity <= 0:
+            raise ValueError('capacity must be a positive number')
+        self.path = path
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        size = self.HEADER.size + capacity * self.SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, _, stored_capacity = self.HEADER.unpack_from(self._mm, 0)
+        if magic == self.MAGIC and stored_capacity != capacity:
+            self.close()
+            raise ValueError('Cache at %s has capacity %d, not %d' % (path, stored_capacity, capacity))
+        if magic != self.MAGIC:
+            self.HEADER.pack_into(self._mm, 0, self.MAGIC, 0, capacity)
+
+    def wrap(self, func):
+        def wrapper(inquiry):
+            digest = _inquiry_digest(inquiry)
+            generation = self._generation()
+            found = self._get(digest, generation)
+            if found is not None:
+                self.hits += 1
+                return found
+            self.misses += 1
+            answer = func(inquiry)
+            # answer is stored with the generation it was computed at, so it's stale if cache was invalidated meanwhile
+            if isinstance(answer, bool):
+                self._put(digest, generation, answer)
+            return answer
+        return wrapper
+
+    def invalidate(self):
+        self.GENERATION.pack_into(self._mm, 8, self._generation() + 1)
+
+    def info(self):
+        generation = self._generation()
+        size = sum(1 for i in range(self.capacity) if self._read(i, generation) is not None)
+        return CacheInfo(self.hits, self.misses, self.capacity, size)
+
+    def close(self):
+        """
+        Unmap the cache file. The file itself is left in place for other processes.
+        """
+        self._mm.close()
+
+    def _generation(self):
+        return self.GENERATION.unpack_from(self._mm, 8)[0]
+
+    def _slots(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.capacity
+        for i in range(min(self.PROBES, self.capacity)):
+            yield (start + i) % self.capacity
+
+    def _read(self, slot, generation):
+        """
+        Get (digest, answer) from a slot if it's valid for the generation, None otherwise
+        """
+        offset = self.HEADER.size + slot * self.SLOT.size
+        digest, slot_generation, answer, checksum = self.SLOT.unpack_from(self._mm, offset)
+        if slot_generation != generation or checksum != _slot_checksum(digest, slot_generation, answer):
+            return None
+        return digest, answer
+
+    def _get(self, digest, generation):
+        for slot in self._slots(digest):
+            found = self._read(slot, generation)
+            if found is not None and found[0] == digest:
+                return found[1]
+        return None
+
+    def _put(self, digest, generation, answer):
+        target = None
+        for slot in self._slots(digest):
+            found = self._read(slot, generation)
+            if found is None or found[0] == digest:
+                target = slot
+                break
+        if target is None:
+            target = next(self._slots(digest))
+        offset = self.HEADER.size + target * self.SLOT.size
+        self.SLOT.pack_into(self._mm, offset, digest, generation, answer, _slot_checksum(digest, generation, answer))
+
+
+def _cache_key(args, kwargs):
+    """
+    Get key of a cached function call. Calls with a single Inquiry are keyed by its canonical key
+    """
+    if len(args) == 1 and not kwargs and isinstance(args[0], (Inquiry, FrozenInquiry)):
+        return args[0].cache_key
+    return (args, frozenset(kwargs.items())) if kwargs else args
+
+
+def _inquiry_digest(inquiry):
+    """
+    Get a digest of inquiry that is the same across processes
+    """
+    if isinstance(inquiry, (Inquiry, FrozenInquiry)):
+        return inquiry.cache_key
+    return structural_digest(inquiry)
+
+
+def _slot_checksum(digest, generation, answer):
+    return zlib.crc32(digest + SharedMemoryCache.GENERATION.pack(generation) + (b'\x01' if answer else b'\x00'))
+
+
+_MISSING = object()
@@ -9,6 +9,7 @@ from abc import ABCMeta, abstractmethod
 
 from .parser import compile_regex
 from .exceptions import InvalidPatternError
+from .rules.compiler import compile_definition
 
 
 log = logging.getLogger(__name__)
@@ -42,7 +43,7 @@ class RegexChecker(Checker):
         where = getattr(policy, field, [])
         for i in where:
             # We are not meant to handle non-string values if they accidentally got here
-            if type(i) != str:
+            if not isinstance(i, str):
                 continue
             # check if 'where' item is not written in a policy-defined-regex syntax.
             if policy.start_tag not in i and policy.end_tag not in i:
@@ -71,7 +72,7 @@ class StringChecker(Checker):
         where = getattr(policy, field, [])
         for item in where:
             # We are not meant to handle non-string values if they accidentally got here
-            if type(item) != str:
+            if not isinstance(item, str):
                 continue
             if policy.start_tag == item[0] and policy.end_tag == item[-1]:
                 item = item[1:-1]
@@ -112,15 +113,32 @@ class RulesChecker(Checker):
     """
     Checker that uses Rules defined inside dictionaries to determine match.
     """
+
+    def __init__(self, compiled=False, cache_size=100000):
+        """
+        If `compiled` is True, policies' Rules are compiled into closures (see `vakt.rules.compiler`).
+        Compiled closures are cached by policy field values (up to `cache_size` of them), so it's beneficial
+        for storages that keep policy objects in memory (e.g. MemoryStorage).
+        A policy field should be reassigned (not modified in-place) to be recompiled.
+        """
+        self.compiled = compiled
+        self.cache_size = cache_size
+        self._compiled_fields = {}
+
     def fits(self, policy, field, what, inquiry=None):
         """Does Policy fit the given 'what' value by its 'field' property"""
         where_list = getattr(policy, field, [])
+        if self.compiled:
+            cached = self._compiled_fields.get(id(where_list))
+            if cached is None or cached[0] is not where_list:
+                cached = self._compile(where_list)
+            return cached[1](what, inquiry)
         is_what_dict = isinstance(what, dict)
         for i in where_list:
             item_result = False
             # If not dict or Rule, skip it - we are not meant to handle it.
             # Do not use isinstance for higher execution speed
-            if type(i) == dict:
+            if isinstance(i, dict):
                 for key, rule in i.items():
                     if not is_what_dict:
                         log.debug('Error matching Policy: data %r in Inquiry is not `dict`', what)
@@ -142,6 +160,16 @@ class RulesChecker(Checker):
                 return True
         return False
 
+    def _compile(self, where_list):
+        """
+        Compile policy field value and cache it.
+        The value itself is kept in cache as well, so that its id can't be reused by another object.
+        """
+        if len(self._compiled_fields) >= self.cache_size:
+            self._compiled_fields.clear()
+        cached = self._compiled_fields[id(where_list)] = (where_list, compile_definition(where_list))
+        return cached
+
     @staticmethod
     def _check_satisfied(rule, what_value, inquiry=None):
         try:
@@ -0,0 +1,180 @@
+"""
+JSON codec for Policies, Rules and Inquiries.
+
+Produces and understands the same JSON as jsonpickle does for vakt's objects, but encodes and decodes
+vakt's own Rules (and the values they hold) directly via a registry of their classes instead of jsonpickle's
+reflection. Anything the codec doesn't know (custom Rules, arbitrary objects, jsonpickle references, etc.)
+makes the whole document go through jsonpickle, so the result is always the same as with jsonpickle.
+"""
+
+import re
+import json
+
+import jsonpickle
+import jsonpickle.pickler
+import jsonpickle.unpickler
+
+
+__all__ = [
+    'encode',
+    'decode',
+    'flatten',
+    'restore',
+    'register_rule',
+    'register_rules',
+]
+
+
+# class path -> class of Rules that are encoded and decoded by the codec
+_RULES = {}
+# classes of _RULES -> their class path
+_RULE_NAMES = {}
+
+_PATTERN_NAME = 're.Pattern'
+_PATTERN_TYPE = type(re.compile(''))
+
+
+class _Unsupported(Exception):
+    """
+    Value can't be handled by the codec and should be handled by jsonpickle
+    """
+    pass
+
+
+def register_rule(cls):
+    """
+    Register Rule class to be encoded and decoded by the codec.
+    Rule's state should consist of its instance attributes only (no custom `__getstate__`, `__setstate__`, etc.).
+    Returns the class, so it can be used as a class decorator.
+    """
+    name = '%s.%s' % (cls.__module__, cls.__qualname__)
+    _RULES[name] = cls
+    _RULE_NAMES[cls] = name
+    return cls
+
+
+def register_rules(base, *modules):
+    """
+    Register all the Rules (subclasses of `base`) defined in the given modules.
+    Rules with custom state handling (`__getstate__`, `__reduce__`, etc.) are skipped and left to jsonpickle.
+    Is used by `vakt.rules` for vakt's own Rules.
+    """
+    for module in modules:
+        for value in vars(module).values():
+            if not isinstance(value, type) or not issubclass(value, base) or value.__module__ != module.__name__:
+                continue
+            if any(getattr(value, attr, None) is not getattr(object, attr, None)
+                   for attr in ('__setstate__', '__getstate__', '__reduce__', '__reduce_ex__', '__getnewargs__')):
+                continue
+            register_rule(value)
+
+
+def encode(value, sort=False):
+    """
+    Encode value to a JSON string
+    """
+    try:
+        return json.dumps(_flatten(value, set()), sort_keys=sort)
+    except _Unsupported:
+        # jsonpickle numbers references in the order of sorted keys, so it should know about sorting
+        jsonpickle.set_encoder_options('json', sort_keys=sort)
+        return jsonpickle.encode(value)
+
+
+def decode(data):
+    """
+    Decode value from a JSON string
+    """
+    return restore(json.loads(data))
+
+
+def flatten(value):
+    """
+    Convert value to JSON-compatible data (dictionaries, lists, strings, numbers, etc.)
+    """
+    try:
+        return _flatten(value, set())
+    except _Unsupported:
+        return jsonpickle.pickler.Pickler().flatten(value)
+
+
+def restore(data):
+    """
+    Convert JSON-compatible data back to a value
+    """
+    try:
+        return _restore(data)
+    except _Unsupported:
+        return jsonpickle.unpickler.Unpickler().restore(data)
+
+
+def _flatten(value, seen):
+    value_type = type(value)
+    if value_type in (str, int, float, bool) or value is None:
+        return value
+    if value_type is tuple:
+        return {'py/tuple': [_flatten(v, seen) for v in value]}
+    if value_type is set:
+        return {'py/set': [_flatten(v, seen) for v in value]}
+    # jsonpickle emits references for objects met more than once, the codec leaves them to it
+    if id(value) in seen:
+        raise _Unsupported()
+    seen.add(id(value))
+    if value_type is list:
+        return [_flatten(v, seen) for v in value]
+    if value_type is dict:
+        return _flatten_items({}, value, seen)
+    name = _RULE_NAMES.get(value_type)
+    if name is not None:
+        return _flatten_items({'py/object': name}, vars(value), seen)
+    if value_type is _PATTERN_TYPE:
+        return {'py/object': _PATTERN_NAME, 'pattern': value.pattern}
+    raise _Unsupported()
+
+
+def _flatten_items(result, items, seen):
+    for k, v in items.items():
+        if not isinstance(k, str) or k.startswith('py/'):
+            raise _Unsupported()
+        result[k] = _flatten(v, seen)
+    return result
+
+
+def _restore(data):
+    data_type = type(data)
+    if data_type is dict:
+        if not data:
+            return {}
+        name = data.get('py/object')
+        if name is not None:
+            return _restore_object(name, data)
+        if 'py/tuple' in data and len(data) == 1:
+            return tuple(_restore(v) for v in data['py/tuple'])
+        if 'py/set' in data and len(data) == 1:
+            return set(_restore(v) for v in data['py/set'])
+        result = {}
+        for k, v in data.items():
+            if k.startswith('py/'):
+                raise _Unsupported()
+            result[k] = _restore(v)
+        return result
+    if data_type is list:
+        return [_restore(v) for v in data]
+    return data
+
+
+def _restore_object(name, data):
+    if name == _PATTERN_NAME and len(data) == 2 and isinstance(data.get('pattern'), str):
+        return re.compile(data['pattern'])
+    cls = _RULES.get(name) if isinstance(name, str) else None
+    if cls is None:
+        raise _Unsupported()
+    obj = cls.__new__(cls)
+    state = obj.__dict__
+    for k, v in data.items():
+        if k == 'py/object':
+            continue
+        if k.startswith('py/'):
+            raise _Unsupported()
+        state[k] = _restore(v)
+    return obj
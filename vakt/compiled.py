@@ -0,0 +1,458 @@
+"""
+Guard that makes decisions using a pre-built (compiled) structure of the whole policy-set.
+"""
+
+import re
+import logging
+import threading
+
+from .guard import Guard, Decision
+from .checker import RegexChecker, StringExactChecker, StringFuzzyChecker, RulesChecker
+from .effects import ALLOW_ACCESS, DENY_ACCESS
+from .exceptions import InvalidPatternError
+from .rules.compiler import compile_definition, compile_context
+from .rules.net import CIDR, ip_network, ip_address
+from .storage.index import PolicyIndex
+from .storage.observable import ObservableMutationStorage, PolicyMutation
+from .storage.table import PolicyTable, _read_consistent
+from .util import Observer
+
+
+__all__ = [
+    'CompiledGuard',
+    'CompiledPolicySet',
+    'CIDRTree',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class CompiledPolicy:
+    """
+    Policy with precomputed matchers for each of its definition fields and context.
+    """
+    def __init__(self, policy, checker):
+        self.policy = policy
+        self.deny = not policy.allow_access()
+        self.actions = _compile_field(checker, policy, 'actions')
+        self.subjects = _compile_field(checker, policy, 'subjects')
+        self.resources = _compile_field(checker, policy, 'resources')
+        # CIDR context rules are not checked one by one, they are looked up in the policy-set's CIDRTree
+        self.networks = {}
+        context = {}
+        for key, rule in policy.context.items():
+            network = _cidr_network(rule)
+            if network is None:
+                context[key] = rule
+            else:
+                self.networks[key] = network
+        self.context = compile_context(context)
+
+    def fits(self, inquiry, networks_matched):
+        """
+        Does policy fit the given inquiry?
+        `networks_matched` is a function: f(context key) -> set of UIDs of policies whose CIDR rule
+        for this key holds for the inquiry.
+        """
+        return (self.actions(inquiry.action, inquiry) and
+                self.subjects(inquiry.subject, inquiry) and
+                self.resources(inquiry.resource, inquiry) and
+                self._networks_fit(inquiry, networks_matched) and
+                self.context(inquiry))
+
+    def _networks_fit(self, inquiry, networks_matched):
+        for key in self.networks:
+            if key not in inquiry.context:
+                log.debug("No key '%s' found in Inquiry context", key)
+                return False
+            if self.policy.uid not in networks_matched(key):
+                return False
+        return True
+
+
+class CompiledPolicySet:
+    """
+    Pre-built decision structure for a policy-set and a checker.
+
+    For vakt's checkers policies are indexed by a PolicyIndex (the same MemoryStorage uses), so that only policies
+    that might fit an inquiry are examined. Other checkers (including subclasses of vakt's checkers) examine
+    all the policies. CIDR context rules of all the policies are put into a CIDRTree per context key,
+    so that an inquiry IP address is looked up once to find all the policies whose network restriction holds.
+
+    Policy-set is modified in place by `apply`, only the modified policies are compiled.
+    Decisions are made without a lock concurrently with modifications: a decision is made anew
+    if a modification overlapped it and is made under the lock after `read_attempts` unsuccessful attempts.
+    """
+
+    read_attempts = 3
+
+    def __init__(self, policies, checker):
+        self.checker = checker
+        self.policies = PolicyTable()
+        self.index = PolicyIndex() if PolicyIndex.kind(checker) else None
+        self.networks = {}
+        self.lock = threading.Lock()
+        # odd while the policy-set is being modified
+        self.version = 0
+        for policy in policies:
+            # storage may return a policy more than once (e.g. Redis HSCAN), the first one is kept
+            if policy.uid in self.policies:
+                continue
+            self._put(*self._prepare(policy))
+
+    def apply(self, mutations):
+        """
+        Apply PolicyMutation events (see `vakt.storage.observable`) to the policy-set.
+        Applying an event to a policy-set that already reflects it changes nothing.
+        """
+        for mutation in mutations:
+            if mutation.action == PolicyMutation.DELETE:
+                self._modify(self._remove, mutation.uid)
+            elif mutation.action == PolicyMutation.ADD or mutation.uid in self.policies or mutation.old is not None:
+                # update of a policy that storage didn't have doesn't add it
+                self._modify(self._put, *self._prepare(mutation.new))
+
+    def _prepare(self, policy):
+        """
+        Compile a policy and get its index data. Is done outside the lock.
+        """
+        index_data = None if self.index is None else self.index.index_data(policy)
+        return CompiledPolicy(policy, self.checker), index_data
+
+    def _modify(self, method, *args):
+        with self.lock:
+            self.version += 1
+            try:
+                method(*args)
+            finally:
+                self.version += 1
+
+    def _put(self, compiled, index_data):
+        """
+        Add a compiled policy or replace the one with the same UID keeping its position.
+        """
+        uid = compiled.policy.uid
+        self._remove_networks(self.policies.get(uid))
+        self.policies[uid] = compiled
+        if self.index is not None:
+            self.index.add_data(uid, *index_data)
+        for key, network in compiled.networks.items():
+            self.networks.setdefault(key, CIDRTree()).add(network, uid)
+
+    def _remove(self, uid):
+        compiled = self.policies.get(uid)
+        if compiled is None:
+            return
+        self._remove_networks(compiled)
+        del self.policies[uid]
+        if self.index is not None:
+            self.index.remove(uid, forget=True)
+
+    def _remove_networks(self, compiled):
+        if compiled is None:
+            return
+        for key, network in compiled.networks.items():
+            self.networks[key].remove(network, compiled.policy.uid)
+
+    def candidates(self, inquiry):
+        """
+        Get compiled policies that might fit the given inquiry.
+        """
+        if self.index is not None:
+            uids = self.index.find(inquiry, self.checker)
+            if uids is not None:
+                policies = self.policies
+                return [policies[uid] for uid in uids]
+        return self.policies.values()
+
+    def decide(self, inquiry, deny_first=False):
+        """
+        Make a decision for a specified inquiry.
+        If `deny_first` is True, candidates with deny effect are checked first and the first matching one decides.
+
+        Returns Decision
+        """
+        return _read_consistent(self, self._decide, inquiry, deny_first)
+
+    def _decide(self, inquiry, deny_first):
+        if deny_first:
+            return self._decide_deny_first(inquiry)
+        networks_matched = self._networks_matcher(inquiry)
+        matched = [c for c in self.candidates(inquiry) if c.fits(inquiry, networks_matched)]
+        filtered = [c.policy for c in matched]
+        if len(filtered) == 0:
+            return Decision(DENY_ACCESS, 'No potential policies were found', filtered, [])
+        for c in matched:
+            if c.deny:
+                return Decision(DENY_ACCESS, 'One of matching policies has deny effect', filtered, [c.policy])
+        return Decision(ALLOW_ACCESS, 'All matching policies have allow effect', filtered, filtered)
+
+    def _decide_deny_first(self, inquiry):
+        candidates = self.candidates(inquiry)
+        networks_matched = self._networks_matcher(inquiry)
+        for c in candidates:
+            if c.deny and c.fits(inquiry, networks_matched):
+                return Decision(DENY_ACCESS, 'One of matching policies has deny effect (short-circuited)',
+                                [c.policy], [c.policy])
+        filtered = [c.policy for c in candidates if not c.deny and c.fits(inquiry, networks_matched)]
+        if len(filtered) == 0:
+            return Decision(DENY_ACCESS, 'No potential policies were found', filtered, [])
+        return Decision(ALLOW_ACCESS, 'All matching policies have allow effect', filtered, filtered)
+
+    def _networks_matcher(self, inquiry):
+        """
+        Build a function: f(context key) -> set of UIDs of policies whose CIDR rule for this key holds.
+        Each context key is looked up at most once per inquiry and only if some candidate needs it.
+        """
+        found = {}
+
+        def matched(key):
+            uids = found.get(key)
+            if uids is None:
+                uids = found[key] = self.networks[key].match(inquiry.context[key])
+            return uids
+        return matched
+
+
+class CIDRTree:
+    """
+    Binary radix tree of IP networks.
+    Finds values of all the networks an IP address belongs to in a single walk over the address bits.
+    """
+    def __init__(self):
+        # node is a list: [child for bit 0, child for bit 1, values of the network ending at this node]
+        self.roots = {4: [None, None, set()], 6: [None, None, set()]}
+
+    def add(self, network, value):
+        """Add value for the network (ipaddress.IPv4Network or ipaddress.IPv6Network)"""
+        node = self.roots[network.version]
+        bits, length = int(network.network_address), network.max_prefixlen
+        for i in range(length - 1, length - 1 - network.prefixlen, -1):
+            bit = (bits >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, set()]
+            node = node[bit]
+        node[2].add(value)
+
+    def remove(self, network, value):
+        """Remove value of the network. Nodes that are left without values and children are dropped"""
+        node = self.roots[network.version]
+        path = []
+        bits, length = int(network.network_address), network.max_prefixlen
+        for i in range(length - 1, length - 1 - network.prefixlen, -1):
+            bit = (bits >> i) & 1
+            if node[bit] is None:
+                return
+            path.append((node, bit))
+            node = node[bit]
+        node[2].discard(value)
+        for parent, bit in reversed(path):
+            child = parent[bit]
+            if child[0] is not None or child[1] is not None or child[2]:
+                break
+            parent[bit] = None
+
+    def match(self, what):
+        """
+        Get values of all the networks the IP address belongs to.
+        Values that are not strings or are not valid IP addresses belong to no network, the same as for CIDR rule.
+        """
+        if not isinstance(what, str):
+            return set()
+        try:
+            ip = ip_address(what)
+        except ValueError:
+            log.exception('Error %s satisfied', CIDR.__name__)
+            return set()
+        node = self.roots[ip.version]
+        found = set(node[2])
+        bits, length = int(ip), ip.max_prefixlen
+        for i in range(length - 1, -1, -1):
+            node = node[(bits >> i) & 1]
+            if node is None:
+                break
+            found.update(node[2])
+        return found
+
+
+class CompiledGuard(Guard, Observer):
+    """
+    Guard that turns all the policies of a storage into a pre-built decision structure (see `CompiledPolicySet`)
+    and makes decisions using it instead of asking storage for policies on each inquiry.
+    Each policy field gets a precomputed matcher, context rules are compiled (see `vakt.rules.compiler`)
+    and policies are indexed by a PolicyIndex for vakt's checkers.
+
+    The structure is built lazily on the first check or explicitly via `compile` method.
+    If storage is an ObservableMutationStorage, guard subscribes to its changes and applies them
+    to the structure compiling only the modified policies. Otherwise you need to call `compile` by yourself.
+
+    Is meant to be used with storages that hold the whole policy-set in memory, e.g. MemoryStorage
+    or EnfoldCache'd storage.
+    """
+
+    def __init__(self, storage, checker, audit_policies_cls=None, deny_first=False):
+        super().__init__(storage, checker, audit_policies_cls, deny_first)
+        self.compile_batch_size = 1000
+        self._policy_set = None
+        # compilation and modifications of the structure are serialized
+        self._lock = threading.RLock()
+        if isinstance(storage, ObservableMutationStorage):
+            storage.add_listener(self)
+
+    def compile(self):
+        """
+        Build the decision structure from all the policies in the storage.
+        """
+        with self._lock:
+            self._policy_set = CompiledPolicySet(self.storage.retrieve_all(self.compile_batch_size), self.checker)
+            return self._policy_set
+
+    def update(self, event=None):
+        """
+        Is a callback for fire events on Storage modify actions.
+        Applies PolicyMutation event (or a list of them for a bulk modification) to the decision structure,
+        so that only the modified policies are compiled.
+        If there is no event payload or it can't be applied, the structure is rebuilt on the next check.
+        """
+        with self._lock:
+            policy_set = self._policy_set
+            # structure that is not built yet will be built from the storage that already has the modification
+            if policy_set is None:
+                return
+            if event is None:
+                self._policy_set = None
+                return
+            try:
+                policy_set.apply(event if isinstance(event, list) else [event])
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception('Error applying %s to compiled policies. They will be compiled anew', event)
+                self._policy_set = None
+
+    def check_inquiry(self, inquiry):
+        try:
+            decision = self._get_policy_set().decide(inquiry, self.deny_first)
+        # any error means the Inquiry is not allowed, the same as for Guard
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
+            return None
+        self._audit(inquiry, decision)
+        return decision
+
+    def is_allowed_check_many(self, inquiries, batch_audit=False):
+        inquiries = list(inquiries)
+        decisions = [None] * len(inquiries)
+        for idx, inquiry in enumerate(inquiries):
+            try:
+                decisions[idx] = self._get_policy_set().decide(inquiry, self.deny_first)
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
+                continue
+            if not batch_audit:
+                self._audit(inquiry, decisions[idx])
+        return self._answers_for_batch(inquiries, decisions, batch_audit)
+
+    def _get_policy_set(self):
+        policy_set = self._policy_set
+        if policy_set is None:
+            with self._lock:
+                policy_set = self._policy_set
+                if policy_set is None:
+                    policy_set = self.compile()
+        return policy_set
+
+
+def _cidr_network(rule):
+    """
+    Get parsed network of a CIDR rule. Returns None for other rules (including subclasses of CIDR)
+    and for CIDR rules with invalid network: they are checked the usual way.
+    """
+    if type(rule) != CIDR:  # pylint: disable=unidiomatic-typecheck
+        return None
+    try:
+        return ip_network(rule.cidr)
+    except ValueError:
+        return None
+
+
+def _compile_field(checker, policy, field):
+    """
+    Build a matcher function for a policy field: matcher(what, inquiry) -> bool
+    Checkers that are not known (including subclasses of vakt's checkers) are asked via their `fits` method.
+    """
+    checker_type = type(checker)
+    if checker_type == RegexChecker:
+        try:
+            return _compile_regex_field(checker, policy, field)
+        except re.error:
+            # let checker deal with malformed regex on each check the same way it does for a plain Guard
+            return lambda what, inquiry: checker.fits(policy, field, what, inquiry)
+    if checker_type == StringExactChecker:
+        values, has_empty = _string_values(policy, field)
+        literals = frozenset(values)
+        return _fail_on_empty_value(lambda what, inquiry: isinstance(what, str) and what in literals, has_empty)
+    if checker_type == StringFuzzyChecker:
+        values, has_empty = _string_values(policy, field)
+        haystacks = tuple(values)
+        return _fail_on_empty_value(lambda what, inquiry: any(what in h for h in haystacks), has_empty)
+    if checker_type == RulesChecker:
+        return compile_definition(getattr(policy, field, []))
+    return lambda what, inquiry: checker.fits(policy, field, what, inquiry)
+
+
+def _compile_regex_field(checker, policy, field):
+    literals, patterns = set(), []
+    for item in getattr(policy, field, []):
+        if not isinstance(item, str):
+            continue
+        if policy.start_tag not in item and policy.end_tag not in item:
+            literals.add(item)
+            continue
+        try:
+            patterns.append(checker.compile(item, policy.start_tag, policy.end_tag))
+        except InvalidPatternError:
+            # RegexChecker stops on the first broken pattern, so the rest of the items are never checked
+            log.exception('Error matching policy, because of failed regex %s compilation', item)
+            break
+    literals, patterns = frozenset(literals), tuple(patterns)
+
+    def match(what, _inquiry):
+        if isinstance(what, str) and what in literals:
+            return True
+        for pattern in patterns:
+            if pattern.match(what):
+                return True
+        return False
+    return match
+
+
+def _string_values(policy, field):
+    """
+    Get string values of a policy field with tags stripped that go before its first empty value
+    and whether there is an empty value. Is used by string checkers.
+    """
+    values = []
+    for item in getattr(policy, field, []):
+        if not isinstance(item, str):
+            continue
+        if not item:
+            return values, True
+        if policy.start_tag == item[0] and policy.end_tag == item[-1]:
+            item = item[1:-1]
+        values.append(item)
+    return values, False
+
+
+def _fail_on_empty_value(match, has_empty):
+    """
+    String checkers fail with IndexError when they come to an empty value of a policy field,
+    so a value that doesn't match any value before it fails the same way.
+    """
+    if not has_empty:
+        return match
+
+    def match_or_fail(what, inquiry):
+        if match(what, inquiry):
+            return True
+        raise IndexError('string index out of range')
+    return match_or_fail
@@ -3,10 +3,13 @@ Main module that serves as an entry point for Vakt decisions.
 Also contains Inquiry class.
 """
 
+import asyncio
 import logging
 
-from .util import JsonSerializer, PrettyPrint
-from .audit import PoliciesUidMsg, __name__ as audit_module_name
+from types import MappingProxyType
+
+from .util import JsonSerializer, PrettyPrint, structural_digest
+from .audit import PoliciesUidMsg, InquiriesMsg, __name__ as audit_module_name
 from .effects import ALLOW_ACCESS, DENY_ACCESS
 
 log = logging.getLogger(__name__)
@@ -15,7 +18,13 @@ audit_log = logging.getLogger(audit_module_name)
 
 class Inquiry(JsonSerializer, PrettyPrint):
     """Holds all the information about the inquired intent.
-    Is responsible to decisions if the inquired intent allowed or not."""
+    Is responsible to decisions if the inquired intent allowed or not.
+
+    Inquiry is compared and hashed by its `cache_key` that is computed once, so if you change an inquiry
+    after it was compared or hashed, reassign its attribute instead of modifying its value in place."""
+
+    # _cache_key is not a part of vars(), so it's neither serialized nor printed
+    __slots__ = ('_cache_key', '__dict__', '__weakref__')
 
     def __init__(self, resource=None, action=None, subject=None, context=None):
         # explicitly assign empty strings instead of occasional None, (), etc.
@@ -35,103 +44,266 @@ class Inquiry(JsonSerializer, PrettyPrint):
         """
         return super().to_json(sort=True)
 
+    @property
+    def cache_key(self):
+        """
+        Canonical key of the inquiry: digest of its contents that is the same for inquiries with the same contents
+        (regardless of dictionaries keys order) and is stable across python processes.
+        Is computed once and memoized until some of the inquiry attributes is reassigned.
+        """
+        key = getattr(self, '_cache_key', None)
+        if key is None:
+            key = structural_digest(vars(self))
+            object.__setattr__(self, '_cache_key', key)
+        return key
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        object.__setattr__(self, '_cache_key', None)
+
     def __eq__(self, other):
         """
         If inquiries have the same contents - they are equal
         """
-        return self.to_json_sorted() == other.to_json_sorted()
+        if not isinstance(other, (Inquiry, FrozenInquiry)):
+            return NotImplemented
+        return self.cache_key == other.cache_key
 
     def __hash__(self):
         """
-        We do not use to_json as contents representation, because strings are not guaranteed
+        We do not use built-in hash of contents, because strings are not guaranteed
         to be hashed consistently across different python processes.
         """
-        return hash(tuple((ord(c) for c in self.to_json_sorted())))
+        return int.from_bytes(self.cache_key[:8], 'little')
 
 
-class Guard:
+class FrozenInquiry(JsonSerializer):
     """
-    Executor of policy checks.
-    Given a storage and a checker it can decide via `is_allowed` method if a given inquiry allowed or not.
+    Immutable compact variant of Inquiry.
+    It has no instance dictionary and its context is a read-only mapping (values of attributes are not copied).
+    Is equal to an Inquiry with the same contents and has the same JSON representation.
+    """
+    # slots are filled via object.__setattr__ since __setattr__ forbids modification,
+    # so pylint sees no assignments of them
+    # pylint: disable=no-member
+    __slots__ = ('resource', 'action', 'subject', 'context', '_cache_key')
+
+    def __init__(self, resource=None, action=None, subject=None, context=None):
+        init = object.__setattr__
+        init(self, 'resource', resource or '')
+        init(self, 'action', action or '')
+        init(self, 'subject', subject or '')
+        init(self, 'context', MappingProxyType(dict(context)) if context else MappingProxyType({}))
+        init(self, '_cache_key', None)
+
+    @classmethod
+    def from_json(cls, data):
+        props = cls._parse(data)
+        return cls(**props)
+
+    def to_json_sorted(self):
+        """
+        Get JSON representation with all keys sorted.
+        """
+        return super().to_json(sort=True)
+
+    @property
+    def cache_key(self):
+        """
+        Canonical key of the inquiry (see `Inquiry.cache_key`)
+        """
+        key = self._cache_key
+        if key is None:
+            key = structural_digest(self._data())
+            object.__setattr__(self, '_cache_key', key)
+        return key
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __reduce__(self):
+        return type(self), (self.resource, self.action, self.subject, dict(self.context))
+
+    def __eq__(self, other):
+        """
+        If inquiries have the same contents - they are equal
+        """
+        if not isinstance(other, (Inquiry, FrozenInquiry)):
+            return NotImplemented
+        return self.cache_key == other.cache_key
+
+    def __hash__(self):
+        return int.from_bytes(self.cache_key[:8], 'little')
+
+    def __str__(self):
+        return "%s <Object ID %s>: %s" % (self.__class__, id(self), self._data())
+
+    def _data(self):
+        return {'resource': self.resource, 'action': self.action, 'subject': self.subject,
+                'context': dict(self.context)}
+
+
+class Decision:
+    """
+    Result of a Guard decision for an inquiry.
+
+    effect - the resulting effect: ALLOW_ACCESS or DENY_ACCESS
+    message - human-readable explanation of the decision
+    candidates - policies that fit the inquiry
+    deciders - policies that are responsible for the decision
+    """
+
+    def __init__(self, effect, message, candidates, deciders):
+        self.effect = effect
+        self.message = message
+        self.candidates = candidates
+        self.deciders = deciders
+
+
+class BaseGuard:
+    """
+    Storage-independent part of policy checks: decisions for given policies and their audit.
+    Is shared by sync and async Guards.
 
     storage - what storage to use
     checker - what checker to use
     audit_policies_cls - what message class to use for logging Policies in audit
+    deny_first - should policies with deny effect be checked first and the decision made on the first matching one?
+                 Policies returned by storage are consumed lazily in this mode, but audit log contains only the policy
+                 that denied access as a candidate.
     """
 
-    def __init__(self, storage, checker, audit_policies_cls=None):
+    def __init__(self, storage, checker, audit_policies_cls=None, deny_first=False):
         self.storage = storage
         self.checker = checker
+        self.deny_first = deny_first
         self.apm = audit_policies_cls
         if self.apm is None:
             self.apm = PoliciesUidMsg
 
-    def is_allowed(self, inquiry):
+    def _group_inquiries(self, inquiries):
         """
-        Is given inquiry intent allowed or not?
-        Same as `is_allowed_check`, but also logs policy enforcement decisions to log for every incoming inquiry.
-        Is meant to be used by an end-user.
+        Group inquiries by the storage filter key.
+        Returns list of inquiries indices lists.
         """
-        answer = self.is_allowed_check(inquiry)
-        if answer:
-            log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
-        else:
-            log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
-        return answer
+        groups = {}
+        for idx, inquiry in enumerate(inquiries):
+            key = self.storage.inquiry_filter_key(inquiry, self.checker)
+            groups.setdefault(key, []).append(idx)
+        return list(groups.values())
 
-    def is_allowed_check(self, inquiry):
+    def _decide_group(self, inquiries, indices, policies, decisions, batch_audit):
         """
-        Is given inquiry intent allowed or not?
-        Does not log answers to 'vakt.guard' log-stream.
-        Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
+        Make decisions for a group of inquiries that share the same policies and put them to `decisions`.
         """
+        if policies is None:
+            log.error('Storage returned None, but is supposed to return at least an empty list')
+            return
         try:
-            policies = self.storage.find_for_inquiry(inquiry, self.checker)
-            # A safe guard against custom Storages that may return None instead of an empty list
-            if policies is None:
-                log.error('Storage returned None, but is supposed to return at least an empty list')
-                return False
-            # Storage is not obliged to do the exact policies match. It's up to the storage
-            # to decide what policies to return. So we need a more correct programmatically done check.
-            answer = self.check_policies_allow(inquiry, policies)
-        except Exception:
-            log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
-            answer = False
-        return answer
+            # policies are shared by all the inquiries in a group, so they are fetched from a Storage once.
+            policies = list(policies)
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Unexpected exception occurred while checking Inquiry %s', inquiries[indices[0]])
+            return
+        for idx in indices:
+            try:
+                decisions[idx] = self.decide(inquiries[idx], policies)
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception('Unexpected exception occurred while checking Inquiry %s', inquiries[idx])
+                continue
+            if not batch_audit:
+                self._audit(inquiries[idx], decisions[idx])
+
+    def _answers_for_batch(self, inquiries, decisions, batch_audit):
+        """
+        Get answers for a batch of inquiries and log audit record for the batch if needed.
+        Inquiries that failed to be checked have no decision and are considered as rejected.
+        """
+        if batch_audit:
+            self._audit_batch(inquiries, decisions)
+        return [d is not None and d.effect == ALLOW_ACCESS for d in decisions]
 
     def check_policies_allow(self, inquiry, policies):
         """
         Check if any of a given policy allows a specified inquiry
         """
+        decision = self.decide(inquiry, policies)
+        self._audit(inquiry, decision)
+        return decision.effect == ALLOW_ACCESS
+
+    def decide(self, inquiry, policies):
+        """
+        Make a decision for a specified inquiry based on a given policies.
+        Does not log the decision to audit log.
+
+        Returns Decision
+        """
+        if self.deny_first:
+            return self._decide_deny_first(inquiry, policies)
         # Filter policies that fit Inquiry by its attributes.
-        filtered = [p for p in policies if
-                    self.checker.fits(p, 'actions', inquiry.action, inquiry) and
-                    self.checker.fits(p, 'subjects', inquiry.subject, inquiry) and
-                    self.checker.fits(p, 'resources', inquiry.resource, inquiry) and
-                    self.check_context_restriction(p, inquiry)]
+        filtered = [p for p in policies if self.fits(p, inquiry)]
 
         # no policies -> deny access!
         if len(filtered) == 0:
-            audit_log.info('No potential policies were found', extra={
-                'effect': DENY_ACCESS, 'inquiry': inquiry,
-                'candidates': self.apm(filtered), 'deciders': self.apm([]),
-            })
-            return False
+            return Decision(DENY_ACCESS, 'No potential policies were found', filtered, [])
 
         # if we have 2 or more similar policies - all of them should have allow effect, otherwise -> deny access!
         for p in filtered:
             if not p.allow_access():
-                audit_log.info('One of matching policies has deny effect', extra={
-                    'effect': DENY_ACCESS, 'inquiry': inquiry,
-                    'candidates': self.apm(filtered), 'deciders': self.apm([p]),
-                })
-                return False
+                return Decision(DENY_ACCESS, 'One of matching policies has deny effect', filtered, [p])
+
+        return Decision(ALLOW_ACCESS, 'All matching policies have allow effect', filtered, filtered)
+
+    def _decide_deny_first(self, inquiry, policies):
+        """
+        Make a decision checking policies with deny effect before the ones with allow effect.
+        Policies are consumed lazily: the first matching policy with deny effect decides the answer,
+        so the rest of them are neither checked nor even fetched from a storage.
+        """
+        allowing = []
+        for p in policies:
+            if p.allow_access():
+                allowing.append(p)
+            elif self.fits(p, inquiry):
+                return Decision(DENY_ACCESS, 'One of matching policies has deny effect (short-circuited)', [p], [p])
+        filtered = [p for p in allowing if self.fits(p, inquiry)]
+        if len(filtered) == 0:
+            return Decision(DENY_ACCESS, 'No potential policies were found', filtered, [])
+        return Decision(ALLOW_ACCESS, 'All matching policies have allow effect', filtered, filtered)
 
-        audit_log.info('All matching policies have allow effect', extra={
-            'effect': ALLOW_ACCESS, 'inquiry': inquiry,
-            'candidates': self.apm(filtered), 'deciders': self.apm(filtered),
+    def fits(self, policy, inquiry):
+        """
+        Does policy fit the inquiry by its actions, subjects, resources and context?
+        """
+        return (self.checker.fits(policy, 'actions', inquiry.action, inquiry) and
+                self.checker.fits(policy, 'subjects', inquiry.subject, inquiry) and
+                self.checker.fits(policy, 'resources', inquiry.resource, inquiry) and
+                self.check_context_restriction(policy, inquiry))
+
+    def _audit(self, inquiry, decision):
+        """
+        Log a decision made for inquiry to audit log
+        """
+        audit_log.info(decision.message, extra={
+            'effect': decision.effect, 'inquiry': inquiry,
+            'candidates': self.apm(decision.candidates), 'deciders': self.apm(decision.deciders),
+        })
+
+    def _audit_batch(self, inquiries, decisions):
+        """
+        Log decisions made for a batch of inquiries to audit log as a single record.
+        """
+        candidates, deciders = {}, {}
+        for decision in filter(None, decisions):
+            candidates.update((id(p), p) for p in decision.candidates)
+            deciders.update((id(p), p) for p in decision.deciders)
+        audit_log.info('Batch of inquiries was checked', extra={
+            'effect': [d.effect if d else DENY_ACCESS for d in decisions], 'inquiry': InquiriesMsg(inquiries),
+            'candidates': self.apm(list(candidates.values())), 'deciders': self.apm(list(deciders.values())),
         })
-        return True
 
     @staticmethod
     def check_context_restriction(policy, inquiry):
@@ -149,3 +321,190 @@ class Guard:
             if not rule.satisfied(ctx_value, inquiry):
                 return False
         return True
+
+
+
+class Guard(BaseGuard):
+    """
+    Executor of policy checks.
+    Given a storage and a checker it can decide via `is_allowed` method if a given inquiry allowed or not.
+
+    storage - what storage to use
+    checker - what checker to use
+    audit_policies_cls - what message class to use for logging Policies in audit
+    deny_first - should policies with deny effect be checked first and the decision made on the first matching one?
+                 Policies returned by storage are consumed lazily in this mode, but audit log contains only the policy
+                 that denied access as a candidate.
+    """
+
+    def is_allowed(self, inquiry):
+        """
+        Is given inquiry intent allowed or not?
+        Same as `is_allowed_check`, but also logs policy enforcement decisions to log for every incoming inquiry.
+        Is meant to be used by an end-user.
+        """
+        answer = self.is_allowed_check(inquiry)
+        if answer:
+            log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
+        else:
+            log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
+        return answer
+
+    def is_allowed_check(self, inquiry):
+        """
+        Is given inquiry intent allowed or not?
+        Does not log answers to 'vakt.guard' log-stream.
+        Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
+        """
+        decision = self.check_inquiry(inquiry)
+        return decision is not None and decision.effect == ALLOW_ACCESS
+
+    def check_inquiry(self, inquiry):
+        """
+        Make a decision for a given inquiry based on policies from Storage and log it to audit log.
+        Does not log answers to 'vakt.guard' log-stream.
+
+        Returns Decision or None if inquiry failed to be checked
+        """
+        try:
+            policies = self.storage.find_for_inquiry(inquiry, self.checker)
+            # A safe guard against custom Storages that may return None instead of an empty list
+            if policies is None:
+                log.error('Storage returned None, but is supposed to return at least an empty list')
+                return None
+            # Storage is not obliged to do the exact policies match. It's up to the storage
+            # to decide what policies to return. So we need a more correct programmatically done check.
+            decision = self.decide(inquiry, policies)
+            self._audit(inquiry, decision)
+        # any error of a Storage or a Checker means the Inquiry is not allowed
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
+            return None
+        return decision
+
+    def is_allowed_many(self, inquiries, batch_audit=False):
+        """
+        Are given inquiries intents allowed or not?
+        Same as `is_allowed_check_many`, but also logs policy enforcement decisions to log for every incoming inquiry.
+        Is meant to be used by an end-user.
+        """
+        inquiries = list(inquiries)
+        answers = self.is_allowed_check_many(inquiries, batch_audit=batch_audit)
+        for inquiry, answer in zip(inquiries, answers):
+            if answer:
+                log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
+            else:
+                log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
+        return answers
+
+    def is_allowed_check_many(self, inquiries, batch_audit=False):
+        """
+        Are given inquiries intents allowed or not?
+        Returns a list of answers in the same order as inquiries were given.
+
+        Inquiries are grouped by the key Storage uses for filtering policies (see `Storage.inquiry_filter_key`),
+        so that potential policies are fetched from Storage only once per each group of inquiries.
+        If `batch_audit` is True, a single audit record is logged for all the inquiries instead of one per inquiry.
+        Does not log answers to 'vakt.guard' log-stream.
+        Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
+        """
+        inquiries = list(inquiries)
+        decisions = [None] * len(inquiries)
+        for indices in self._group_inquiries(inquiries):
+            try:
+                policies = self.storage.find_for_inquiry(inquiries[indices[0]], self.checker)
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception('Unexpected exception occurred while checking Inquiry %s', inquiries[indices[0]])
+                continue
+            self._decide_group(inquiries, indices, policies, decisions, batch_audit)
+        return self._answers_for_batch(inquiries, decisions, batch_audit)
+
+
+class AsyncGuard(BaseGuard):
+    """
+    Executor of policy checks for asyncio applications.
+    The same as Guard, but works with an AsyncStorage, and its `is_allowed*` methods are coroutines.
+    While storage performs I/O, the event loop is free to serve other inquiries.
+
+    storage - what async storage to use
+    checker - what checker to use
+    audit_policies_cls - what message class to use for logging Policies in audit
+    deny_first - should policies with deny effect be checked first (see Guard)
+    """
+
+    async def is_allowed(self, inquiry):
+        """
+        Is given inquiry intent allowed or not?
+        Same as `is_allowed_check`, but also logs policy enforcement decisions to log for every incoming inquiry.
+        Is meant to be used by an end-user.
+        """
+        answer = await self.is_allowed_check(inquiry)
+        if answer:
+            log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
+        else:
+            log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
+        return answer
+
+    async def is_allowed_check(self, inquiry):
+        """
+        Is given inquiry intent allowed or not?
+        Does not log answers to 'vakt.guard' log-stream.
+        Is not meant to be called by an end-user. Use it only if you want the core functionality of allowance check.
+        """
+        decision = await self.check_inquiry(inquiry)
+        return decision is not None and decision.effect == ALLOW_ACCESS
+
+    async def check_inquiry(self, inquiry):
+        """
+        Make a decision for a given inquiry based on policies from Storage and log it to audit log.
+        See `Guard.check_inquiry` for details.
+
+        Returns Decision or None if inquiry failed to be checked
+        """
+        try:
+            policies = await self.storage.find_for_inquiry(inquiry, self.checker)
+            # A safe guard against custom Storages that may return None instead of an empty list
+            if policies is None:
+                log.error('Storage returned None, but is supposed to return at least an empty list')
+                return None
+            decision = self.decide(inquiry, policies)
+            self._audit(inquiry, decision)
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Unexpected exception occurred while checking Inquiry %s', inquiry)
+            return None
+        return decision
+
+    async def is_allowed_many(self, inquiries, batch_audit=False):
+        """
+        Are given inquiries intents allowed or not?
+        Same as `is_allowed_check_many`, but also logs policy enforcement decisions to log for every incoming inquiry.
+        Is meant to be used by an end-user.
+        """
+        inquiries = list(inquiries)
+        answers = await self.is_allowed_check_many(inquiries, batch_audit=batch_audit)
+        for inquiry, answer in zip(inquiries, answers):
+            if answer:
+                log.info('Incoming Inquiry was allowed. Inquiry: %s', inquiry)
+            else:
+                log.info('Incoming Inquiry was rejected. Inquiry: %s', inquiry)
+        return answers
+
+    async def is_allowed_check_many(self, inquiries, batch_audit=False):
+        """
+        Are given inquiries intents allowed or not?
+        See `Guard.is_allowed_check_many` for details. Policies for all groups of inquiries are fetched concurrently.
+        """
+        inquiries = list(inquiries)
+        decisions = [None] * len(inquiries)
+        groups = self._group_inquiries(inquiries)
+        fetched = await asyncio.gather(
+            *[self.storage.find_for_inquiry(inquiries[indices[0]], self.checker) for indices in groups],
+            return_exceptions=True
+        )
+        for indices, policies in zip(groups, fetched):
+            if isinstance(policies, Exception):
+                log.error('Unexpected exception occurred while checking Inquiry %s', inquiries[indices[0]],
+                          exc_info=policies)
+                continue
+            self._decide_group(inquiries, indices, policies, decisions, batch_audit)
+        return self._answers_for_batch(inquiries, decisions, batch_audit)
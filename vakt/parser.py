@@ -7,7 +7,7 @@ import re
 from .exceptions import InvalidPatternError
 
 
-__all__ = ['compile_regex']
+__all__ = ['compile_regex', 'get_literal_affixes']
 
 
 def compile_regex(phrase, start_tag, end_tag):
@@ -24,6 +24,18 @@ def compile_regex(phrase, start_tag, end_tag):
     return re.compile('^%s%s$' % (pattern, re.escape(raw)))
 
 
+def get_literal_affixes(phrase, start_tag, end_tag):
+    """
+    Get literal prefix and suffix of a string denoted by tags.
+    E.g. ('books:', '.txt') for 'books:<.*>.txt'. For a string without tags the whole string is a prefix.
+    Raises exception if tags are not balanced.
+    """
+    indices = get_tag_indices(phrase, start_tag, end_tag)
+    if not indices:
+        return phrase, ''
+    return phrase[:indices[0]], phrase[indices[-1]:]
+
+
 def get_tag_indices(string, start, end):
     """
     Find and return list of tag indices in the given string.
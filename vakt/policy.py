@@ -4,7 +4,7 @@ Namespace for a basic Policy class.
 
 import logging
 import warnings
-import copy
+from types import MappingProxyType
 
 from .effects import ALLOW_ACCESS, DENY_ACCESS
 from .exceptions import PolicyCreationError
@@ -53,20 +53,7 @@ class Policy(JsonSerializer, PrettyPrint):
 
     @classmethod
     def from_json(cls, data):
-        props = cls._parse(data)
-        if 'uid' not in props:
-            log.error("Error creating policy from json. 'uid' attribute is required")
-            raise PolicyCreationError("Error creating policy from json. 'uid' attribute is required")
-        context_rules = {}
-        if 'context' in props:
-            context_rules = props['context']
-        elif 'rules' in props:  # this is to support deprecated 'rules' attribute
-            context_rules = props['rules']
-            del props['rules']
-        props['context'] = context_rules
-        if 'type' in props:  # type is calculated dynamically on init
-            del props['type']
-        return cls(**props)
+        return cls(**_props_from_json(cls._parse(data)))
 
     def allow_access(self):
         """Does policy imply allow-access?"""
@@ -97,32 +84,13 @@ class Policy(JsonSerializer, PrettyPrint):
         self.__dict__['type'] = calculated_type
 
     def _calculate_type(self, new_element_name, new_element_value):
-        all_elements = rule_elements = str_elements = 0
-        self_copy = copy.copy(self)
-        self_copy.__dict__[new_element_name] = new_element_value
-        for elements in [getattr(self_copy, f, ()) for f in self._definition_fields]:
-            for e in elements:
-                all_elements += 1
-                if isinstance(e, (dict, Rule)):
-                    rule_elements += 1
-                elif isinstance(e, str):
-                    str_elements += 1
-        if all_elements == str_elements or all_elements == 0:
-            return TYPE_STRING_BASED
-        if all_elements == rule_elements:
-            return TYPE_RULE_BASED
-        raise PolicyCreationError(
-            'Policy elements should all be either dict, Rule (for rule-based) or string (for string-based)'
+        return _calculate_type(
+            new_element_value if f == new_element_name else getattr(self, f, ()) for f in self._definition_fields
         )
 
     def _check_field_type(self, name, value):
         """Checks type of a field that defines Policy"""
-        if name in self._definition_fields and not all(map(lambda x: isinstance(x, (str, dict, Rule)), value)):
-            raise PolicyCreationError(
-                'Field "%s" element must be of `str`, `dict` or `Rule` type. But given: %s' % (name, value)
-            )
-        if name == 'context' and not isinstance(value, dict):
-            raise PolicyCreationError('Error creating Policy. Context must be a dictionary')
+        _check_field_type(self._definition_fields, name, value)
 
     def _data(self):
         data = vars(self)
@@ -133,6 +101,107 @@ class Policy(JsonSerializer, PrettyPrint):
         return data
 
 
+class FrozenPolicy(JsonSerializer):
+    """
+    Immutable compact variant of Policy.
+    It has no instance dictionary: definition fields are stored as tuples, context as a read-only mapping
+    and policy type is calculated once on creation. Is meant for large policy-sets held in memory.
+    Has the same attributes and the same JSON representation as Policy, so it can be used with any Storage.
+    """
+    # slots are filled via object.__setattr__ since __setattr__ forbids modification,
+    # so pylint sees no assignments of them
+    # pylint: disable=no-member
+    __slots__ = ('uid', 'subjects', 'effect', 'resources', 'actions', 'context', 'description', 'type')
+
+    _definition_fields = Policy._definition_fields
+
+    def __init__(self, uid, subjects=(), effect=DENY_ACCESS, resources=(),
+                 actions=(), context=None, description=None):
+        subjects, resources, actions = tuple(subjects), tuple(resources), tuple(actions)
+        for name, value in (('subjects', subjects), ('resources', resources), ('actions', actions)):
+            _check_field_type(self._definition_fields, name, value)
+        if context is None:
+            context = _EMPTY_CONTEXT
+        else:
+            if isinstance(context, MappingProxyType):
+                context = dict(context)
+            _check_field_type(self._definition_fields, 'context', context)
+            context = MappingProxyType(context.copy()) if context else _EMPTY_CONTEXT
+        init = object.__setattr__
+        init(self, 'uid', uid)
+        init(self, 'subjects', subjects)
+        init(self, 'effect', effect or DENY_ACCESS)
+        init(self, 'resources', resources)
+        init(self, 'actions', actions)
+        init(self, 'context', context)
+        init(self, 'description', description)
+        init(self, 'type', _calculate_type((subjects, resources, actions)))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**_props_from_json(cls._parse(data)))
+
+    @classmethod
+    def from_policy(cls, policy):
+        """
+        Create FrozenPolicy from a Policy
+        """
+        return cls(policy.uid, subjects=policy.subjects, effect=policy.effect, resources=policy.resources,
+                   actions=policy.actions, context=policy.context, description=policy.description)
+
+    def to_policy(self):
+        """
+        Create a mutable Policy from this one
+        """
+        return Policy(self.uid, subjects=list(self.subjects), effect=self.effect, resources=list(self.resources),
+                      actions=list(self.actions), context=dict(self.context), description=self.description)
+
+    def allow_access(self):
+        """Does policy imply allow-access?"""
+        return self.effect == ALLOW_ACCESS
+
+    @property
+    def start_tag(self):
+        """
+        Policy expression start tag.
+        Used for policies defined with regexp.
+        """
+        return '<'
+
+    @property
+    def end_tag(self):
+        """
+        Policy expression end tag.
+        Used for policies defined with regexp.
+        """
+        return '>'
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __reduce__(self):
+        return type(self), (self.uid, self.subjects, self.effect, self.resources,
+                            self.actions, dict(self.context), self.description)
+
+    def __str__(self):
+        return "%s <Object ID %s>: %s" % (self.__class__, id(self), self._data())
+
+    def _data(self):
+        return {
+            'uid': self.uid,
+            'subjects': list(self.subjects),
+            'effect': self.effect,
+            'resources': list(self.resources),
+            'actions': list(self.actions),
+            'context': dict(self.context),
+            'description': self.description,
+            'type': self.type,
+        }
+
+
 class PolicyAllow(Policy):
     """
     Policy that has effect ALLOW_ACCESS by default.
@@ -151,3 +220,56 @@ class PolicyDeny(Policy):
         super().__init__(uid, effect=DENY_ACCESS,
                          subjects=subjects, resources=resources,
                          actions=actions, context=context, description=description)
+
+
+_EMPTY_CONTEXT = MappingProxyType({})
+
+
+def _props_from_json(props):
+    """
+    Get policy constructor arguments from a parsed JSON
+    """
+    if 'uid' not in props:
+        log.error("Error creating policy from json. 'uid' attribute is required")
+        raise PolicyCreationError("Error creating policy from json. 'uid' attribute is required")
+    context_rules = {}
+    if 'context' in props:
+        context_rules = props['context']
+    elif 'rules' in props:  # this is to support deprecated 'rules' attribute
+        context_rules = props['rules']
+        del props['rules']
+    props['context'] = context_rules
+    if 'type' in props:  # type is calculated dynamically on init
+        del props['type']
+    return props
+
+
+def _calculate_type(fields):
+    """
+    Calculate policy type by values of its definition fields
+    """
+    all_elements = rule_elements = str_elements = 0
+    for elements in fields:
+        for e in elements:
+            all_elements += 1
+            if isinstance(e, (dict, Rule)):
+                rule_elements += 1
+            elif isinstance(e, str):
+                str_elements += 1
+    if all_elements == str_elements or all_elements == 0:
+        return TYPE_STRING_BASED
+    if all_elements == rule_elements:
+        return TYPE_RULE_BASED
+    raise PolicyCreationError(
+        'Policy elements should all be either dict, Rule (for rule-based) or string (for string-based)'
+    )
+
+
+def _check_field_type(definition_fields, name, value):
+    """Checks type of a field that defines Policy"""
+    if name in definition_fields and not all(map(lambda x: isinstance(x, (str, dict, Rule)), value)):
+        raise PolicyCreationError(
+            'Field "%s" element must be of `str`, `dict` or `Rule` type. But given: %s' % (name, value)
+        )
+    if name == 'context' and not isinstance(value, dict):
+        raise PolicyCreationError('Error creating Policy. Context must be a dictionary')
@@ -17,3 +17,10 @@ from .string import (
     Contains,
     RegexMatch,
 )
+
+from .. import codec as _codec
+from . import base as _base, inquiry as _inquiry, list as _list, logic as _logic, net as _net, \
+    operator as _operator, string as _string
+
+# vakt's own Rules are encoded and decoded by the codec directly
+_codec.register_rules(_base.Rule, _inquiry, _list, _logic, _net, _operator, _string)
@@ -0,0 +1,292 @@
+"""
+Compiler of Rules into plain Python closures.
+
+Each compiled closure has the `satisfied` signature: (what, inquiry) -> bool and behaves the same way
+(including exceptions raised) as the `satisfied` method of the Rule it was compiled from.
+Only vakt's own Rules are compiled, Rules of other classes (including subclasses of vakt's Rules)
+are called via their `satisfied` method.
+
+Rules are considered immutable: if a Rule is modified after compilation, it should be compiled again.
+"""
+
+import logging
+
+from . import operator, logic, list as list_rules, string, net
+
+
+__all__ = [
+    'compile_rule',
+    'compile_definition',
+    'compile_context',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+def compile_rule(rule):
+    """
+    Compile a Rule into a closure: f(what, inquiry) -> bool
+    """
+    compiler = _COMPILERS.get(type(rule))
+    if compiler is not None:
+        return compiler(rule)
+    satisfied = getattr(rule, 'satisfied', None)
+    if callable(satisfied):
+        return satisfied
+    # let it fail on a call the same way as it does when not compiled
+    return lambda what, inquiry=None: rule.satisfied(what, inquiry)
+
+
+def compile_definition(items):
+    """
+    Compile a rule-based policy definition field (list of Rules and dictionaries of Rules) into a closure:
+    f(what, inquiry) -> bool that gives the same answer as `RulesChecker.fits` for this field.
+    """
+    matchers = []
+    for item in items:
+        if isinstance(item, dict):
+            matchers.append(_compile_dict_item(item))
+        elif callable(getattr(item, 'satisfied', '')):
+            matchers.append(_guarded(compile_rule(item)))
+    matchers = tuple(matchers)
+
+    def fits(what, inquiry=None):
+        for matcher in matchers:
+            if matcher(what, inquiry):
+                return True
+        return False
+    return fits
+
+
+def compile_context(context):
+    """
+    Compile policy context (dictionary of Rules) into a closure: f(inquiry) -> bool
+    that gives the same answer as `Guard.check_context_restriction`.
+    """
+    rules = tuple((key, compile_rule(rule)) for key, rule in context.items())
+
+    def satisfied(inquiry):
+        ctx = inquiry.context
+        for key, rule in rules:
+            try:
+                ctx_value = ctx[key]
+            except KeyError:
+                log.debug("No key '%s' found in Inquiry context", key)
+                return False
+            if not rule(ctx_value, inquiry):
+                return False
+        return True
+    return satisfied
+
+
+def _guarded(compiled):
+    """
+    Guard a top-level Rule call the same way RulesChecker does: any exception means no match.
+    """
+    def satisfied(what, inquiry=None):
+        try:
+            return compiled(what, inquiry)
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Error matching Policy, because of raised exception')
+            return False
+    return satisfied
+
+
+def _compile_dict_item(item):
+    rules = tuple((key, compile_rule(rule)) for key, rule in item.items())
+    # empty dictionary is never satisfied
+    if not rules:
+        return lambda what, inquiry=None: False
+
+    def satisfied(what, inquiry=None):
+        if not isinstance(what, dict):
+            log.debug('Error matching Policy: data %r in Inquiry is not `dict`', what)
+            return False
+        try:
+            for key, rule in rules:
+                if key not in what:
+                    log.debug('Error matching Policy: data %r has no key "%r" required by Policy', what, key)
+                    return False
+                if not rule(what[key], inquiry):
+                    return False
+        # any exception means that the item is not satisfied, the same as in RulesChecker
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Error matching Policy, because of raised exception')
+            return False
+        return True
+    return satisfied
+
+
+# Operator Rules
+
+def _compile_eq(rule):
+    val = list(rule.val) if isinstance(rule.val, tuple) else rule.val
+    return lambda what, inquiry=None: val == what
+
+
+def _compile_not_eq(rule):
+    val = list(rule.val) if isinstance(rule.val, tuple) else rule.val
+    return lambda what, inquiry=None: val != what
+
+
+def _compile_greater(rule):
+    val = rule.val
+    return lambda what, inquiry=None: what > val
+
+
+def _compile_less(rule):
+    val = rule.val
+    return lambda what, inquiry=None: what < val
+
+
+def _compile_greater_or_equal(rule):
+    val = rule.val
+    return lambda what, inquiry=None: what >= val
+
+
+def _compile_less_or_equal(rule):
+    val = rule.val
+    return lambda what, inquiry=None: what <= val
+
+
+# Logic Rules
+
+def _compile_boolean(rule):
+    val = rule.val
+    return lambda what, inquiry=None: bool(what() if callable(what) else what) == val
+
+
+def _compile_and(rule):
+    rules = tuple(compile_rule(r) for r in rule.rules)
+    if not rules:
+        return lambda what, inquiry=None: False
+
+    def satisfied(what, inquiry=None):
+        for r in rules:
+            if not r(what, inquiry):
+                return False
+        return True
+    return satisfied
+
+
+def _compile_or(rule):
+    rules = tuple(compile_rule(r) for r in rule.rules)
+
+    def satisfied(what, inquiry=None):
+        for r in rules:
+            if r(what, inquiry):
+                return True
+        return False
+    return satisfied
+
+
+def _compile_not(rule):
+    negated = compile_rule(rule.rule)
+    return lambda what, inquiry=None: not negated(what, inquiry)
+
+
+def _compile_any(_rule):
+    return lambda what=None, inquiry=None: True
+
+
+def _compile_neither(_rule):
+    return lambda what=None, inquiry=None: False
+
+
+# List Rules
+
+def _compile_in(rule):
+    data = rule.data
+    return lambda what, inquiry=None: what in data
+
+
+def _compile_not_in(rule):
+    data = rule.data
+    return lambda what, inquiry=None: what not in data
+
+
+def _compile_list_input(check):
+    """
+    Build a compiler for list Rules that accept only lists: check(what, data) -> bool
+    """
+    def compiler(rule):
+        data = rule.data
+
+        def satisfied(what, inquiry=None):  # pylint: disable=unused-argument
+            if not isinstance(what, list):
+                raise TypeError('Value should be of list type')
+            return check(what, data)
+        return satisfied
+    return compiler
+
+
+# String Rules
+
+def _compile_string(check):
+    """
+    Build a compiler for string Rules with optional case-insensitivity: check(what, val) -> bool
+    """
+    def compiler(rule):
+        if rule.ci:
+            val = rule.val.lower()
+            return lambda what, inquiry=None: isinstance(what, str) and check(what.lower(), val)
+        val = rule.val
+        return lambda what, inquiry=None: isinstance(what, str) and check(what, val)
+    return compiler
+
+
+def _compile_regex_match(rule):
+    regex = rule.regex
+    return lambda what, inquiry=None: bool(regex.match(str(what)))
+
+
+# Net Rules
+
+def _compile_cidr(rule):
+    try:
+        network = net.ip_network(rule.cidr)
+    except ValueError:
+        # let the rule log the error on each check
+        return rule.satisfied
+    ip_address = net.ip_address
+
+    def satisfied(what, inquiry=None):  # pylint: disable=unused-argument
+        if not isinstance(what, str):
+            return False
+        try:
+            ip = ip_address(what)
+        except ValueError:
+            log.exception('Error %s satisfied', type(rule).__name__)
+            return False
+        return ip in network
+    return satisfied
+
+
+_COMPILERS = {
+    operator.Eq: _compile_eq,
+    operator.NotEq: _compile_not_eq,
+    operator.Greater: _compile_greater,
+    operator.Less: _compile_less,
+    operator.GreaterOrEqual: _compile_greater_or_equal,
+    operator.LessOrEqual: _compile_less_or_equal,
+    logic.Truthy: _compile_boolean,
+    logic.Falsy: _compile_boolean,
+    logic.And: _compile_and,
+    logic.Or: _compile_or,
+    logic.Not: _compile_not,
+    logic.Any: _compile_any,
+    logic.Neither: _compile_neither,
+    list_rules.In: _compile_in,
+    list_rules.NotIn: _compile_not_in,
+    list_rules.AllIn: _compile_list_input(lambda what, data: set(what).issubset(data)),
+    list_rules.AllNotIn: _compile_list_input(lambda what, data: not set(what).issubset(data)),
+    list_rules.AnyIn: _compile_list_input(lambda what, data: bool(data.intersection(set(what)))),
+    list_rules.AnyNotIn: _compile_list_input(lambda what, data: bool(set(what).difference(data))),
+    string.Equal: _compile_string(lambda what, val: what == val),
+    string.StartsWith: _compile_string(lambda what, val: what.startswith(val)),
+    string.EndsWith: _compile_string(lambda what, val: what.endswith(val)),
+    string.Contains: _compile_string(lambda what, val: val in what),
+    string.RegexMatch: _compile_regex_match,
+    net.CIDR: _compile_cidr,
+}
@@ -77,11 +77,16 @@ class CompositionRule(Rule, metaclass=ABCMeta):
 class And(CompositionRule):
     """
     Rule that is satisfied when all the rules it's composed of are satisfied.
+    Uses short-circuit evaluation.
     For example: subjects=[{'stars': And(Greater(50), Less(120)), 'name': Eq('Jimmy')}]
     """
     def satisfied(self, what, inquiry=None):
-        answers = [x.satisfied(what, inquiry) for x in self.rules]
-        return len(answers) > 0 and all(answers)
+        if not self.rules:
+            return False
+        for rule in self.rules:
+            if not rule.satisfied(what, inquiry):
+                return False
+        return True
 
 
 class Or(CompositionRule):
@@ -5,6 +5,7 @@ All Rules relevant to networking context
 import ipaddress
 import logging
 import warnings
+from functools import lru_cache
 
 from ..rules.base import Rule
 
@@ -30,14 +31,30 @@ class CIDR(Rule):
         if not isinstance(what, str):
             return False
         try:
-            ip = ipaddress.ip_address(what)
-            net = ipaddress.ip_network(self.cidr)
+            ip = ip_address(what)
+            net = ip_network(self.cidr)
         except ValueError:
             log.exception('Error %s satisfied', type(self).__name__)
             return False
         return ip in net
 
 
+@lru_cache(maxsize=4096)
+def ip_network(cidr):
+    """
+    Parse IP network. Parsed networks are cached, so that each network is parsed once.
+    """
+    return ipaddress.ip_network(cidr)
+
+
+@lru_cache(maxsize=1024)
+def ip_address(address):
+    """
+    Parse IP address. Parsed addresses are cached, so that an inquiry's address is parsed once for all the rules.
+    """
+    return ipaddress.ip_address(address)
+
+
 # Classes marked for removal in next releases
 class CIDRRule(CIDR):
     """Deprecated in favor of CIDR"""
@@ -2,7 +2,94 @@
 Contains interfaces that all Storages should implement.
 """
 
+import heapq
 from abc import ABCMeta, abstractmethod
+from operator import attrgetter
+
+from ..util import structural_digest
+
+
+# errors of converting a policy to the form a storage keeps it in (e.g. a policy with a value that can't be serialized)
+_CONVERSION_ERRORS = (TypeError, ValueError, AttributeError, RecursionError)
+
+
+class BulkResult:
+    """
+    Result of a bulk modification of Storage: `add_many`, `update_many` or `delete_many`.
+
+    succeeded - list of UIDs of policies that were processed, in the order they were given
+    errors - dict of UID -> exception for policies that failed. A failure of one policy doesn't abort the others
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.errors = {}
+
+    def __bool__(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '%s(succeeded=%d, errors=%d)' % (type(self).__name__, len(self.succeeded), len(self.errors))
+
+    def succeed(self, uid):
+        self.succeeded.append(uid)
+
+    def fail(self, uid, error):
+        self.errors[uid] = error
+
+    def filter_succeeded(self, items, uid_of=attrgetter('uid')):
+        """
+        Get those of the given items (policies by default) that succeeded.
+        Items should be the ones the result was obtained for, in the same order.
+        """
+        succeeded, pos = self.succeeded, 0
+        result = []
+        for item in items:
+            if pos < len(succeeded) and uid_of(item) == succeeded[pos]:
+                result.append(item)
+                pos += 1
+        return result
+
+
+def _fields_filter_key(inquiry):
+    """
+    Get a key of inquiry fields storages filter policies on: (subject, action, resource).
+    Non-string values are replaced by a digest of their contents, so the key is always hashable
+    and values of different types are not treated as equal.
+    """
+    key = (inquiry.subject, inquiry.action, inquiry.resource)
+    if all(isinstance(x, str) for x in key):
+        return key
+    return structural_digest(key)
+
+
+def _uid_order(policy):
+    # UIDs are compared as strings, since SQL storage keeps them so
+    return str(policy.uid)
+
+
+def _first_after(policies, last_uid, limit):
+    """
+    Get at most `limit` of the given policies ordered by UID whose UIDs go after `last_uid`.
+    Only `limit` policies are kept at a time.
+    """
+    if last_uid is not None:
+        policies = (p for p in policies if str(p.uid) > str(last_uid))
+    return heapq.nsmallest(limit, policies, key=_uid_order)
+
+
+def _chunks(items, size):
+    """
+    Split iterable into lists of a given size, the last one may be shorter.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class Storage(metaclass=ABCMeta):
@@ -12,6 +99,9 @@ class Storage(metaclass=ABCMeta):
     it can be in-memory storage, SQL database, NoSQL solution, etc.
     """
 
+    # storage implements `get_after` without a scan of all the policies, so `retrieve_all` pages with it
+    supports_get_after = False
+
     @abstractmethod
     def add(self, policy):
         """Store a policy"""
@@ -33,14 +123,42 @@ class Storage(metaclass=ABCMeta):
         """
         pass
 
+    def get_after(self, last_uid, limit):
+        """
+        Retrieve at most `limit` policies ordered by UID whose UIDs go after `last_uid`.
+        If `last_uid` is None, policies are retrieved from the first one.
+        Storage decides how UIDs of different types are ordered, the default implementation compares them as strings.
+        Unlike `get_all` storage doesn't have to skip the preceding policies, so paging through
+        the whole storage with UID of the last retrieved policy is linear.
+
+        Storages that can order policies by UID implement it and set `supports_get_after`.
+        Otherwise all the policies are scanned on each call.
+
+        Returns Iterable
+        """
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return []
+        return _first_after(self.retrieve_all(), last_uid, limit)
+
     def retrieve_all(self, batch=50):
         """
         Retrieve all the policies from the storage in batches of a specified size.
         Stops when all the existing policies from a storage where returned.
         You can specify a size of a batch of policies for each iteration.
+        Uses `get_after` if storage supports it and `get_all` otherwise.
 
         Returns generator
         """
+        if self.supports_get_after:
+            policies = list(self.get_after(None, batch))
+            while policies:
+                for policy in policies:
+                    yield policy
+                if len(policies) < batch:
+                    return
+                policies = list(self.get_after(policies[-1].uid, batch))
+            return
         limit, offset = batch, 0
         while True:
             policies = list(self.get_all(limit, offset))
@@ -66,6 +184,20 @@ class Storage(metaclass=ABCMeta):
         """
         pass
 
+    def inquiry_filter_key(self, inquiry, checker=None):  # pylint: disable=unused-argument
+        """
+        Get a key that identifies the result of `find_for_inquiry` for a given inquiry and checker.
+        Inquiries that have equal keys must get the same potential policies from `find_for_inquiry`,
+        so that callers that check many inquiries at once are able to fetch policies only once per key.
+        Storage that returns the same policies regardless of the inquiry may return a constant (e.g. None).
+
+        By default the key is built from inquiry subject, action and resource, the context isn't a part of it.
+        Storage whose `find_for_inquiry` filters policies by inquiry context must override it.
+
+        Returns hashable object
+        """
+        return _fields_filter_key(inquiry)
+
     @abstractmethod
     def update(self, policy):
         """Update a policy"""
@@ -76,9 +208,205 @@ class Storage(metaclass=ABCMeta):
         """Delete a policy"""
         pass
 
+    def add_many(self, policies):
+        """
+        Store many policies at once.
+        Policy that can't be stored (e.g. already exists) is reported in the result and doesn't stop the others.
+        Errors that concern the whole batch (e.g. lost connection) are raised.
+
+        By default policies are added one by one. Storages are free to do it in a more efficient way.
+
+        Returns BulkResult
+        """
+        return self._each(self.add, policies, lambda policy: policy.uid)
+
+    def update_many(self, policies):
+        """
+        Update many policies at once. See `add_many` for the handling of errors.
+
+        Returns BulkResult
+        """
+        return self._each(self.update, policies, lambda policy: policy.uid)
+
+    def delete_many(self, uids):
+        """
+        Delete many policies at once. See `add_many` for the handling of errors.
+
+        Returns BulkResult
+        """
+        return self._each(self.delete, uids, lambda uid: uid)
+
+    @staticmethod
+    def _each(func, items, uid_of):
+        """
+        Apply func to each of the items collecting errors in BulkResult.
+        """
+        result = BulkResult()
+        for item in items:
+            try:
+                func(item)
+            # errors a storage raises are unknown here, each of them fails only its item
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                result.fail(uid_of(item), e)
+            else:
+                result.succeed(uid_of(item))
+        return result
+
     @staticmethod
     def _check_limit_and_offset(limit, offset):
         if limit < 0:
             raise ValueError("Limit can't be negative")
         if offset < 0:
             raise ValueError("Offset can't be negative")
+
+
+class AsyncStorage(metaclass=ABCMeta):
+    """
+    Interface for any storage that persists policies and is meant to be used with asyncio.
+    Mirrors `Storage` interface, but all the methods that do I/O are coroutines.
+    """
+
+    # see `Storage.supports_get_after`
+    supports_get_after = False
+
+    @abstractmethod
+    async def add(self, policy):
+        """Store a policy"""
+        pass
+
+    @abstractmethod
+    async def get(self, uid):
+        """Retrieve specific policy"""
+        pass
+
+    @abstractmethod
+    async def get_all(self, limit, offset):
+        """
+        Retrieve all the policies within a window.
+
+        All storages must have the same behaviour when using limit=0: return empty list.
+
+        Returns Iterable
+        """
+        pass
+
+    async def get_after(self, last_uid, limit):
+        """
+        Retrieve at most `limit` policies ordered by UID whose UIDs go after `last_uid`.
+        See `Storage.get_after` for details.
+
+        Returns Iterable
+        """
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return []
+        found, chunk = [], []
+        async for policy in self.retrieve_all():
+            chunk.append(policy)
+            if len(chunk) == limit:
+                found = _first_after(found + chunk, last_uid, limit)
+                chunk = []
+        return _first_after(found + chunk, last_uid, limit)
+
+    async def retrieve_all(self, batch=50):
+        """
+        Retrieve all the policies from the storage in batches of a specified size.
+        Stops when all the existing policies from a storage where returned.
+        You can specify a size of a batch of policies for each iteration.
+        Uses `get_after` if storage supports it and `get_all` otherwise.
+
+        Returns async generator
+        """
+        if self.supports_get_after:
+            policies = list(await self.get_after(None, batch))
+            while policies:
+                for policy in policies:
+                    yield policy
+                if len(policies) < batch:
+                    return
+                policies = list(await self.get_after(policies[-1].uid, batch))
+            return
+        limit, offset = batch, 0
+        while True:
+            policies = list(await self.get_all(limit, offset))
+            if len(policies) == 0:
+                return
+            for policy in policies:
+                yield policy
+            offset = offset + limit
+
+    @abstractmethod
+    async def find_for_inquiry(self, inquiry, checker=None):
+        """
+        Get potential policies for a given inquiry.
+        See `Storage.find_for_inquiry` for details.
+
+        Returns Iterable
+        """
+        pass
+
+    def inquiry_filter_key(self, inquiry, checker=None):  # pylint: disable=unused-argument
+        """
+        Get a key that identifies the result of `find_for_inquiry` for a given inquiry and checker.
+        See `Storage.inquiry_filter_key` for details.
+
+        Returns hashable object
+        """
+        return _fields_filter_key(inquiry)
+
+    @abstractmethod
+    async def update(self, policy):
+        """Update a policy"""
+        pass
+
+    @abstractmethod
+    async def delete(self, uid):
+        """Delete a policy"""
+        pass
+
+    async def add_many(self, policies):
+        """
+        Store many policies at once.
+        See `Storage.add_many` for details.
+
+        Returns BulkResult
+        """
+        return await self._each(self.add, policies, lambda policy: policy.uid)
+
+    async def update_many(self, policies):
+        """
+        Update many policies at once.
+        See `Storage.add_many` for details.
+
+        Returns BulkResult
+        """
+        return await self._each(self.update, policies, lambda policy: policy.uid)
+
+    async def delete_many(self, uids):
+        """
+        Delete many policies at once.
+        See `Storage.add_many` for details.
+
+        Returns BulkResult
+        """
+        return await self._each(self.delete, uids, lambda uid: uid)
+
+    @staticmethod
+    async def _each(func, items, uid_of):
+        """
+        Await func for each of the items collecting errors in BulkResult.
+        """
+        result = BulkResult()
+        for item in items:
+            try:
+                await func(item)
+            # errors a storage raises are unknown here, each of them fails only its item
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                result.fail(uid_of(item), e)
+            else:
+                result.succeed(uid_of(item))
+        return result
+
+    @staticmethod
+    def _check_limit_and_offset(limit, offset):
+        Storage._check_limit_and_offset(limit, offset)
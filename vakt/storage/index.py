@@ -0,0 +1,554 @@
+"""
+In-memory indexes of Policies that are used by storages to narrow down potential policies for an inquiry.
+"""
+
+import re
+import threading
+
+from ..checker import RegexChecker, StringExactChecker, StringFuzzyChecker, RulesChecker
+from ..exceptions import InvalidPatternError
+from ..parser import compile_regex, get_literal_affixes
+from ..rules.operator import Eq
+from ..rules.list import In
+
+
+__all__ = [
+    'PolicyIndex',
+    'RegexSet',
+    'RegexTrie',
+    'SubstringIndex',
+]
+
+
+# Policy fields with their Inquiry counterparts
+FIELDS = (
+    ('subjects', 'subject'),
+    ('actions', 'action'),
+    ('resources', 'resource'),
+)
+
+KIND_EXACT = 'exact'
+KIND_REGEX = 'regex'
+KIND_FUZZY = 'fuzzy'
+KIND_RULES = 'rules'
+
+# Key of a bucket for policies that can't be found by a literal value of a field and are always potential
+SCAN = None
+
+
+class PolicyIndex:
+    """
+    Per-field hash indexes of policies' literal values: literal value -> policy uids.
+
+    Indexes are kept for the checkers with known matching semantics:
+      - StringExactChecker: values with tags stripped.
+      - RegexChecker: values that are not tag-delimited regexps.
+        Tag-delimited regexps of a field are kept in a RegexTrie of that field.
+        Policies with regexps that can't be compiled are kept in a separate scan-bucket of that field.
+      - StringFuzzyChecker: values with tags stripped are kept in a SubstringIndex of that field.
+      - RulesChecker: dictionaries of Rules are indexed by (key, value) pairs pinned by their `Eq` or `In` rules,
+        e.g. {'status': Eq('registered')} by ('status', 'registered').
+        Policies that have Rules or dictionaries without such rules in a field are kept in a scan-bucket of that field.
+    Other checkers (including subclasses of the above ones) are not indexed.
+
+    Index gives a superset of policies that fit an inquiry. Policies should still be checked by a checker.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.keys = {}
+        self.structures = {
+            KIND_REGEX: {field: RegexTrie() for field, _ in FIELDS},
+            KIND_FUZZY: {field: SubstringIndex() for field, _ in FIELDS},
+        }
+        self.entries = {}
+        self.seq = {}
+        self._counter = 0
+
+    def add(self, policy):
+        """
+        Index a policy. If policy with the same UID was indexed, it's reindexed keeping its position.
+        """
+        keys, entries = self.index_data(policy)
+        self.add_data(policy.uid, keys, entries)
+
+    def add_data(self, uid, keys, entries):
+        """
+        Index a policy by its index data obtained with `index_data`.
+        If policy with the same UID was indexed, it's reindexed keeping its position.
+        """
+        self.remove(uid)
+        if uid not in self.seq:
+            self.seq[uid] = self._counter
+            self._counter += 1
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(uid)
+        for kind, field, entry in entries:
+            self.structures[kind][field].add(entry, uid)
+        # tuples take less memory than sets
+        self.keys[uid] = tuple(keys)
+        self.entries[uid] = tuple(entries)
+
+    @classmethod
+    def index_data(cls, policy):
+        """
+        Get data a policy is indexed by: (keys, entries), where keys are (kind, field, value) keys of buckets
+        and entries are (kind, field, entry) entries of structures (RegexTrie, SubstringIndex) the policy belongs to.
+        """
+        keys, entries = set(), set()
+        for field, _ in FIELDS:
+            for kind, value in cls._bucket_values(policy, field):
+                entry = None
+                if value is SCAN:
+                    pass
+                elif kind == KIND_FUZZY:
+                    entry = value
+                elif kind == KIND_REGEX and (policy.start_tag in value or policy.end_tag in value):
+                    try:
+                        regex = compile_regex(value, policy.start_tag, policy.end_tag)
+                        prefix, suffix = get_literal_affixes(value, policy.start_tag, policy.end_tag)
+                    except (InvalidPatternError, re.error):
+                        value = SCAN
+                    else:
+                        # regex is kept as source, it's compiled again only if it needs to be scanned
+                        entry = (regex.pattern, prefix, suffix)
+                if entry is None:
+                    keys.add((kind, field, value))
+                else:
+                    entries.add((kind, field, entry))
+        return keys, entries
+
+    def remove(self, uid, forget=False):
+        """
+        Remove a policy from index.
+        If `forget` is True policy's position is forgotten as well.
+        """
+        for key in self.keys.pop(uid, ()):
+            bucket = self.buckets[key]
+            bucket.discard(uid)
+            if not bucket:
+                del self.buckets[key]
+        for kind, field, entry in self.entries.pop(uid, ()):
+            self.structures[kind][field].remove(entry, uid)
+        if forget:
+            self.seq.pop(uid, None)
+
+    def find(self, inquiry, checker):
+        """
+        Find UIDs of policies that might fit the inquiry in the order they were added.
+        Returns None if policies can't be looked up for the given inquiry and checker.
+        """
+        kind = self.kind(checker)
+        if kind is None:
+            return None
+        result = None
+        for field, attr in FIELDS:
+            found = self._find_for_field(kind, field, getattr(inquiry, attr))
+            if found is None:
+                return None
+            result = found if result is None else result & found
+            if not result:
+                return []
+        return sorted(result, key=self.seq.__getitem__)
+
+    def filter_key(self, inquiry, checker):
+        """
+        Get a key that is equal for inquiries that get the same result from `find`.
+        """
+        kind = self.kind(checker)
+        if kind is None:
+            return None
+        if kind == KIND_RULES:
+            return tuple(self._pinned_inquiry_values(getattr(inquiry, attr)) for _, attr in FIELDS)
+        key = tuple(getattr(inquiry, attr) for _, attr in FIELDS)
+        if not all(isinstance(x, str) for x in key):
+            return None
+        return key
+
+    def _find_for_field(self, kind, field, what):
+        """
+        Find UIDs of policies that might fit the inquiry value by the given field.
+        Returns None if policies can't be looked up.
+        """
+        found = set(self.buckets.get((kind, field, SCAN), ()))
+        if kind == KIND_RULES:
+            for pair in self._pinned_inquiry_values(what) or ():
+                found |= self.buckets.get((kind, field, pair), set())
+            return found
+        if not isinstance(what, str):
+            return None
+        found |= self.buckets.get((kind, field, what), set())
+        structures = self.structures.get(kind)
+        if structures:
+            found |= structures[field].match(what)
+        return found
+
+    @staticmethod
+    def kind(checker):
+        """
+        Get kind of an index suitable for a checker. None if there is no such index.
+        """
+        checker_type = type(checker)
+        if checker_type == StringExactChecker:
+            return KIND_EXACT
+        if checker_type == RegexChecker:
+            return KIND_REGEX
+        if checker_type == StringFuzzyChecker:
+            return KIND_FUZZY
+        if checker_type == RulesChecker:
+            return KIND_RULES
+        return None
+
+    @staticmethod
+    def _bucket_values(policy, field):
+        """
+        Get (kind, value) pairs of buckets a policy field belongs to.
+        Non-string values never fit string-based checkers, so they are not indexed for them at all.
+        The same is true for string values and RulesChecker.
+        Policies with an empty field never fit, but are kept in scan-buckets to be returned as before.
+        """
+        items = getattr(policy, field, [])
+        if not items:
+            for kind in (KIND_EXACT, KIND_REGEX, KIND_FUZZY, KIND_RULES):
+                yield kind, SCAN
+        for item in items:
+            if isinstance(item, dict):
+                pinned = PolicyIndex._pinned_values(item)
+                for value in (SCAN,) if pinned is None else pinned:
+                    yield KIND_RULES, value
+                continue
+            if not isinstance(item, str):
+                yield KIND_RULES, SCAN
+                continue
+            # StringChecker fails on empty values, so let it decide what to do with them
+            if not item:
+                yield KIND_EXACT, SCAN
+                yield KIND_FUZZY, SCAN
+            elif policy.start_tag == item[0] and policy.end_tag == item[-1]:
+                yield KIND_EXACT, item[1:-1]
+                yield KIND_FUZZY, item[1:-1]
+            else:
+                yield KIND_EXACT, item
+                yield KIND_FUZZY, item
+            yield KIND_REGEX, item
+
+    @staticmethod
+    def _pinned_values(item):
+        """
+        Get (key, value) pairs a dictionary of Rules can be found by: at least one of them should be in inquiry's data
+        for a dictionary to be satisfied. Returns None if there are no such pairs.
+        Dictionary with `Eq` rule is found by its value, dictionary with `In` rule is found by any of its values.
+        """
+        if not item:
+            # empty dictionary is never satisfied
+            return []
+        # subclasses of the rules may be satisfied by other values, so they aren't pinned
+        # pylint: disable=unidiomatic-typecheck
+        for key, rule in item.items():
+            if type(rule) == Eq:
+                val = list(rule.val) if isinstance(rule.val, tuple) else rule.val
+                try:
+                    hash(val)
+                except TypeError:
+                    continue
+                return [(key, val)]
+        for key, rule in item.items():
+            if type(rule) == In:
+                return [(key, val) for val in rule.data]
+        return None
+
+    @staticmethod
+    def _pinned_inquiry_values(what):
+        """
+        Get hashable (key, value) pairs of inquiry's data. None if data is not a dictionary.
+        """
+        if not isinstance(what, dict):
+            return None
+        pairs = set()
+        for pair in what.items():
+            try:
+                hash(pair)
+            except TypeError:
+                continue
+            pairs.add(pair)
+        return frozenset(pairs)
+
+
+class RegexSet:
+    """
+    Set of regexps that finds all the regexps matching a string in a few scans.
+    Regexps are given either compiled or as their sources: sources are compiled only when they need to be scanned.
+
+    Python's `re` reports only the first matched alternative of a regex, so regexps are organized into a tree:
+    each node is a combined alternation of regexps of its subtree and children of a node are scanned only
+    if the node itself matched. Regexps that can't be safely combined (e.g. ones with backreferences)
+    are scanned one by one. Tree is rebuilt lazily after the set was modified.
+
+    Modifications should be serialized by the caller, while `match` can be called concurrently with them:
+    a tree is built under a lock (shared by all the sets) and is never modified after it's built.
+    """
+
+    fanout = 16
+
+    # backreferences and conditionals refer to groups by number that changes when regexps are combined
+    _backref = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.regexps = {}
+        # (singles, tree) or None if it should be built
+        self._built = None
+
+    def add(self, regex, uid):
+        """
+        Add a regex (compiled or its source) that belongs to a policy with the given uid.
+        """
+        uids = self.regexps.get(regex)
+        if uids is None:
+            with self._lock:
+                uids = self.regexps[regex] = set()
+                self._built = None
+        uids.add(uid)
+
+    def remove(self, regex, uid):
+        """
+        Remove a regex that belongs to a policy with the given uid.
+        """
+        uids = self.regexps.get(regex)
+        if uids is None:
+            return
+        uids.discard(uid)
+        if not uids:
+            with self._lock:
+                del self.regexps[regex]
+                self._built = None
+
+    def match(self, what):
+        """
+        Get uids of policies that have regexps matching the given string.
+        """
+        built = self._built
+        if built is None:
+            with self._lock:
+                if self._built is None:
+                    self._built = self._build()
+                built = self._built
+        singles, tree = built
+        found = set()
+        for regex, uids in singles:
+            if regex.match(what):
+                found.update(uids)
+        stack = list(tree)
+        while stack:
+            node = stack.pop()
+            regex, children, uids = node
+            if isinstance(regex, str):
+                regex = node[0] = re.compile(regex)
+            if regex is not None and not regex.match(what):
+                continue
+            if children is None:
+                found.update(uids)
+            else:
+                stack.extend(children)
+        return found
+
+    def _build(self):
+        combinable, singles = [], []
+        for regex, uids in self.regexps.items():
+            pattern = self._pattern(regex)
+            if self._backref.search(pattern):
+                singles.append((re.compile(pattern), uids))
+            else:
+                # leaves are compiled only when their parent matches
+                combinable.append([regex, None, uids])
+        return singles, self._build_level(combinable)
+
+    def _build_level(self, nodes):
+        """
+        Group nodes under parent nodes until there are no more than `fanout` of them at the top.
+        """
+        while len(nodes) > self.fanout:
+            nodes = [self._combine(nodes[i:i+self.fanout]) for i in range(0, len(nodes), self.fanout)]
+        return nodes
+
+    @classmethod
+    def _combine(cls, children):
+        regex = None
+        if all(child[0] is not None for child in children):
+            try:
+                regex = re.compile('|'.join('(?:%s)' % cls._pattern(child[0]) for child in children))
+            except re.error:
+                pass
+        return [regex, children, None]
+
+    @staticmethod
+    def _pattern(regex):
+        return regex if isinstance(regex, str) else regex.pattern
+
+
+class RegexTrie:
+    """
+    Prefix trie over literal prefixes of tag-delimited regexps, e.g. 'library:books:' for 'library:books:<.+>'.
+
+    Each node keeps regexps that have the node's literal prefix in RegexSets grouped by their literal suffix,
+    so only regexps whose literal prefix and suffix fit a string are scanned.
+    """
+
+    class Node:
+        __slots__ = ('children', 'sets')
+
+        def __init__(self):
+            self.children = {}
+            self.sets = {}
+
+    def __init__(self):
+        self.root = self.Node()
+
+    def add(self, entry, uid):
+        """
+        Add a (regex, prefix, suffix) entry (regex is compiled or its source)
+        that belongs to a policy with the given uid.
+        """
+        regex, prefix, suffix = entry
+        node = self.root
+        for char in prefix:
+            node = node.children.setdefault(char, self.Node())
+        node.sets.setdefault(suffix, RegexSet()).add(regex, uid)
+
+    def remove(self, entry, uid):
+        """
+        Remove a (regex, prefix, suffix) entry that belongs to a policy with the given uid.
+        """
+        regex, prefix, suffix = entry
+        path, node = [], self.root
+        for char in prefix:
+            path.append((node, char))
+            node = node.children.get(char)
+            if node is None:
+                return
+        regex_set = node.sets.get(suffix)
+        if regex_set is None:
+            return
+        regex_set.remove(regex, uid)
+        if regex_set.regexps:
+            return
+        del node.sets[suffix]
+        # prune the nodes that are left empty
+        for parent, char in reversed(path):
+            if node.sets or node.children:
+                break
+            del parent.children[char]
+            node = parent
+
+    def match(self, what):
+        """
+        Get uids of policies that have regexps matching the given string.
+        """
+        found = set()
+        node = self.root
+        for i in range(len(what) + 1):
+            for suffix, regex_set in node.sets.items():
+                # `$` also matches before a trailing newline
+                if what.endswith(suffix) or what.endswith(suffix + '\n'):
+                    found |= regex_set.match(what)
+            if i == len(what):
+                break
+            node = node.children.get(what[i])
+            if node is None:
+                break
+        return found
+
+
+class SubstringIndex:
+    """
+    Index of strings by their n-grams that finds all the strings containing a given substring.
+
+    Multi-pattern automatons (e.g. Aho-Corasick) find known patterns in a given text. Here it's the other way round:
+    texts (policies' values) are known in advance and a pattern (inquiry's value) is given, so strings are found
+    through an inverted index of all their substrings of length up to `n` and then verified.
+    The inverted index is built on the first search, so it takes no memory if strings are never searched.
+
+    Modifications should be serialized by the caller, while `match` can be called concurrently with them:
+    the inverted index is built and modified under a lock (shared by all the indexes).
+    """
+
+    n = 3
+
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.values = {}
+        self.grams = None
+
+    def add(self, value, uid):
+        """
+        Add a string value that belongs to a policy with the given uid.
+        """
+        uids = self.values.get(value)
+        if uids is None:
+            with self._lock:
+                uids = self.values[value] = set()
+                if self.grams is not None:
+                    self._add_grams(self.grams, value)
+        uids.add(uid)
+
+    def remove(self, value, uid):
+        """
+        Remove a string value that belongs to a policy with the given uid.
+        """
+        uids = self.values.get(value)
+        if uids is None:
+            return
+        uids.discard(uid)
+        if uids:
+            return
+        with self._lock:
+            del self.values[value]
+            if self.grams is None:
+                return
+            for gram in self._grams(value):
+                values = self.grams[gram]
+                values.discard(value)
+                if not values:
+                    del self.grams[gram]
+
+    def match(self, what):
+        """
+        Get uids of policies that have values containing the given string.
+        """
+        grams = self.grams
+        if grams is None:
+            with self._lock:
+                if self.grams is None:
+                    grams = {}
+                    for value in self.values:
+                        self._add_grams(grams, value)
+                    self.grams = grams
+                grams = self.grams
+        if not what:
+            candidates = self.values
+        else:
+            size = min(len(what), self.n)
+            candidates = None
+            for i in range(len(what) - size + 1):
+                values = grams.get(what[i:i+size])
+                if not values:
+                    return set()
+                if candidates is None or len(values) < len(candidates):
+                    candidates = values
+        found = set()
+        for value in candidates:
+            if what in value:
+                found |= self.values[value]
+        return found
+
+    def _add_grams(self, grams, value):
+        for gram in self._grams(value):
+            grams.setdefault(gram, set()).add(value)
+
+    def _grams(self, value):
+        """
+        Get all distinct substrings of a value of length up to `n`.
+        """
+        return {value[i:i+size] for size in range(1, self.n + 1) for i in range(len(value) - size + 1)}
@@ -2,10 +2,15 @@
 Memory storage for Policies.
 """
 
+import gc
 import threading
 import logging
+from contextlib import contextmanager
 
-from ..storage.abc import Storage
+from ..storage.abc import Storage, AsyncStorage, BulkResult, _first_after, _CONVERSION_ERRORS
+from ..storage.index import PolicyIndex
+from ..storage.snapshot import read_snapshot
+from ..storage.table import PolicyTable, _read_consistent
 from ..exceptions import PolicyExistsError
 
 
@@ -13,11 +18,49 @@ log = logging.getLogger(__name__)
 
 
 class MemoryStorage(Storage):
-    """Stores all policies in memory"""
+    """
+    Stores all policies in memory.
+
+    Policies are indexed by literal values and pinned Rules of their subjects, actions and resources
+    (see PolicyIndex), so that for vakt's checkers only relevant policies are returned by `find_for_inquiry`.
+    Since index is built on `add` and `update`, a modified policy should always be passed to `update`.
+
+    Reads take no lock and are safe while policies are modified. Modifications are serialized by a lock.
+    Policies are kept in a PolicyTable that can be read and iterated concurrently with modifications.
+    Index is modified in place under a version counter: a read of the index is retried
+    if a modification overlapped it and is done under the lock after `read_attempts` unsuccessful attempts.
+    """
+
+    read_attempts = 3
+    supports_get_after = True
 
     def __init__(self):
-        self.policies = {}
+        self.policies = PolicyTable()
+        self.index = PolicyIndex()
         self.lock = threading.Lock()
+        # odd while the index is being modified
+        self.version = 0
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Create storage from a snapshot file made by `vakt.storage.snapshot.export_snapshot`.
+        Storage is indexed right away, but policies are decoded from the memory-mapped snapshot
+        only when they are accessed for the first time.
+        """
+        storage = cls()
+        # loading creates millions of acyclic objects: garbage collector passes would just slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            storage.policies, index_data = read_snapshot(path)
+            for uid, keys, entries in index_data:
+                storage.index.add_data(uid, keys, entries)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        log.info('Loaded %d policies from snapshot %s', len(storage.policies), path)
+        return storage
 
     def add(self, policy):
         uid = policy.uid
@@ -25,7 +68,9 @@ class MemoryStorage(Storage):
             if uid in self.policies:
                 log.error('Error trying to create already existing policy with UID=%s', uid)
                 raise PolicyExistsError(uid)
-            self.policies[uid] = policy
+            with self._modifying():
+                self.policies[uid] = policy
+                self.index.add(policy)
             log.info('Added Policy: %s', policy)
 
     def get(self, uid):
@@ -33,23 +78,165 @@ class MemoryStorage(Storage):
 
     def get_all(self, limit, offset):
         self._check_limit_and_offset(limit, offset)
-        result = [v for v in self.policies.values()]
+        result = self.policies.values()
         if offset > len(result) or limit == 0:
             return []
         return result[offset:limit+offset]
 
+    def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return []
+        return _first_after(self.policies.values(), last_uid, limit)
+
     def find_for_inquiry(self, inquiry, checker=None):
-        with self.lock:
-            return self.policies.values()
+        return _read_consistent(self, self._find, inquiry, checker)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self.index.filter_key(inquiry, checker)
 
     def update(self, policy):
         with self.lock:
             if policy.uid not in self.policies:
                 return
-            self.policies[policy.uid] = policy
+            with self._modifying():
+                self.policies[policy.uid] = policy
+                self.index.add(policy)
         log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
 
     def delete(self, uid):
-        if uid in self.policies:
-            del self.policies[uid]
-            log.info('Policy with UID %s was deleted', uid)
+        with self.lock:
+            if uid not in self.policies:
+                return
+            with self._modifying():
+                del self.policies[uid]
+                self.index.remove(uid, forget=True)
+        log.info('Policy with UID %s was deleted', uid)
+
+    def add_many(self, policies):
+        result = BulkResult()
+        # lock is taken once, while each policy is modified in a window of its own, so readers aren't held off
+        with self.lock:
+            for policy in policies:
+                uid = policy.uid
+                # index data is obtained beforehand, so a failed policy leaves nothing behind
+                try:
+                    if uid in self.policies:
+                        raise PolicyExistsError(uid)
+                    keys, entries = self.index.index_data(policy)
+                except (PolicyExistsError,) + _CONVERSION_ERRORS as e:
+                    log.error('Error trying to add policy with UID=%s: %s', uid, e)
+                    result.fail(uid, e)
+                    continue
+                with self._modifying():
+                    self.policies[uid] = policy
+                    self.index.add_data(uid, keys, entries)
+                result.succeed(uid)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    def update_many(self, policies):
+        result = BulkResult()
+        with self.lock:
+            for policy in policies:
+                uid = policy.uid
+                try:
+                    # non-existing policies are skipped as `update` does
+                    if uid not in self.policies:
+                        result.succeed(uid)
+                        continue
+                    keys, entries = self.index.index_data(policy)
+                except _CONVERSION_ERRORS as e:
+                    log.error('Error trying to update policy with UID=%s: %s', uid, e)
+                    result.fail(uid, e)
+                    continue
+                with self._modifying():
+                    self.policies[uid] = policy
+                    self.index.add_data(uid, keys, entries)
+                result.succeed(uid)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    def delete_many(self, uids):
+        result = BulkResult()
+        with self.lock:
+            for uid in uids:
+                if uid in self.policies:
+                    with self._modifying():
+                        del self.policies[uid]
+                        self.index.remove(uid, forget=True)
+                result.succeed(uid)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    @contextmanager
+    def _modifying(self):
+        """
+        Modify policies and the index under the version counter. Should be used under the lock.
+        """
+        self.version += 1
+        try:
+            yield
+        finally:
+            self.version += 1
+
+    def _find(self, inquiry, checker):
+        uids = self.index.find(inquiry, checker)
+        if uids is None:
+            return self.policies.values()
+        policies = self.policies
+        return [policies[uid] for uid in uids]
+
+
+class AsyncMemoryStorage(AsyncStorage):
+    """
+    Stores all policies in memory.
+    Asyncio version of MemoryStorage. Since there is no I/O, it never yields control to the event loop.
+    """
+
+    supports_get_after = True
+
+    def __init__(self):
+        self.storage = MemoryStorage()
+
+    @classmethod
+    def from_snapshot(cls, path):
+        """
+        Create storage from a snapshot file. See `MemoryStorage.from_snapshot`.
+        """
+        storage = cls()
+        storage.storage = MemoryStorage.from_snapshot(path)
+        return storage
+
+    async def add(self, policy):
+        self.storage.add(policy)
+
+    async def get(self, uid):
+        return self.storage.get(uid)
+
+    async def get_all(self, limit, offset):
+        return self.storage.get_all(limit, offset)
+
+    async def get_after(self, last_uid, limit):
+        return self.storage.get_after(last_uid, limit)
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        return self.storage.find_for_inquiry(inquiry, checker)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self.storage.inquiry_filter_key(inquiry, checker)
+
+    async def update(self, policy):
+        self.storage.update(policy)
+
+    async def delete(self, uid):
+        self.storage.delete(uid)
+
+    async def add_many(self, policies):
+        return self.storage.add_many(policies)
+
+    async def update_many(self, policies):
+        return self.storage.update_many(policies)
+
+    async def delete_many(self, uids):
+        return self.storage.delete_many(uids)
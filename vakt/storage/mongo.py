@@ -4,18 +4,23 @@ MongoDB Storage and Migrations for Policies.
 
 import logging
 import copy
+import inspect
 from abc import ABCMeta
 
 import bson.json_util as b_json
 import pymongo
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, BulkWriteError, WriteError, PyMongoError
 import jsonpickle.tags
 
-from ..storage.abc import Storage
+from ..storage.abc import Storage, AsyncStorage, BulkResult, _chunks, _fields_filter_key, _CONVERSION_ERRORS
 from ..storage.migration import Migration, MigrationSet
-from ..exceptions import PolicyExistsError, UnknownCheckerType, Irreversible
-from ..policy import Policy
+from ..exceptions import PolicyExistsError, PolicyCreationError, UnknownCheckerType, Irreversible
+from ..policy import Policy, _props_from_json
+from .. import codec
 from ..rules.base import Rule
+from ..rules.operator import Eq, Greater, Less, GreaterOrEqual, LessOrEqual
+from ..rules.list import In
+from ..rules.string import Equal, StartsWith
 from ..checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
 from ..policy import TYPE_STRING_BASED, TYPE_RULE_BASED
 from ..parser import compile_regex
@@ -27,84 +32,67 @@ DEFAULT_MIGRATION_COLLECTION = 'vakt_policies_migration_version'
 log = logging.getLogger(__name__)
 
 
-class MongoStorage(Storage):
-    """Stores all policies in MongoDB"""
+class MongoQueryMixin:
+    """
+    Building of MongoDB queries and documents for Policies.
+    Is shared by sync and async MongoDB Storages.
+    """
 
-    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION):
+    # number of UIDs that `delete_many` puts in a single query
+    bulk_size = 1000
+
+    # inquiry strings that are longer are not checked against `StartsWith` rules on the DB side
+    max_prefix_check_length = 256
+
+    def _init_collection(self, client, db_name, collection):
         self.client = client
         self.database = self.client[db_name]
         self.collection = self.database[collection]
-        self.db_server_version = tuple(map(int, client.server_info()['version'].split('.')))
+        self.db_server_version = None
         self.condition_fields = [
             'actions',
             'subjects',
             'resources',
         ]
         self.condition_field_compiled_name = lambda x: '%s_compiled_regex' % x
+        self.condition_field_rules_name = lambda x: '%s_rules' % x
 
-    def add(self, policy):
-        try:
-            self.collection.insert_one(self.__prepare_doc(policy))
-        except DuplicateKeyError:
-            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
-            raise PolicyExistsError(policy.uid)
-        log.info('Added Policy: %s', policy)
-
-    def get(self, uid):
-        ret = self.collection.find_one(uid)
-        if not ret:
-            return None
-        return self.__prepare_from_doc(ret)
-
-    def get_all(self, limit, offset):
-        self._check_limit_and_offset(limit, offset)
-        # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
-        if limit == 0:
-            return []
-        cur = self.collection.find(limit=limit, skip=offset, sort=[('_id', pymongo.ASCENDING)])
-        return self.__feed_policies(cur)
-
-    def find_for_inquiry(self, inquiry, checker=None):
-        q_filter, use_aggregation = self._create_filter(inquiry, checker)
-        if use_aggregation:
-            cur = self.collection.aggregate(q_filter)
-        else:
-            cur = self.collection.find(q_filter)
-        return self.__feed_policies(cur)
-
-    def update(self, policy):
-        uid = policy.uid
-        self.collection.update_one(
-            {'_id': uid},
-            {"$set": self.__prepare_doc(policy)},
-            upsert=False)
-        log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
-
-    def delete(self, uid):
-        self.collection.delete_one({'_id': uid})
-        log.info('Deleted Policy with UID=%s.', uid)
+    @staticmethod
+    def _parse_server_version(server_info):
+        return tuple(map(int, server_info['version'].split('.')))
 
     def _create_filter(self, inquiry, checker):
         """
         Returns proper query-filter based on the checker type and a flag that marks whether aggregation should be used
         """
         if isinstance(checker, StringFuzzyChecker):
-            return self.__string_query_on_conditions('$regex', inquiry), False
+            return self._string_query_on_conditions('$regex', inquiry), False
         elif isinstance(checker, StringExactChecker):
-            return self.__string_query_on_conditions('$eq', inquiry), False
+            return self._string_query_on_conditions('$eq', inquiry), False
         elif isinstance(checker, RegexChecker):
             if self.db_server_version < (4, 2, 0):
                 return {'type': TYPE_STRING_BASED}, False
-            return self.__regex_query_on_conditions(inquiry), True
+            return self._regex_query_on_conditions(inquiry), True
         elif isinstance(checker, RulesChecker):
-            return {'type': TYPE_RULE_BASED}, False
+            return self._rules_query_on_conditions(inquiry), False
         elif not checker:
             return {}, False
         else:
             log.error('Provided Checker type is not supported.')
             raise UnknownCheckerType(checker)
 
-    def __string_query_on_conditions(self, operator, inquiry):
+    def _filter_key(self, inquiry, checker):
+        """
+        Get a key for `inquiry_filter_key` that corresponds to the query-filter built by `_create_filter`.
+        """
+        if not checker:
+            return None
+        if isinstance(checker, RegexChecker) and self.db_server_version is not None \
+                and self.db_server_version < (4, 2, 0):
+            return None
+        return _fields_filter_key(inquiry)
+
+    def _string_query_on_conditions(self, operator, inquiry):
         """
         Construct MongoDB query for string-based Checkers.
         """
@@ -121,7 +109,7 @@ class MongoStorage(Storage):
             })
         return {"$and": conditions}
 
-    def __regex_query_on_conditions(self, inquiry):
+    def _regex_query_on_conditions(self, inquiry):
         """
         Construct MongoDB query for RegexChecker.
         """
@@ -158,12 +146,115 @@ class MongoStorage(Storage):
             })
         return [{'$match': {'$expr': {'$and': conditions}}}]
 
-    def __prepare_doc(self, policy):
+    def _rules_query_on_conditions(self, inquiry):
+        """
+        Construct MongoDB query for RulesChecker.
+        Policy is returned if each of its fields has an item whose projection (see `_rules_projection`)
+        has all its keys in inquiry's data and none of its constraints is violated by inquiry's data.
+        Policies that were saved without projections are always returned.
+        """
+        conditions = [
+            {'type': TYPE_RULE_BASED}
+        ]
+        for field in self.condition_fields:
+            what = getattr(inquiry, field.rstrip('s'))
+            if isinstance(what, dict):
+                keys = [key for key in what if isinstance(key, str)]
+                pairs = [(key, what[key]) for key in keys]
+            else:
+                keys, pairs = [], [(None, what)]
+            item_query = {'keys': {'$not': {'$elemMatch': {'$nin': keys}}}}
+            violations = [dict(violation, key=key) for key, value in pairs for violation in self._violations(value)]
+            if isinstance(what, dict):
+                # Rules that are projected never compare equal to or order with dictionaries
+                violations.append({'key': None})
+            if violations:
+                item_query['constraints'] = {'$not': {'$elemMatch': {'$or': violations}}}
+            name = self.condition_field_rules_name(field)
+            conditions.append({
+                '$or': [
+                    {name: {'$exists': False}},
+                    {name: {'$elemMatch': item_query}},
+                ]
+            })
+        return {'$and': conditions}
+
+    def _violations(self, value):
+        """
+        Get conditions on constraints (see `_rule_constraint`) that the given inquiry value violates.
+        Values are compared only if MongoDB compares them the same way as Python does.
+        """
+        if not isinstance(value, str):
+            violations = [{name: {'$exists': True}} for name in ('ieq', 'prefix', 'iprefix')]
+        else:
+            lower = value.lower()
+            violations = [{'ieq': {'$exists': True, '$ne': lower}}]
+            if len(value) <= self.max_prefix_check_length:
+                violations.append({'prefix': {'$exists': True, '$nin': _prefixes(value)}})
+                violations.append({'iprefix': {'$exists': True, '$nin': _prefixes(lower)}})
+        if _is_plain(value):
+            violations.extend([
+                {'eq': {'$exists': True, '$ne': value}},
+                {'in': {'$exists': True, '$ne': value}},
+                {'gt': {'$gte': value}},
+                {'gte': {'$gt': value}},
+                {'lt': {'$lte': value}},
+                {'lte': {'$lt': value}},
+            ])
+        return violations
+
+    def _rules_projection(self, items):
+        """
+        Get a queryable projection of a field of a rule-based policy.
+        Each dictionary of Rules or Rule of the field is projected to a document of:
+          - `keys` - keys of the dictionary that should be present in inquiry's data.
+          - `constraints` - constraints of the simple Rules (see `_rule_constraint`).
+        Rules that can't be projected don't constrain anything, so projection is satisfied by a superset of inquiries.
+        """
+        projection = []
+        for item in items:
+            if isinstance(item, dict):
+                # empty dictionary is never satisfied
+                if not item:
+                    continue
+                keys = [key for key in item if isinstance(key, str)]
+                constraints = [self._rule_constraint(key, item[key]) for key in keys]
+            elif callable(getattr(item, 'satisfied', '')):
+                keys, constraints = [], [self._rule_constraint(None, item)]
+            else:
+                # RulesChecker skips such items
+                continue
+            projection.append({'keys': keys, 'constraints': [c for c in constraints if c is not None]})
+        return projection
+
+    @staticmethod
+    def _rule_constraint(key, rule):
+        """
+        Get a constraint of a Rule on the value of a key of inquiry's data (on the whole data if key is None).
+        Returns None if Rule can't be represented as a constraint.
+        """
+        rule_type = type(rule)
+        operators = {Eq: 'eq', Greater: 'gt', Less: 'lt', GreaterOrEqual: 'gte', LessOrEqual: 'lte'}
+        try:
+            if rule_type in operators and _is_plain(rule.val):
+                return {'key': key, operators[rule_type]: rule.val}
+            if rule_type == In and all(_is_plain(x) for x in rule.data):
+                return {'key': key, 'in': sorted(rule.data, key=lambda x: (isinstance(x, str), x))}
+            if rule_type == Equal:
+                return {'key': key, 'ieq': rule.val.lower()} if rule.ci else {'key': key, 'eq': rule.val}
+            if rule_type == StartsWith:
+                return {'key': key, 'iprefix': rule.val.lower()} if rule.ci else {'key': key, 'prefix': rule.val}
+        # Rules that were restored from documents of older versions might lack some attributes
+        except AttributeError:
+            log.warning('Rule %s can not be projected for DB-side checks', rule)
+        return None
+
+    def _prepare_doc(self, policy):
         """
         Prepare Policy object as a document for insertion.
         """
         # todo - add dict inheritance
-        doc = b_json.loads(policy.to_json())
+        doc = codec.flatten(policy._data())
         if policy.type == TYPE_STRING_BASED:
             for field in self.condition_fields:
                 compiled_regexes = []
@@ -174,10 +265,65 @@ class MongoStorage(Storage):
                         compiled = el
                     compiled_regexes.append(compiled)
                 doc[self.condition_field_compiled_name(field)] = compiled_regexes
+        elif policy.type == TYPE_RULE_BASED:
+            for field in self.condition_fields:
+                doc[self.condition_field_rules_name(field)] = self._rules_projection(getattr(policy, field))
         doc['_id'] = policy.uid
         return doc
 
-    def __prepare_from_doc(self, doc):
+    def _prepare_docs(self, policies, result):
+        """
+        Prepare documents for a bulk write. Policies that can't be converted are reported as failed to result.
+        Returns (UIDs, documents) of the rest of the policies.
+        """
+        uids, docs = [], []
+        for policy in policies:
+            try:
+                docs.append(self._prepare_doc(policy))
+            except _CONVERSION_ERRORS as e:
+                result.fail(policy.uid, e)
+                continue
+            uids.append(policy.uid)
+        return uids, docs
+
+    @staticmethod
+    def _collect_bulk_result(result, uids, error=None):
+        """
+        Report policies of an unordered bulk write to result taking into account errors of BulkWriteError.
+        """
+        errors = {}
+        if error is not None:
+            write_errors = error.details.get('writeErrors')
+            # without errors of specific documents the whole write is failed
+            if not write_errors:
+                raise error
+            for err in write_errors:
+                uid = uids[err['index']]
+                if err.get('code') == 11000:
+                    log.error('Error trying to create already existing policy with UID=%s.', uid)
+                    errors[err['index']] = PolicyExistsError(uid)
+                else:
+                    errors[err['index']] = WriteError(err.get('errmsg'), err.get('code'), err)
+        for i, uid in enumerate(uids):
+            if i in errors:
+                result.fail(uid, errors[i])
+            else:
+                result.succeed(uid)
+        return result
+
+    @staticmethod
+    def _after_filter(last_uid):
+        """
+        Create a filter for policies following the given UID in `_id` order.
+        """
+        if last_uid is None:
+            return {}
+        # MongoDB compares values of the same BSON type only, while numbers go before strings in `_id` order
+        if type(last_uid) in (int, float):
+            return {'$or': [{'_id': {'$gt': last_uid}}, {'_id': {'$type': 'string'}}]}
+        return {'_id': {'$gt': last_uid}}
+
+    def _prepare_from_doc(self, doc):
         """
         Prepare Policy object as a return from MongoDB.
         """
@@ -187,14 +333,245 @@ class MongoStorage(Storage):
             compiled_field_name = self.condition_field_compiled_name(field)
             if compiled_field_name in doc:
                 del doc[compiled_field_name]
-        return Policy.from_json(b_json.dumps(doc))
+            doc.pop(self.condition_field_rules_name(field), None)
+        # document is already JSON-compatible data, so there is no need to dump it and parse again
+        return Policy(**_props_from_json(codec.restore(doc)))
+
+
+class MongoStorage(MongoQueryMixin, Storage):
+    """Stores all policies in MongoDB"""
+
+    supports_get_after = True
+
+    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION):
+        self._init_collection(client, db_name, collection)
+        self.db_server_version = self._parse_server_version(client.server_info())
+
+    def add(self, policy):
+        try:
+            self.collection.insert_one(self._prepare_doc(policy))
+        except DuplicateKeyError:
+            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+            raise PolicyExistsError(policy.uid)
+        log.info('Added Policy: %s', policy)
+
+    def get(self, uid):
+        ret = self.collection.find_one(uid)
+        if not ret:
+            return None
+        return self._prepare_from_doc(ret)
+
+    def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
+        if limit == 0:
+            return []
+        cur = self.collection.find(limit=limit, skip=offset, sort=[('_id', pymongo.ASCENDING)])
+        return self.__feed_policies(cur)
+
+    def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
+        if limit == 0:
+            return []
+        cur = self.collection.find(self._after_filter(last_uid), limit=limit, sort=[('_id', pymongo.ASCENDING)])
+        return self.__feed_policies(cur)
+
+    def find_for_inquiry(self, inquiry, checker=None):
+        q_filter, use_aggregation = self._create_filter(inquiry, checker)
+        if use_aggregation:
+            cur = self.collection.aggregate(q_filter)
+        else:
+            cur = self.collection.find(q_filter)
+        return self.__feed_policies(cur)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self._filter_key(inquiry, checker)
+
+    def update(self, policy):
+        uid = policy.uid
+        self.collection.update_one(
+            {'_id': uid},
+            {"$set": self._prepare_doc(policy)},
+            upsert=False)
+        log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
+
+    def delete(self, uid):
+        self.collection.delete_one({'_id': uid})
+        log.info('Deleted Policy with UID=%s.', uid)
+
+    def add_many(self, policies):
+        result = BulkResult()
+        uids, docs = self._prepare_docs(policies, result)
+        error = None
+        if docs:
+            try:
+                self.collection.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                error = e
+        self._collect_bulk_result(result, uids, error)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    def update_many(self, policies):
+        result = BulkResult()
+        uids, docs = self._prepare_docs(policies, result)
+        error = None
+        if docs:
+            try:
+                self.collection.bulk_write([
+                    pymongo.UpdateOne({'_id': uid}, {'$set': doc}, upsert=False) for uid, doc in zip(uids, docs)
+                ], ordered=False)
+            except BulkWriteError as e:
+                error = e
+        self._collect_bulk_result(result, uids, error)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(uids, self.bulk_size):
+            self.collection.delete_many({'_id': {'$in': chunk}})
+            self._collect_bulk_result(result, chunk)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
 
     def __feed_policies(self, cursor):
         """
         Yields Policies from the given cursor.
         """
         for doc in cursor:
-            yield self.__prepare_from_doc(doc)
+            yield self._prepare_from_doc(doc)
+
+
+class AsyncMongoStorage(MongoQueryMixin, AsyncStorage):
+    """
+    Stores all policies in MongoDB. Asyncio version of MongoStorage.
+    Accepts asyncio MongoDB client, e.g. pymongo's `AsyncMongoClient` or Motor's `AsyncIOMotorClient`.
+    """
+
+    supports_get_after = True
+
+    def __init__(self, client, db_name, collection=DEFAULT_COLLECTION):
+        self._init_collection(client, db_name, collection)
+
+    async def add(self, policy):
+        try:
+            await self.collection.insert_one(self._prepare_doc(policy))
+        except DuplicateKeyError:
+            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+            raise PolicyExistsError(policy.uid)
+        log.info('Added Policy: %s', policy)
+
+    async def get(self, uid):
+        ret = await self.collection.find_one(uid)
+        if not ret:
+            return None
+        return self._prepare_from_doc(ret)
+
+    async def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
+        if limit == 0:
+            return []
+        cur = self.collection.find(limit=limit, skip=offset, sort=[('_id', pymongo.ASCENDING)])
+        return await self.__fetch_policies(cur)
+
+    async def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        # Special check for: https://docs.mongodb.com/manual/reference/method/cursor.limit/#zero-value
+        if limit == 0:
+            return []
+        cur = self.collection.find(self._after_filter(last_uid), limit=limit, sort=[('_id', pymongo.ASCENDING)])
+        return await self.__fetch_policies(cur)
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        if self.db_server_version is None:
+            self.db_server_version = self._parse_server_version(await self.client.server_info())
+        q_filter, use_aggregation = self._create_filter(inquiry, checker)
+        if use_aggregation:
+            cur = self.collection.aggregate(q_filter)
+        else:
+            cur = self.collection.find(q_filter)
+        return await self.__fetch_policies(cur)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self._filter_key(inquiry, checker)
+
+    async def update(self, policy):
+        uid = policy.uid
+        await self.collection.update_one(
+            {'_id': uid},
+            {"$set": self._prepare_doc(policy)},
+            upsert=False)
+        log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
+
+    async def delete(self, uid):
+        await self.collection.delete_one({'_id': uid})
+        log.info('Deleted Policy with UID=%s.', uid)
+
+    async def add_many(self, policies):
+        result = BulkResult()
+        uids, docs = self._prepare_docs(policies, result)
+        error = None
+        if docs:
+            try:
+                await self.collection.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                error = e
+        self._collect_bulk_result(result, uids, error)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    async def update_many(self, policies):
+        result = BulkResult()
+        uids, docs = self._prepare_docs(policies, result)
+        error = None
+        if docs:
+            try:
+                await self.collection.bulk_write([
+                    pymongo.UpdateOne({'_id': uid}, {'$set': doc}, upsert=False) for uid, doc in zip(uids, docs)
+                ], ordered=False)
+            except BulkWriteError as e:
+                error = e
+        self._collect_bulk_result(result, uids, error)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    async def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(uids, self.bulk_size):
+            await self.collection.delete_many({'_id': {'$in': chunk}})
+            self._collect_bulk_result(result, chunk)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    async def __fetch_policies(self, cursor):
+        """
+        Get Policies from the given async cursor.
+        """
+        # some drivers return a cursor for aggregation only after being awaited
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        return [self._prepare_from_doc(doc) async for doc in cursor]
+
+
+def _is_plain(value):
+    """
+    Is value compared by MongoDB the same way as by Python? Booleans are equal to numbers in Python only.
+    """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 63
+    return isinstance(value, (str, float))
+
+
+def _prefixes(value):
+    """
+    Get all prefixes of a string
+    """
+    return [value[:i] for i in range(len(value) + 1)]
 
 
 ##############
@@ -217,6 +594,7 @@ class MongoMigrationSet(MigrationSet):
             Migration1x1x0To1x1x1(self.storage),
             Migration1x1x1To1x2x0(self.storage),
             Migration1x2x0To1x4x0(self.storage),
+            Migration1x4x0To1x7x0(self.storage),
         ]
 
     def save_applied_number(self, number):
@@ -460,3 +838,38 @@ class Migration1x2x0To1x4x0(MongoMigration):
             self.storage.collection.drop_index(self.index_name(field_name))
         # return policies to their previous state
         self._each_doc(processor=process)
+
+
+class Migration1x4x0To1x7x0(MongoMigration):
+    """
+    Migration between versions 1.4.0 and 1.7.0.
+    What it does:
+    - Adds projections of simple Rules for each rule-based policy that are needed for Rules DB-side checks.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def order(self):
+        return 5
+
+    def up(self):
+        # re-save rule-based policies to add *_rules fields
+        failed = []
+        for doc in self.storage.collection.find({'type': TYPE_RULE_BASED}):
+            # document is modified by the conversion to policy, so its ID is taken beforehand
+            _id = doc['_id']
+            try:
+                self.storage.update(self.storage._prepare_from_doc(doc))
+            except (PolicyCreationError, PyMongoError) + _CONVERSION_ERRORS:
+                log.exception('Unexpected exception occurred while migrating Policy: %s', doc)
+                failed.append(_id)
+        if failed:
+            log.error('Migration was unable to convert some Policies, but they were left in the database as-is. ' +
+                      'They are returned for any inquiry by RulesChecker. Mongo IDs of failed Policies are: %s',
+                      failed)
+
+    def down(self):
+        fields = [self.storage.condition_field_rules_name(x) for x in self.storage.condition_fields]
+        self.storage.collection.update_many({}, {'$unset': {field: '' for field in fields}})
@@ -1,11 +1,49 @@
+import logging
+
 from ..util import Subject
 
 
+__all__ = [
+    'ObservableMutationStorage',
+    'PolicyMutation',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class PolicyMutation:
+    """
+    Event about a policy-set modification that ObservableMutationStorage sends to its observers.
+    Bulk modifications are sent as a list of such events.
+
+    action - what was done: 'add', 'update' or 'delete'
+    uid - UID of the modified policy
+    old - policy as it was in Storage before the modification, None if Storage had no such policy
+          (note that if policy was modified in place before `update` for in-memory Storages it's the same object as new)
+    new - policy after the modification, None for 'delete'
+    """
+    ADD = 'add'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    def __init__(self, action, uid, old, new):
+        self.action = action
+        self.uid = uid
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return '%s(action=%r, uid=%r)' % (type(self).__name__, self.action, self.uid)
+
+
 class ObservableMutationStorage(Subject):
     """
     Wraps Storage.
     Implements mutation part of Storage interface as a notifier of subscribers.
-    Notifies observers when mutation method is called on Storage.
+    Notifies observers when mutation method is called on Storage sending them PolicyMutation event.
+    Bulk methods send a single event for the whole batch: a list of PolicyMutation of the policies
+    that were modified successfully. Nothing is sent if no policy was modified.
     Read part of Storage interface is a simple proxy.
     """
     def __init__(self, storage):
@@ -14,17 +52,41 @@ class ObservableMutationStorage(Subject):
 
     def add(self, policy):
         res = self.storage.add(policy)
-        self.notify()
+        self.notify(PolicyMutation(PolicyMutation.ADD, policy.uid, None, policy))
         return res
 
     def update(self, policy):
+        old = self._get_old(policy.uid)
         res = self.storage.update(policy)
-        self.notify()
+        self.notify(PolicyMutation(PolicyMutation.UPDATE, policy.uid, old, policy))
         return res
 
     def delete(self, uid):
+        old = self._get_old(uid)
         res = self.storage.delete(uid)
-        self.notify()
+        self.notify(PolicyMutation(PolicyMutation.DELETE, uid, old, None))
+        return res
+
+    def add_many(self, policies):
+        policies = list(policies)
+        res = self.storage.add_many(policies)
+        self._notify_batch([PolicyMutation(PolicyMutation.ADD, policy.uid, None, policy)
+                            for policy in res.filter_succeeded(policies)])
+        return res
+
+    def update_many(self, policies):
+        policies = list(policies)
+        old = self._get_many_old(policy.uid for policy in policies)
+        res = self.storage.update_many(policies)
+        self._notify_batch([PolicyMutation(PolicyMutation.UPDATE, policy.uid, old.get(policy.uid), policy)
+                            for policy in res.filter_succeeded(policies)])
+        return res
+
+    def delete_many(self, uids):
+        uids = list(uids)
+        old = self._get_many_old(uids)
+        res = self.storage.delete_many(uids)
+        self._notify_batch([PolicyMutation(PolicyMutation.DELETE, uid, old.get(uid), None) for uid in res.succeeded])
         return res
 
     def get(self, uid):
@@ -33,8 +95,44 @@ class ObservableMutationStorage(Subject):
     def get_all(self, limit, offset):
         return self.storage.get_all(limit, offset)
 
+    def get_after(self, last_uid, limit):
+        return self.storage.get_after(last_uid, limit)
+
+    @property
+    def supports_get_after(self):
+        return self.storage.supports_get_after
+
     def retrieve_all(self, *args, **kwargs):
         return self.storage.retrieve_all(*args, **kwargs)
 
     def find_for_inquiry(self, inquiry, checker=None):
         return self.storage.find_for_inquiry(inquiry, checker)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self.storage.inquiry_filter_key(inquiry, checker)
+
+    def _notify_batch(self, mutations):
+        if mutations:
+            self.notify(mutations)
+
+    def _get_old(self, uid):
+        """
+        Get policy before modification. Failure to get it must not prevent the modification itself.
+        Without listeners nobody needs it, so it isn't fetched.
+        """
+        if not self._listeners:
+            return None
+        try:
+            return self.storage.get(uid)
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception('Error getting Policy with UID=%s before its modification', uid)
+            return None
+
+    def _get_many_old(self, uids):
+        """
+        Get policies before a bulk modification as a dict of UID -> policy.
+        Without listeners nobody needs them, so they aren't fetched.
+        """
+        if not self._listeners:
+            return {}
+        return {uid: self._get_old(uid) for uid in uids}
@@ -2,18 +2,28 @@
 Redis storage for Policies.
 """
 
+import time
+import json
+import asyncio
 import logging
 import pickle
 import itertools
+import threading
 
-from ..storage.abc import Storage
-from ..policy import Policy
-from ..exceptions import PolicyExistsError
+from ..storage.abc import Storage, AsyncStorage, BulkResult, _chunks, _fields_filter_key, _CONVERSION_ERRORS
+from ..storage.migration import Migration, MigrationSet
+from ..policy import Policy, TYPE_STRING_BASED
+from ..checker import StringExactChecker, RegexChecker
+from ..exceptions import PolicyExistsError, PolicyCreationError
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_COLLECTION = 'vakt_policies'
+DEFAULT_MIGRATION_KEY = 'vakt_policies_migration_version'
+
+# errors of serializing a policy to bytes or back by any of the serializers
+_SERIALIZATION_ERRORS = _CONVERSION_ERRORS + (pickle.PickleError, EOFError, ImportError, PolicyCreationError)
 
 
 class JSONSerializer:
@@ -47,31 +57,285 @@ class PickleSerializer:
         return pickle.loads(data, **self.kwargs)
 
 
-class RedisStorage(Storage):
+class RedisQueryMixin:
     """
-    Stores Policies in Redis.
+    Building of Redis index keys and queries for Policies.
+    Is shared by sync and async Redis Storages.
 
-    Stores all policies in a single hash whose name is a `collection` argument.
-    Each filed in this hash is a Policy's UID and the value of this key is a serialized Policy representation.
+    Besides the hash of policies, string-based policies are indexed in Redis sets of UIDs:
+    `<collection>:index:<field>:value:<value>` - policies that have the value in their field
+    (without tags if the value is wrapped in them), `<collection>:index:<field>:regex` - policies that have
+    a regex in their field, `<collection>:index:<field>:scan` - policies that have an empty value in their field,
+    they are returned for any inquiry. `<collection>:index` hash keeps the list of index keys of each policy.
+    All UIDs are kept in `<collection>:uids` sorted set with the same score, so they are ordered lexicographically.
+
+    Lua scripts get all the keys they touch in KEYS, so on Redis Cluster they work as long as all the keys
+    are in the same slot: use a collection name with a hash tag for this, e.g. `{vakt_policies}`.
     """
 
     class Scripts:
         """
         Helper class to register and store Redis Lua scripts.
+        Scripts modify the hash of policies and the index atomically.
+        KEYS are: the hash of policies, the hash of policies index keys, the sorted set of UIDs,
+        index sets the policy is put to, index sets the policy is kept in now.
+        ARGV are: UID, JSON list of index sets the policy is put to, JSON list of index sets the policy is kept in
+        as it was read from the hash of policies index keys ('' if there is none), serialized policy.
+        If the index sets the policy is kept in were changed since they were read, scripts return -1.
         """
+        # is called after a policy was changed, might be redefined to track changes
+        hooks = """
+            local function changed(uid)
+            end
+            """
+        functions = """
+            local put_keys = cjson.decode(ARGV[2])
+            local kept_count = ARGV[3] == '' and 0 or #cjson.decode(ARGV[3])
+            local first_put = #KEYS - kept_count - #put_keys + 1
+            local function is_stale(uid)
+                return (redis.call('HGET', KEYS[2], uid) or '') ~= ARGV[3]
+            end
+            local function unindex(uid)
+                for i = first_put + #put_keys, #KEYS do
+                    redis.call('SREM', KEYS[i], uid)
+                end
+                redis.call('HDEL', KEYS[2], uid)
+            end
+            local function index(uid)
+                for i = first_put, first_put + #put_keys - 1 do
+                    redis.call('SADD', KEYS[i], uid)
+                end
+                redis.call('HSET', KEYS[2], uid, ARGV[2])
+            end
+            """
+        # stops a script that modifies a policy if there's no such policy or its index keys are stale
+        existing = """
+            if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+                return 0
+            end
+            if is_stale(ARGV[1]) then
+                return -1
+            end
+            """
+        # gets serialized policies of the given UIDs from the hash of policies
+        fetch = """
+            local function fetch(uids)
+                if #uids == 0 then
+                    return {}
+                end
+                local result = {}
+                for _, data in ipairs(redis.call('HMGET', KEYS[1], unpack(uids))) do
+                    if data then
+                        result[#result + 1] = data
+                    end
+                end
+                return result
+            end
+            """
+
         def __init__(self, client):
-            self.updater = client.register_script("""
-                local exists = redis.call('HEXISTS', KEYS[1], ARGV[1])
-                if exists == 1 then
-                    return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+            self.adder = client.register_script(self.functions + self.hooks + """
+                if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[4]) == 1 then
+                    redis.call('ZADD', KEYS[3], 0, ARGV[1])
+                    index(ARGV[1])
+                    changed(ARGV[1])
+                    return 1
                 end
                 return 0
                 """)
+            self.updater = client.register_script(self.functions + self.hooks + self.existing + """
+                redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+                unindex(ARGV[1])
+                index(ARGV[1])
+                changed(ARGV[1])
+                return 1
+                """)
+            self.deleter = client.register_script(self.functions + self.hooks + self.existing + """
+                redis.call('HDEL', KEYS[1], ARGV[1])
+                redis.call('ZREM', KEYS[3], ARGV[1])
+                unindex(ARGV[1])
+                changed(ARGV[1])
+                return 1
+                """)
+            # same as updater, but doesn't change the policy itself
+            self.indexer = client.register_script(self.functions + self.existing + """
+                unindex(ARGV[1])
+                index(ARGV[1])
+                return 1
+                """)
+            # KEYS are: the hash of policies, index sets grouped by fields. ARGV is: number of sets per field.
+            # Returns serialized policies that are in the union of sets of each field.
+            self.finder = client.register_script("""
+                local per_field = tonumber(ARGV[1])
+                local found = nil
+                for first = 2, #KEYS, per_field do
+                    local matched = {}
+                    for _, uid in ipairs(redis.call('SUNION', unpack(KEYS, first, first + per_field - 1))) do
+                        if found == nil or found[uid] then
+                            matched[uid] = true
+                        end
+                    end
+                    found = matched
+                end
+                local uids = {}
+                for uid in pairs(found) do
+                    uids[#uids + 1] = uid
+                end
+                local result = {}
+                for i = 1, #uids, 1000 do
+                    for _, data in ipairs(redis.call('HMGET', KEYS[1], unpack(uids, i, math.min(i + 999, #uids)))) do
+                        if data then
+                            result[#result + 1] = data
+                        end
+                    end
+                end
+                return result
+                """)
+            # KEYS are: the hash of policies, the sorted set of UIDs. ARGV are: offset, limit.
+            # Returns serialized policies of a page of UIDs.
+            self.pager = client.register_script(self.fetch + """
+                return fetch(redis.call('ZRANGE', KEYS[2], ARGV[1], ARGV[1] + ARGV[2] - 1))
+                """)
+            # KEYS are: the hash of policies, the sorted set of UIDs. ARGV are: start of UIDs range, limit.
+            # Returns serialized policies of a page of UIDs that go after the given one.
+            self.keyset_pager = client.register_script(self.fetch + """
+                return fetch(redis.call('ZRANGEBYLEX', KEYS[2], ARGV[1], '+', 'LIMIT', 0, ARGV[2]))
+                """)
+
+    # policy fields that are indexed and the corresponding inquiry fields
+    condition_fields = [
+        ('subjects', 'subject'),
+        ('actions', 'action'),
+        ('resources', 'resource'),
+    ]
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        if self._find_keys(inquiry, checker) is None:
+            # all policies are returned
+            return None
+        return _fields_filter_key(inquiry)
+
+    def _find_keys(self, inquiry, checker):
+        """
+        Get index sets to find policies by: (keys, number of keys per field).
+        Returns None if all the policies should be returned.
+        """
+        if isinstance(checker, StringExactChecker):
+            regex = False
+        elif isinstance(checker, RegexChecker):
+            regex = True
+        else:
+            return None
+        keys = []
+        for field, inquiry_field in self.condition_fields:
+            value = getattr(inquiry, inquiry_field)
+            # checkers don't handle non-string values, let them decide what to do with them
+            if not isinstance(value, str):
+                return None
+            keys.append(self._value_key(field, value))
+            keys.append(self._scan_key(field))
+            if regex:
+                keys.append(self._regex_key(field))
+        return keys, 3 if regex else 2
+
+    def _index_keys(self, policy):
+        """
+        Get keys of index sets a policy belongs to.
+        Rule-based policies never fit string-based checkers, so they are not indexed.
+        """
+        if policy.type != TYPE_STRING_BASED:
+            return []
+        keys = set()
+        for field, _ in self.condition_fields:
+            for value in getattr(policy, field):
+                # checkers skip non-string values
+                if not isinstance(value, str):
+                    continue
+                # checkers fail on empty values, so let them decide what to do with them
+                if not value:
+                    keys.add(self._scan_key(field))
+                    continue
+                if policy.start_tag == value[0] and policy.end_tag == value[-1]:
+                    keys.add(self._value_key(field, value[1:-1]))
+                else:
+                    keys.add(self._value_key(field, value))
+                if policy.start_tag in value or policy.end_tag in value:
+                    keys.add(self._regex_key(field))
+        return sorted(keys)
+
+    def _index_key(self):
+        return '%s:index' % self.collection
+
+    def _uids_key(self):
+        return '%s:uids' % self.collection
+
+    @staticmethod
+    def _uids_after(last_uid):
+        """
+        Get start of a lexicographical range of the sorted set of UIDs that go after the given one.
+        """
+        return '-' if last_uid is None else '(%s' % last_uid
+
+    def _value_key(self, field, value):
+        return '%s:index:%s:value:%s' % (self.collection, field, value)
+
+    def _regex_key(self, field):
+        return '%s:index:%s:regex' % (self.collection, field)
+
+    def _scan_key(self, field):
+        return '%s:index:%s:scan' % (self.collection, field)
+
+    def _script_keys(self):
+        """
+        Keys Lua scripts operate on besides the index sets.
+        """
+        return [self.collection, self._index_key(), self._uids_key()]
+
+    def _policy_call(self, policy, stored=None):
+        """
+        Get (keys, args) of a Lua script that adds or updates a policy.
+        """
+        return self._script_call(policy.uid, self._index_keys(policy), stored, self.sr.serialize(policy))
+
+    def _delete_call(self, uid, stored=None):
+        """
+        Get (keys, args) of a Lua script that deletes a policy.
+        """
+        return self._script_call(uid, [], stored)
+
+    def _script_call(self, uid, index_keys, stored, *args):
+        """
+        Get (keys, args) of a Lua script that modifies a policy.
+        `stored` is the value of the hash of policies index keys for the policy as it was read from Redis.
+        """
+        kept_keys = json.loads(stored) if stored else []
+        keys = self._script_keys() + index_keys + kept_keys
+        return keys, [uid, json.dumps(index_keys, ensure_ascii=False), stored or ''] + list(args)
+
+
+class RedisStorage(RedisQueryMixin, Storage):
+    """
+    Stores Policies in Redis.
+
+    Stores all policies in a single hash whose name is a `collection` argument.
+    Each filed in this hash is a Policy's UID and the value of this key is a serialized Policy representation.
+    String-based policies are also indexed in Redis sets (see RedisQueryMixin), so for StringExactChecker and
+    RegexChecker only relevant policies are returned by `find_for_inquiry`.
+
+    If `ordered` is True, `get_all` returns policies ordered by UIDs and fetches only the requested page.
+    `get_after` always pages by the sorted set of UIDs.
+    Otherwise the order of the hash is used that isn't stable between calls if the hash is modified.
+    """
 
-    def __init__(self, client, collection=DEFAULT_COLLECTION, serializer=None):
+    # number of policies that bulk methods send in a single pipeline
+    bulk_size = 1000
+    supports_get_after = True
+
+    def __init__(self, client, collection=DEFAULT_COLLECTION, serializer=None, ordered=False):
         self.client = client
         self.collection = collection
         self.sr = serializer
+        self.ordered = ordered
         self.scripts = self.Scripts(client)
         if serializer is None:
             self.sr = PickleSerializer()
@@ -79,7 +343,8 @@ class RedisStorage(Storage):
     def add(self, policy):
         uid = policy.uid
         try:
-            done = self.client.hsetnx(self.collection, uid, self.sr.serialize(policy))
+            keys, args = self._policy_call(policy)
+            done = self.scripts.adder(keys=keys, args=args)
             if done == 0:
                 log.error('Error trying to create already existing policy with UID=%s.', uid)
                 raise PolicyExistsError(uid)
@@ -95,24 +360,54 @@ class RedisStorage(Storage):
         return self.sr.deserialize(ret)
 
     def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        if self.ordered:
+            return self.__feed_policies(self._get_page(limit, offset))
         # According to docs https://redis.io/commands/scan#the-count-option
         # Redis doesn't guarantee the exact number of elements returned,
         # so we opt to fetching all data and manual slicing on the client side.
-        self._check_limit_and_offset(limit, offset)
         data = self.client.hgetall(self.collection)
-        sliced = itertools.islice(data.items(), offset, limit+offset)
-        return self.__feed_policies(dict(sliced))
+        sliced = itertools.islice(data.values(), offset, limit+offset)
+        return self.__feed_policies(sliced)
+
+    def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return []
+        keys = [self.collection, self._uids_key()]
+        return self.__feed_policies(self.scripts.keyset_pager(keys=keys, args=[self._uids_after(last_uid), limit]))
+
+    def retrieve_all(self, batch=50):
+        """
+        Retrieve all the policies with HSCAN that fetches about `batch` policies per call.
+        A policy that was modified during the scan might be returned in its old or new version,
+        a policy that was added or deleted during the scan might be returned or not.
+        HSCAN might return a policy more than once if the hash is resized during the scan,
+        so callers that need each policy once skip the repeated UIDs (as `EnfoldCache.populate`, `export_snapshot`
+        and `CompiledGuard` do) or use `ordered` storage: it pages policies by the sorted set of UIDs instead.
+
+        Returns generator
+        """
+        if self.ordered:
+            yield from super().retrieve_all(batch)
+            return
+        for _, data in self.client.hscan_iter(self.collection, count=batch):
+            yield self.sr.deserialize(data)
 
     def find_for_inquiry(self, inquiry, checker=None):
+        query = self._find_keys(inquiry, checker)
+        if query is not None:
+            keys, per_field = query
+            return self.__feed_policies(self.scripts.finder(keys=[self.collection] + keys, args=[per_field]))
         data = self.client.hgetall(self.collection)
         if not data:
             return []
-        return self.__feed_policies(data)
+        return self.__feed_policies(data.values())
 
     def update(self, policy):
         uid = policy.uid
         try:
-            res = self.scripts.updater(keys=[self.collection], args=[uid, self.sr.serialize(policy)])
+            res = self._modify(self.scripts.updater, uid, self._policy_call, policy)
             if res == 1:
                 log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
         except Exception as e:
@@ -120,15 +415,608 @@ class RedisStorage(Storage):
             raise e
 
     def delete(self, uid):
-        res = self.client.hdel(self.collection, uid)
+        res = self._modify(self.scripts.deleter, uid, self._delete_call, uid)
+        if res == 0:
+            log.info('Nothing to delete by UID=%s', uid)
+        else:
+            log.info('Deleted Policy with UID=%s', uid)
+
+    def add_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(((p.uid, p) for p in policies), self.bulk_size):
+            _collect_added(result, *self._pipe_calls(chunk, itertools.repeat(None), result, self._policy_call,
+                                                     self.scripts.adder))
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    def update_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(((p.uid, p) for p in policies), self.bulk_size):
+            self._modify_many(chunk, result, self._policy_call, self.scripts.updater)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(((uid, uid) for uid in uids), self.bulk_size):
+            self._modify_many(chunk, result, self._delete_call, self.scripts.deleter)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    def _modify(self, script, uid, call, item):
+        """
+        Run a Lua script that modifies a policy with the index keys stored for it.
+        Script is run again if they were changed concurrently.
+        """
+        while True:
+            keys, args = call(item, self.client.hget(self._index_key(), uid))
+            res = script(keys=keys, args=args)
+            if res != -1:
+                return res
+
+    def _modify_many(self, items, result, call, script):
+        """
+        Run a Lua script for each of the (uid, item) pairs in a pipeline with the index keys stored for them.
+        Scripts of the items whose index keys were changed concurrently are run again.
+        """
+        while items:
+            stored = self.client.hmget(self._index_key(), [uid for uid, _ in items])
+            items = _collect_modified(result, *self._pipe_calls(items, stored, result, call, script))
+
+    def _pipe_calls(self, items, stored, result, call, script):
+        """
+        Run a Lua script for each of the (uid, item) pairs in a pipeline, `stored` are the index keys stored for them.
+        Items whose script arguments can't be obtained (e.g. can't be serialized) are reported as failed to result.
+        Returns the queued pairs and the replies to them.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        queued = []
+        for (uid, item), kept in zip(items, stored):
+            try:
+                keys, args = call(item, kept)
+            except _SERIALIZATION_ERRORS as e:
+                result.fail(uid, e)
+                continue
+            script(keys=keys, args=args, client=pipe)
+            queued.append((uid, item))
+        return queued, pipe.execute(raise_on_error=False)
+
+    def _get_page(self, limit, offset):
+        if limit == 0:
+            return []
+        return self.scripts.pager(keys=[self.collection, self._uids_key()], args=[offset, limit])
+
+    def __feed_policies(self, values):
+        """
+        Yields Policies from the given serialized values.
+        """
+        for data in values:
+            yield self.sr.deserialize(data)
+
+
+class AsyncRedisStorage(RedisQueryMixin, AsyncStorage):
+    """
+    Stores Policies in Redis. Asyncio version of RedisStorage.
+    Accepts asyncio Redis client: `redis.asyncio.Redis`.
+
+    Stores all policies in a single hash whose name is a `collection` argument.
+    Each filed in this hash is a Policy's UID and the value of this key is a serialized Policy representation.
+    """
+
+    # number of policies that bulk methods send in a single pipeline
+    bulk_size = 1000
+    supports_get_after = True
+
+    def __init__(self, client, collection=DEFAULT_COLLECTION, serializer=None, ordered=False):
+        self.client = client
+        self.collection = collection
+        self.sr = serializer
+        self.ordered = ordered
+        self.scripts = self.Scripts(client)
+        if serializer is None:
+            self.sr = PickleSerializer()
+
+    async def add(self, policy):
+        uid = policy.uid
+        try:
+            keys, args = self._policy_call(policy)
+            done = await self.scripts.adder(keys=keys, args=args)
+            if done == 0:
+                log.error('Error trying to create already existing policy with UID=%s.', uid)
+                raise PolicyExistsError(uid)
+        except Exception:
+            log.exception('Error trying to create already existing policy with UID=%s.', uid)
+            raise PolicyExistsError(uid)
+        log.info('Added Policy: %s', policy)
+
+    async def get(self, uid):
+        ret = await self.client.hget(self.collection, uid)
+        if not ret:
+            return None
+        return self.sr.deserialize(ret)
+
+    async def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        if self.ordered:
+            values = await self._get_page(limit, offset)
+            return [self.sr.deserialize(v) for v in values]
+        # See RedisStorage.get_all for the reasoning of client-side slicing
+        data = await self.client.hgetall(self.collection)
+        sliced = itertools.islice(data.items(), offset, limit+offset)
+        return [self.sr.deserialize(v) for _, v in sliced]
+
+    async def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        if limit == 0:
+            return []
+        keys = [self.collection, self._uids_key()]
+        values = await self.scripts.keyset_pager(keys=keys, args=[self._uids_after(last_uid), limit])
+        return [self.sr.deserialize(v) for v in values]
+
+    async def retrieve_all(self, batch=50):
+        """
+        Retrieve all the policies with HSCAN. See `RedisStorage.retrieve_all` for details.
+
+        Returns async generator
+        """
+        if self.ordered:
+            async for policy in super().retrieve_all(batch):
+                yield policy
+            return
+        async for _, data in self.client.hscan_iter(self.collection, count=batch):
+            yield self.sr.deserialize(data)
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        query = self._find_keys(inquiry, checker)
+        if query is not None:
+            keys, per_field = query
+            values = await self.scripts.finder(keys=[self.collection] + keys, args=[per_field])
+        else:
+            values = (await self.client.hgetall(self.collection)).values()
+        return [self.sr.deserialize(v) for v in values]
+
+    async def _get_page(self, limit, offset):
+        if limit == 0:
+            return []
+        return await self.scripts.pager(keys=[self.collection, self._uids_key()], args=[offset, limit])
+
+    async def update(self, policy):
+        uid = policy.uid
+        try:
+            res = await self._modify(self.scripts.updater, uid, self._policy_call, policy)
+            if res == 1:
+                log.info('Updated Policy with UID=%s. New value is: %s', uid, policy)
+        except Exception as e:
+            log.exception('Error trying to update policy with UID=%s.', uid)
+            raise e
+
+    async def delete(self, uid):
+        res = await self._modify(self.scripts.deleter, uid, self._delete_call, uid)
         if res == 0:
             log.info('Nothing to delete by UID=%s', uid)
         else:
             log.info('Deleted Policy with UID=%s', uid)
 
-    def __feed_policies(self, data):
+    async def add_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(((p.uid, p) for p in policies), self.bulk_size):
+            queued, replies = await self._pipe_calls(chunk, itertools.repeat(None), result, self._policy_call,
+                                                     self.scripts.adder)
+            _collect_added(result, queued, replies)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    async def update_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(((p.uid, p) for p in policies), self.bulk_size):
+            await self._modify_many(chunk, result, self._policy_call, self.scripts.updater)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    async def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(((uid, uid) for uid in uids), self.bulk_size):
+            await self._modify_many(chunk, result, self._delete_call, self.scripts.deleter)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    async def _modify(self, script, uid, call, item):
+        """
+        Run a Lua script that modifies a policy with the index keys stored for it.
+        See `RedisStorage._modify` for details.
+        """
+        while True:
+            keys, args = call(item, await self.client.hget(self._index_key(), uid))
+            res = await script(keys=keys, args=args)
+            if res != -1:
+                return res
+
+    async def _modify_many(self, items, result, call, script):
+        """
+        Run a Lua script for each of the (uid, item) pairs in a pipeline with the index keys stored for them.
+        See `RedisStorage._modify_many` for details.
+        """
+        while items:
+            stored = await self.client.hmget(self._index_key(), [uid for uid, _ in items])
+            items = _collect_modified(result, *await self._pipe_calls(items, stored, result, call, script))
+
+    async def _pipe_calls(self, items, stored, result, call, script):
+        """
+        Run a Lua script for each of the (uid, item) pairs in a pipeline. See `RedisStorage._pipe_calls` for details.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        queued = []
+        for (uid, item), kept in zip(items, stored):
+            try:
+                keys, args = call(item, kept)
+            except _SERIALIZATION_ERRORS as e:
+                result.fail(uid, e)
+                continue
+            await script(keys=keys, args=args, client=pipe)
+            queued.append((uid, item))
+        return queued, await pipe.execute(raise_on_error=False)
+
+
+class RedisMirrorMixin:
+    """
+    Local in-process mirror of the policies hash.
+    Is shared by sync and async mirrored Redis Storages.
+
+    Every write through a mirrored Storage bumps a version counter kept in `<collection>:version` key
+    and records the version in `<collection>:changes` sorted set of changed hash fields (its size is bounded
+    by the number of distinct policy UIDs). A mirror that is behind the counter fetches only the fields
+    that were changed since its version.
+    """
+
+    class Scripts(RedisQueryMixin.Scripts):
+        """
+        Helper class to register and store Redis Lua scripts that also track changes of the policies hash.
+        Additional KEYS are: the version counter, the sorted set of changes.
+        """
+        hooks = """
+            local function changed(uid)
+                local version = redis.call('INCR', KEYS[4])
+                redis.call('ZADD', KEYS[5], version, uid)
+            end
+            """
+
+    def _init_mirror(self, refresh_interval, timer):
+        self.refresh_interval = refresh_interval
+        self.timer = timer
+        self.version_key = '%s:version' % self.collection
+        self.changes_key = '%s:changes' % self.collection
+        self.mirror_version = 0
+        # (hash field -> policy, tuple of policies) are replaced together, so readers get them consistently.
+        # None until the mirror is loaded on the first read
+        self._state = None
+        self._refresh_at = float('-inf')
+
+    def inquiry_filter_key(self, inquiry, checker=None):  # pylint: disable=unused-argument
+        # all policies are returned for any inquiry
+        return None
+
+    def _is_fresh(self):
+        return self._state is not None and self.timer() < self._refresh_at
+
+    def _invalidate(self):
+        """
+        Make the next read check the version, so that own writes are seen right away.
+        """
+        self._refresh_at = float('-inf')
+
+    def _load(self, version, data):
+        self._publish({field: self.sr.deserialize(value) for field, value in data.items()}, version)
+
+    def _apply(self, version, fields, values):
+        mirror = dict(self._state[0])
+        for field, value in zip(fields, values):
+            if value is None:
+                mirror.pop(field, None)
+            else:
+                mirror[field] = self.sr.deserialize(value)
+        log.info('Refreshed %d changed Policies of mirror of %s', len(fields), self.collection)
+        self._publish(mirror, version)
+
+    def _publish(self, mirror, version):
+        self._state = (mirror, tuple(mirror.values()))
+        self.mirror_version = version
+        self._refresh_at = self.timer() + self.refresh_interval
+
+    def _field(self, uid):
+        """
+        Get hash field of a policy UID as the client returns it.
+        """
+        encoder = self.client.connection_pool.get_encoder()
+        return encoder.decode(encoder.encode(uid))
+
+    def _script_keys(self):
+        return super()._script_keys() + [self.version_key, self.changes_key]
+
+
+class MirroredRedisStorage(RedisMirrorMixin, RedisStorage):
+    """
+    Stores Policies in Redis and serves reads from a local in-process mirror of the policies hash.
+
+    Mirror is loaded on the first read. Afterwards reads check the version counter with a single GET
+    at most once per `refresh_interval` seconds and fetch only the changed policies,
+    so reads are at most `refresh_interval` seconds stale. Own writes are seen by the next read.
+    All the writers of the collection should be mirrored Storages: writes of RedisStorage aren't tracked.
+    """
+
+    def __init__(self, client, collection=DEFAULT_COLLECTION, serializer=None, refresh_interval=1,
+                 timer=time.monotonic):
+        super().__init__(client, collection=collection, serializer=serializer)
+        self._init_mirror(refresh_interval, timer)
+        self._lock = threading.Lock()
+
+    def add(self, policy):
+        super().add(policy)
+        self._invalidate()
+
+    def get(self, uid):
+        self._refresh()
+        return self._state[0].get(self._field(uid))
+
+    def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        self._refresh()
+        return list(self._state[1][offset:limit+offset])
+
+    def retrieve_all(self, batch=50):
+        self._refresh()
+        yield from self._state[1]
+
+    def find_for_inquiry(self, inquiry, checker=None):
+        self._refresh()
+        return self._state[1]
+
+    def update(self, policy):
+        super().update(policy)
+        self._invalidate()
+
+    def delete(self, uid):
+        super().delete(uid)
+        self._invalidate()
+
+    def add_many(self, policies):
+        result = super().add_many(policies)
+        self._invalidate()
+        return result
+
+    def update_many(self, policies):
+        result = super().update_many(policies)
+        self._invalidate()
+        return result
+
+    def delete_many(self, uids):
+        result = super().delete_many(uids)
+        self._invalidate()
+        return result
+
+    def refresh(self):
+        """
+        Bring the mirror up to date with Redis right away.
+        """
+        self._invalidate()
+        self._refresh()
+
+    def _refresh(self):
+        if self._is_fresh():
+            return
+        with self._lock:
+            if self._is_fresh():
+                return
+            if self._state is not None:
+                version = int(self.client.get(self.version_key) or 0)
+                if version == self.mirror_version:
+                    self._refresh_at = self.timer() + self.refresh_interval
+                    return
+                # counter that went back means that the collection was recreated
+                if version > self.mirror_version:
+                    fields = self.client.zrangebyscore(self.changes_key, '(%d' % self.mirror_version, '+inf')
+                    values = self.client.hmget(self.collection, fields) if fields else []
+                    self._apply(version, fields, values)
+                    return
+            pipe = self.client.pipeline(transaction=True)
+            pipe.get(self.version_key)
+            pipe.hgetall(self.collection)
+            version, data = pipe.execute()
+            self._load(int(version or 0), data)
+            log.info('Loaded %d Policies to mirror of %s', len(data), self.collection)
+
+
+class AsyncMirroredRedisStorage(RedisMirrorMixin, AsyncRedisStorage):
+    """
+    Stores Policies in Redis and serves reads from a local in-process mirror of the policies hash.
+    Asyncio version of MirroredRedisStorage. Accepts asyncio Redis client: `redis.asyncio.Redis`.
+    """
+
+    def __init__(self, client, collection=DEFAULT_COLLECTION, serializer=None, refresh_interval=1,
+                 timer=time.monotonic):
+        super().__init__(client, collection=collection, serializer=serializer)
+        self._init_mirror(refresh_interval, timer)
+        self._lock = asyncio.Lock()
+
+    async def add(self, policy):
+        await super().add(policy)
+        self._invalidate()
+
+    async def get(self, uid):
+        await self._refresh()
+        return self._state[0].get(self._field(uid))
+
+    async def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        await self._refresh()
+        return list(self._state[1][offset:limit+offset])
+
+    async def retrieve_all(self, batch=50):
+        await self._refresh()
+        for policy in self._state[1]:
+            yield policy
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        await self._refresh()
+        return self._state[1]
+
+    async def update(self, policy):
+        await super().update(policy)
+        self._invalidate()
+
+    async def delete(self, uid):
+        await super().delete(uid)
+        self._invalidate()
+
+    async def add_many(self, policies):
+        result = await super().add_many(policies)
+        self._invalidate()
+        return result
+
+    async def update_many(self, policies):
+        result = await super().update_many(policies)
+        self._invalidate()
+        return result
+
+    async def delete_many(self, uids):
+        result = await super().delete_many(uids)
+        self._invalidate()
+        return result
+
+    async def refresh(self):
         """
-        Yields Policies from the given cursor.
+        Bring the mirror up to date with Redis right away.
         """
-        for uid in data:
-            yield self.sr.deserialize(data[uid])
+        self._invalidate()
+        await self._refresh()
+
+    async def _refresh(self):
+        if self._is_fresh():
+            return
+        async with self._lock:
+            if self._is_fresh():
+                return
+            if self._state is not None:
+                version = int(await self.client.get(self.version_key) or 0)
+                if version == self.mirror_version:
+                    self._refresh_at = self.timer() + self.refresh_interval
+                    return
+                # counter that went back means that the collection was recreated
+                if version > self.mirror_version:
+                    fields = await self.client.zrangebyscore(self.changes_key, '(%d' % self.mirror_version, '+inf')
+                    values = await self.client.hmget(self.collection, fields) if fields else []
+                    self._apply(version, fields, values)
+                    return
+            pipe = self.client.pipeline(transaction=True)
+            pipe.get(self.version_key)
+            pipe.hgetall(self.collection)
+            version, data = await pipe.execute()
+            self._load(int(version or 0), data)
+            log.info('Loaded %d Policies to mirror of %s', len(data), self.collection)
+
+
+def _collect_added(result, queued, replies):
+    """
+    Report policies to result by pipeline replies of the adder script.
+    """
+    for (uid, _), reply in zip(queued, replies):
+        if isinstance(reply, Exception):
+            log.error('Error trying to create policy with UID=%s: %s', uid, reply)
+            result.fail(uid, reply)
+        elif reply == 0:
+            log.error('Error trying to create already existing policy with UID=%s.', uid)
+            result.fail(uid, PolicyExistsError(uid))
+        else:
+            result.succeed(uid)
+
+
+def _collect_modified(result, queued, replies):
+    """
+    Report policies to result by pipeline replies of the updater or deleter script.
+    Returns the queued pairs whose index keys were changed concurrently, they are not reported.
+    """
+    stale = []
+    for (uid, item), reply in zip(queued, replies):
+        if isinstance(reply, Exception):
+            log.error('Error trying to modify policy with UID=%s: %s', uid, reply)
+            result.fail(uid, reply)
+        elif reply == -1:
+            stale.append((uid, item))
+        else:
+            result.succeed(uid)
+    return stale
+
+
+##############
+# Migrations #
+##############
+
+
+class RedisMigrationSet(MigrationSet):
+    """
+    Migrations Collection for RedisStorage
+    """
+    def __init__(self, storage, key=DEFAULT_MIGRATION_KEY):
+        self.storage = storage
+        self.key = key
+
+    def migrations(self):
+        return [
+            Migration0To1x7x0(self.storage),
+        ]
+
+    def save_applied_number(self, number):
+        self.storage.client.set(self.key, number)
+
+    def last_applied(self):
+        data = self.storage.client.get(self.key)
+        if data:
+            return int(data)
+        return 0
+
+
+class Migration0To1x7x0(Migration):
+    """
+    Migration between versions before 1.7.0 and 1.7.0.
+    What it does:
+    - Builds index sets of the existing string-based policies that are needed for server-side filtering.
+    - Builds the sorted set of the existing policies UIDs that is needed for ordered paging.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def order(self):
+        return 1
+
+    def up(self):
+        st = self.storage
+        failed = []
+        for chunk in _chunks(st.client.hscan_iter(st.collection, count=st.bulk_size), st.bulk_size):
+            stored = st.client.hmget(st._index_key(), [uid for uid, _ in chunk])
+            pipe = st.client.pipeline(transaction=False)
+            pipe.zadd(st._uids_key(), {uid: 0 for uid, _ in chunk})
+            for (uid, data), kept in zip(chunk, stored):
+                try:
+                    keys, args = st._script_call(uid, st._index_keys(st.sr.deserialize(data)), kept)
+                except _SERIALIZATION_ERRORS:
+                    log.exception('Unexpected exception occurred while indexing Policy with UID: %s', uid)
+                    failed.append(uid)
+                    continue
+                # policy that was modified concurrently is already indexed by the modification, so -1 is ignored
+                st.scripts.indexer(keys=keys, args=args, client=pipe)
+            pipe.execute()
+        if failed:
+            log.error('Migration was unable to index some Policies, they will not be found for string-based ' +
+                      'checkers. You must fix them manually or delete entirely. UIDs of failed Policies are: %s',
+                      failed)
+
+    def down(self):
+        st = self.storage
+        index_key = st._index_key()
+        keys = set()
+        for _, data in st.client.hscan_iter(index_key):
+            keys.update(json.loads(data))
+        for chunk in _chunks(keys, st.bulk_size):
+            st.client.delete(*chunk)
+        st.client.delete(index_key, st._uids_key())
@@ -0,0 +1,167 @@
+"""
+Binary snapshots of a policy-set for a fast startup of MemoryStorage.
+
+Snapshot is a file of the following layout (all numbers are little-endian):
+  - header: magic `VAKTSNAP`, format version (uint32), number of policies (uint64), offset of the table (uint64).
+  - policies: JSON of each policy, one after another.
+  - table: JSON list of [uid, offset, length, keys, entries] rows in the order policies were stored,
+    where offset and length locate JSON of a policy in the file, keys and entries are its PolicyIndex data
+    (regexps are already translated from policy definitions into their sources there).
+
+A loaded snapshot is memory-mapped: MemoryStorage is indexed from the table right away,
+while policies are decoded from their JSON only on the first access.
+"""
+
+import os
+import mmap
+import json
+import struct
+import logging
+
+from .index import PolicyIndex
+from .table import PolicyTable
+from .. import codec
+from ..policy import Policy
+
+
+__all__ = [
+    'export_snapshot',
+    'read_snapshot',
+    'SnapshotPolicies',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+MAGIC = b'VAKTSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sIQQ')
+
+
+def export_snapshot(storage, path, batch=1000):
+    """
+    Export all the policies of a storage to a snapshot file.
+    File is written under a temporary name and then renamed to `path`, so readers never see a partial snapshot.
+    Returns number of exported policies.
+    """
+    rows = []
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        offset = HEADER.size
+        seen = set()
+        for policy in storage.retrieve_all(batch=batch):
+            # storage may return a policy more than once (e.g. Redis HSCAN), the first one is kept
+            if policy.uid in seen:
+                continue
+            seen.add(policy.uid)
+            data = policy.to_json().encode('utf-8')
+            f.write(data)
+            keys, entries = PolicyIndex.index_data(policy)
+            rows.append([_flatten(policy.uid), offset, len(data),
+                         [[kind, field, _flatten(value)] for kind, field, value in keys],
+                         [[kind, field, entry] for kind, field, entry in entries]])
+            offset += len(data)
+        f.write(json.dumps(rows).encode('utf-8'))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(rows), offset))
+    os.replace(tmp_path, path)
+    log.info('Exported %d policies to snapshot %s', len(rows), path)
+    return len(rows)
+
+
+def read_snapshot(path):
+    """
+    Read a snapshot file.
+    Returns (policies, index_data), where policies is a SnapshotPolicies mapping and index_data is
+    a list of (uid, keys, entries) for PolicyIndex.add_data.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError('File %s is not a policy snapshot' % path)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count, table_offset = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        mm.close()
+        raise ValueError('File %s is not a policy snapshot' % path)
+    if version != VERSION:
+        mm.close()
+        raise ValueError('Snapshot %s has version %d, but only version %d is supported' % (path, version, VERSION))
+    rows = json.loads(mm[table_offset:].decode('utf-8'))
+    if len(rows) != count:
+        mm.close()
+        raise ValueError('Snapshot %s is corrupted: %d policies expected, %d found' % (path, count, len(rows)))
+    records, index_data = {}, []
+    for uid, offset, length, keys, entries in rows:
+        uid = _restore(uid)
+        records[uid] = SnapshotRecord(offset, length)
+        keys = [(kind, field, _restore(value)) for kind, field, value in keys]
+        entries = [(kind, field, entry if isinstance(entry, str) else tuple(entry)) for kind, field, entry in entries]
+        index_data.append((uid, keys, entries))
+    return SnapshotPolicies(mm, records), index_data
+
+
+class SnapshotRecord(tuple):
+    """
+    Location of a policy's JSON in a snapshot: (offset, length)
+    """
+    __slots__ = ()
+
+    def __new__(cls, offset, length):
+        return tuple.__new__(cls, (offset, length))
+
+
+class SnapshotPolicies(PolicyTable):
+    """
+    Table of policies backed by a memory-mapped snapshot.
+    Policy is decoded from the snapshot on the first access and is kept decoded afterwards.
+    Policies that are set to the table replace their snapshot records.
+    """
+
+    def __init__(self, mm, records):
+        self._mm = mm
+        # snapshot record -> decoded policy. Readers never modify slots, so they can't overwrite a concurrent update
+        self._decoded = {}
+        super().__init__()
+        slots = list(records.items())
+        self._state = (slots, {uid: pos for pos, (uid, _) in enumerate(slots)})
+
+    def decoded(self):
+        """
+        Get number of policies that are already decoded
+        """
+        return len(self._decoded)
+
+    def _value(self, slot):
+        value = slot[1]
+        if not isinstance(value, SnapshotRecord):
+            return value
+        policy = self._decoded.get(value)
+        if policy is None:
+            offset, length = value
+            policy = Policy.from_json(self._mm[offset:offset+length].decode('utf-8'))
+            policy = self._decoded.setdefault(value, policy)
+        return policy
+
+    def _replace(self, slots, pos, slot):
+        old = slots[pos]
+        slots[pos] = slot
+        if old is not None and isinstance(old[1], SnapshotRecord):
+            self._decoded.pop(old[1], None)
+
+
+def _flatten(value):
+    """
+    Get JSON-compatible representation of a hashable value. Values that are not JSON-native are kept as
+    JSON objects of the codec: they can't be confused with dictionaries that are never hashable.
+    """
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    return codec.flatten(value)
+
+
+def _restore(value):
+    if isinstance(value, dict):
+        return codec.restore(value)
+    return value
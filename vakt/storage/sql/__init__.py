@@ -4,12 +4,12 @@ SQL Storage for Policies.
 
 import logging
 
-from sqlalchemy import and_, or_, literal, func
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, or_, literal, func, select, delete
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm.exc import FlushError
 
 from .model import PolicyModel, PolicyActionModel, PolicyResourceModel, PolicySubjectModel
-from ..abc import Storage
+from ..abc import Storage, AsyncStorage, BulkResult, _chunks, _fields_filter_key, _CONVERSION_ERRORS
 from ...checker import StringExactChecker, StringFuzzyChecker, RegexChecker, RulesChecker
 from ...exceptions import PolicyExistsError, UnknownCheckerType
 from ...policy import TYPE_STRING_BASED, TYPE_RULE_BASED
@@ -18,9 +18,113 @@ from ...policy import TYPE_STRING_BASED, TYPE_RULE_BASED
 log = logging.getLogger(__name__)
 
 
-class SQLStorage(Storage):
+class SQLQueryMixin:
+    """
+    Building of SQL queries for Policies.
+    Is shared by sync and async SQL Storages.
+    """
+
+    def _filter_key(self, inquiry, checker):
+        """
+            Get a key for `inquiry_filter_key` that corresponds to the query-filter criteria.
+        """
+        if isinstance(checker, RulesChecker) or not checker:
+            return None
+        if isinstance(checker, RegexChecker) and not self._supports_regex_operator():
+            return None
+        return _fields_filter_key(inquiry)
+
+    def _get_filter_criteria(self, inquiry, checker):
+        """
+            Returns list of query-filter criteria based on the checker type.
+        """
+        if isinstance(checker, StringFuzzyChecker):
+            return [
+                PolicyModel.type == TYPE_STRING_BASED,
+                PolicyModel.actions.any(PolicyActionModel.action_string.like('%{}%'.format(inquiry.action))),
+                PolicyModel.resources.any(PolicyResourceModel.resource_string.like('%{}%'.format(inquiry.resource))),
+                PolicyModel.subjects.any(PolicySubjectModel.subject_string.like('%{}%'.format(inquiry.subject)))]
+        elif isinstance(checker, StringExactChecker):
+            return [
+                PolicyModel.type == TYPE_STRING_BASED,
+                PolicyModel.actions.any(PolicyActionModel.action_string == inquiry.action),
+                PolicyModel.resources.any(PolicyResourceModel.resource_string == inquiry.resource),
+                PolicyModel.subjects.any(PolicySubjectModel.subject_string == inquiry.subject)]
+        elif isinstance(checker, RegexChecker):
+            if not self._supports_regex_operator():
+                return [PolicyModel.type == TYPE_STRING_BASED]
+            return [
+                PolicyModel.type == TYPE_STRING_BASED,
+                PolicyModel.actions.any(
+                    or_(
+                        and_(PolicyActionModel.action_regex.is_(None),
+                             PolicyActionModel.action_string == inquiry.action),
+                        and_(PolicyActionModel.action_regex.isnot(None),
+                             self._regex_operation(inquiry.action, PolicyActionModel.action_regex))
+                    ),
+                ),
+                PolicyModel.resources.any(
+                    or_(
+                        and_(PolicyResourceModel.resource_regex.is_(None),
+                             PolicyResourceModel.resource_string == inquiry.resource),
+                        and_(PolicyResourceModel.resource_regex.isnot(None),
+                             self._regex_operation(inquiry.resource, PolicyResourceModel.resource_regex))
+                    ),
+                ),
+                PolicyModel.subjects.any(
+                    or_(
+                        and_(PolicySubjectModel.subject_regex.is_(None),
+                             PolicySubjectModel.subject_string == inquiry.subject),
+                        and_(PolicySubjectModel.subject_regex.isnot(None),
+                             self._regex_operation(inquiry.subject, PolicySubjectModel.subject_regex))
+                    ),
+                )
+            ]
+        elif isinstance(checker, RulesChecker):
+            return [PolicyModel.type == TYPE_RULE_BASED]
+        elif not checker:
+            return []
+        else:
+            log.error('Provided Checker type is not supported.')
+            raise UnknownCheckerType(checker)
+
+    @staticmethod
+    def _get_after_query(query, last_uid, limit):
+        """
+            Returns query of policies following the given UID in UID order.
+        """
+        if last_uid is not None:
+            # UIDs are stored as strings, so they are compared as strings as well
+            query = query.filter(PolicyModel.uid > str(last_uid))
+        return query.order_by(PolicyModel.uid.asc()).limit(limit)
+
+    def _supports_regex_operator(self):
+        """
+        Does database support regex operator?
+        """
+        return self.dialect in ['mysql', 'postgresql', 'oracle']
+
+    def _regex_operation(self, left, right):
+        """
+        Get database-specific regex operation.
+        Don't forget to check if there is a support for regex operator before using it.
+        """
+        if self.dialect == 'mysql':
+            return literal(left).op('REGEXP', is_comparison=True)(right)
+        elif self.dialect == 'postgresql':
+            return literal(left).op('~', is_comparison=True)(right)
+        elif self.dialect == 'oracle':
+            return func.REGEXP_LIKE(left, right)
+        return None
+
+
+class SQLStorage(SQLQueryMixin, Storage):
     """Stores all policies in SQL Database"""
 
+    # number of policies that bulk methods process in a single transaction
+    bulk_size = 500
+    supports_get_after = True
+
     def __init__(self, scoped_session):
         """
             Initialize SQL Storage
@@ -59,11 +163,20 @@ class SQLStorage(Storage):
         for policy_model in cur:
             yield policy_model.to_policy()
 
+    def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        cur = self._get_after_query(self.session.query(PolicyModel), last_uid, limit)
+        for policy_model in cur:
+            yield policy_model.to_policy()
+
     def find_for_inquiry(self, inquiry, checker=None):
         cur = self._get_filtered_cursor(inquiry, checker)
         for policy_model in cur:
             yield policy_model.to_policy()
 
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self._filter_key(inquiry, checker)
+
     def update(self, policy):
         try:
             policy_model = self.session.get(PolicyModel, policy.uid)
@@ -80,76 +193,229 @@ class SQLStorage(Storage):
         self.session.query(PolicyModel).filter(PolicyModel.uid == uid).delete()
         log.info('Deleted Policy with UID=%s.', uid)
 
+    def add_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(policies, self.bulk_size):
+            query = self.session.query(PolicyModel.uid).filter(PolicyModel.uid.in_([p.uid for p in chunk]))
+            existing = {uid for (uid,) in query}
+            added = []
+            for policy in chunk:
+                if policy.uid in existing:
+                    log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+                    result.fail(policy.uid, PolicyExistsError(policy.uid))
+                    continue
+                try:
+                    self.session.add(PolicyModel.from_policy(policy))
+                except _CONVERSION_ERRORS as e:
+                    result.fail(policy.uid, e)
+                    continue
+                existing.add(policy.uid)
+                added.append(policy)
+            try:
+                self.session.commit()
+            except (IntegrityError, FlushError):
+                # policies could have been created concurrently, find out which ones
+                self.session.rollback()
+                self._one_by_one(self.add, added, result)
+            else:
+                for policy in added:
+                    result.succeed(policy.uid)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    def update_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(policies, self.bulk_size):
+            try:
+                query = self.session.query(PolicyModel).filter(PolicyModel.uid.in_([p.uid for p in chunk]))
+                models = {model.uid: model for model in query}
+                for policy in chunk:
+                    # non-existing policies are skipped as `update` does
+                    if policy.uid in models:
+                        models[policy.uid].update(policy)
+                self.session.commit()
+            except (SQLAlchemyError,) + _CONVERSION_ERRORS:
+                # a failed policy may be partially applied to its model, so the whole chunk is redone one by one
+                self.session.rollback()
+                self._one_by_one(self.update, chunk, result)
+            else:
+                for policy in chunk:
+                    result.succeed(policy.uid)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(uids, self.bulk_size):
+            self.session.query(PolicyModel).filter(PolicyModel.uid.in_(chunk)).delete()
+            for uid in chunk:
+                result.succeed(uid)
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    def _one_by_one(self, func, policies, result):
+        """
+            Apply func to each of the policies, so that a failed policy doesn't affect the others.
+        """
+        for policy in policies:
+            try:
+                func(policy)
+            except (PolicyExistsError, SQLAlchemyError) + _CONVERSION_ERRORS as e:
+                self.session.rollback()
+                result.fail(policy.uid, e)
+            else:
+                result.succeed(policy.uid)
+
     def _get_filtered_cursor(self, inquiry, checker):
         """
             Returns cursor with proper query-filter based on the checker type.
         """
-        cur = self.session.query(PolicyModel)
-        if isinstance(checker, StringFuzzyChecker):
-            return cur.filter(
-                PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(PolicyActionModel.action_string.like('%{}%'.format(inquiry.action))),
-                PolicyModel.resources.any(PolicyResourceModel.resource_string.like('%{}%'.format(inquiry.resource))),
-                PolicyModel.subjects.any(PolicySubjectModel.subject_string.like('%{}%'.format(inquiry.subject))))
-        elif isinstance(checker, StringExactChecker):
-            return cur.filter(
-                PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(PolicyActionModel.action_string == inquiry.action),
-                PolicyModel.resources.any(PolicyResourceModel.resource_string == inquiry.resource),
-                PolicyModel.subjects.any(PolicySubjectModel.subject_string == inquiry.subject))
-        elif isinstance(checker, RegexChecker):
-            if not self._supports_regex_operator():
-                return cur.filter(PolicyModel.type == TYPE_STRING_BASED)
-            return cur.filter(
-                PolicyModel.type == TYPE_STRING_BASED,
-                PolicyModel.actions.any(
-                    or_(
-                        and_(PolicyActionModel.action_regex.is_(None),
-                             PolicyActionModel.action_string == inquiry.action),
-                        and_(PolicyActionModel.action_regex.isnot(None),
-                             self._regex_operation(inquiry.action, PolicyActionModel.action_regex))
-                    ),
-                ),
-                PolicyModel.resources.any(
-                    or_(
-                        and_(PolicyResourceModel.resource_regex.is_(None),
-                             PolicyResourceModel.resource_string == inquiry.resource),
-                        and_(PolicyResourceModel.resource_regex.isnot(None),
-                             self._regex_operation(inquiry.resource, PolicyResourceModel.resource_regex))
-                    ),
-                ),
-                PolicyModel.subjects.any(
-                    or_(
-                        and_(PolicySubjectModel.subject_regex.is_(None),
-                             PolicySubjectModel.subject_string == inquiry.subject),
-                        and_(PolicySubjectModel.subject_regex.isnot(None),
-                             self._regex_operation(inquiry.subject, PolicySubjectModel.subject_regex))
-                    ),
-                )
-            )
-        elif isinstance(checker, RulesChecker):
-            return cur.filter(PolicyModel.type == TYPE_RULE_BASED)
-        elif not checker:
-            return cur
-        else:
-            log.error('Provided Checker type is not supported.')
-            raise UnknownCheckerType(checker)
+        return self.session.query(PolicyModel).filter(*self._get_filter_criteria(inquiry, checker))
 
-    def _supports_regex_operator(self):
+
+class AsyncSQLStorage(SQLQueryMixin, AsyncStorage):
+    """Stores all policies in SQL Database. Asyncio version of SQLStorage"""
+
+    # number of policies that bulk methods process in a single transaction
+    bulk_size = 500
+    supports_get_after = True
+
+    def __init__(self, session):
         """
-        Does database support regex operator?
+            Initialize async SQL Storage
+
+            :param session: SQL Alchemy AsyncSession or async_scoped_session
         """
-        return self.dialect in ['mysql', 'postgresql', 'oracle']
+        self.session = session
+        self.dialect = self.session.bind.dialect.name
 
-    def _regex_operation(self, left, right):
+    async def add(self, policy):
+        try:
+            self.session.add(PolicyModel.from_policy(policy))
+            await self.session.commit()
+        except IntegrityError:
+            await self.session.rollback()
+            log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+            raise PolicyExistsError(policy.uid)
+        log.info('Added Policy: %s', policy)
+
+    async def get(self, uid):
+        policy_model = await self.session.get(PolicyModel, uid)
+        if not policy_model:
+            return None
+        return policy_model.to_policy()
+
+    async def get_all(self, limit, offset):
+        self._check_limit_and_offset(limit, offset)
+        query = select(PolicyModel).order_by(PolicyModel.uid.asc()).slice(offset, offset + limit)
+        return await self.__fetch_policies(query)
+
+    async def get_after(self, last_uid, limit):
+        self._check_limit_and_offset(limit, 0)
+        query = self._get_after_query(select(PolicyModel), last_uid, limit)
+        return await self.__fetch_policies(query)
+
+    async def find_for_inquiry(self, inquiry, checker=None):
+        query = select(PolicyModel).filter(*self._get_filter_criteria(inquiry, checker))
+        return await self.__fetch_policies(query)
+
+    def inquiry_filter_key(self, inquiry, checker=None):
+        return self._filter_key(inquiry, checker)
+
+    async def update(self, policy):
+        try:
+            policy_model = await self.session.get(PolicyModel, policy.uid)
+            if not policy_model:
+                return
+            policy_model.update(policy)
+            await self.session.commit()
+        except IntegrityError:
+            await self.session.rollback()
+            raise
+        log.info('Updated Policy with UID=%s. New value is: %s', policy.uid, policy)
+
+    async def delete(self, uid):
+        await self.session.execute(delete(PolicyModel).where(PolicyModel.uid == uid))
+        await self.session.commit()
+        log.info('Deleted Policy with UID=%s.', uid)
+
+    async def add_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(policies, self.bulk_size):
+            query = select(PolicyModel.uid).where(PolicyModel.uid.in_([p.uid for p in chunk]))
+            existing = set((await self.session.execute(query)).scalars())
+            added = []
+            for policy in chunk:
+                if policy.uid in existing:
+                    log.error('Error trying to create already existing policy with UID=%s.', policy.uid)
+                    result.fail(policy.uid, PolicyExistsError(policy.uid))
+                    continue
+                try:
+                    self.session.add(PolicyModel.from_policy(policy))
+                except _CONVERSION_ERRORS as e:
+                    result.fail(policy.uid, e)
+                    continue
+                existing.add(policy.uid)
+                added.append(policy)
+            try:
+                await self.session.commit()
+            except (IntegrityError, FlushError):
+                # policies could have been created concurrently, find out which ones
+                await self.session.rollback()
+                await self._one_by_one(self.add, added, result)
+            else:
+                for policy in added:
+                    result.succeed(policy.uid)
+        log.info('Added %d Policies', len(result.succeeded))
+        return result
+
+    async def update_many(self, policies):
+        result = BulkResult()
+        for chunk in _chunks(policies, self.bulk_size):
+            try:
+                query = select(PolicyModel).where(PolicyModel.uid.in_([p.uid for p in chunk]))
+                models = {model.uid: model for model in (await self.session.execute(query)).unique().scalars()}
+                for policy in chunk:
+                    # non-existing policies are skipped as `update` does
+                    if policy.uid in models:
+                        models[policy.uid].update(policy)
+                await self.session.commit()
+            except (SQLAlchemyError,) + _CONVERSION_ERRORS:
+                # a failed policy may be partially applied to its model, so the whole chunk is redone one by one
+                await self.session.rollback()
+                await self._one_by_one(self.update, chunk, result)
+            else:
+                for policy in chunk:
+                    result.succeed(policy.uid)
+        log.info('Updated %d Policies', len(result.succeeded))
+        return result
+
+    async def delete_many(self, uids):
+        result = BulkResult()
+        for chunk in _chunks(uids, self.bulk_size):
+            await self.session.execute(delete(PolicyModel).where(PolicyModel.uid.in_(chunk)))
+            for uid in chunk:
+                result.succeed(uid)
+        await self.session.commit()
+        log.info('Deleted %d Policies', len(result.succeeded))
+        return result
+
+    async def _one_by_one(self, func, policies, result):
         """
-        Get database-specific regex operation.
-        Don't forget to check if there is a support for regex operator before using it.
+            Await func for each of the policies, so that a failed policy doesn't affect the others.
         """
-        if self.dialect == 'mysql':
-            return literal(left).op('REGEXP', is_comparison=True)(right)
-        elif self.dialect == 'postgresql':
-            return literal(left).op('~', is_comparison=True)(right)
-        elif self.dialect == 'oracle':
-            return func.REGEXP_LIKE(left, right)
-        return None
+        for policy in policies:
+            try:
+                await func(policy)
+            except (PolicyExistsError, SQLAlchemyError) + _CONVERSION_ERRORS as e:
+                await self.session.rollback()
+                result.fail(policy.uid, e)
+            else:
+                result.succeed(policy.uid)
+
+    async def __fetch_policies(self, query):
+        """
+            Get Policies for the given query.
+        """
+        result = await self.session.execute(query)
+        return [policy_model.to_policy() for policy_model in result.unique().scalars()]
@@ -6,6 +6,7 @@ from sqlalchemy.orm import declarative_base, relationship
 from ...policy import Policy, ALLOW_ACCESS, DENY_ACCESS, TYPE_STRING_BASED
 from ...rules.base import Rule
 from ...parser import compile_regex
+from ... import codec
 
 Base = declarative_base()
 
@@ -115,8 +116,7 @@ class PolicyModel(Base):
             :param policy: object of type Policy
             :param model: object of type PolicyModel
         """
-        policy_json = policy.to_json()
-        policy_dict = json.loads(policy_json)
+        policy_dict = codec.flatten(policy._data())
         model.uid = policy_dict['uid']
         model.type = policy_dict['type']
         model.effect = policy_dict['effect'] == ALLOW_ACCESS
@@ -0,0 +1,126 @@
+"""
+Table of policies that is safe to read while it's being modified.
+"""
+
+from collections.abc import MutableMapping
+
+
+__all__ = [
+    'PolicyTable',
+]
+
+
+# errors a read can get from structures that are modified concurrently with it
+_CONCURRENT_READ_ERRORS = (LookupError, RuntimeError)
+
+
+class PolicyTable(MutableMapping):
+    """
+    Mapping of policy UID -> policy in the order policies were added.
+
+    Modifications should be serialized by the caller, while reads and iteration can be done concurrently with them
+    without any locks. Policies are kept in an append-only list of (uid, policy) slots: an update replaces a slot,
+    a deletion empties it, so a list that is being iterated never shrinks and is never reordered.
+    When more than a half of the slots are empty, live slots are copied to a new list
+    that replaces the old one together with its positions, the old list isn't modified afterwards.
+    """
+
+    # don't bother compacting small tables
+    min_compact_size = 64
+
+    def __init__(self, items=()):
+        # (slots, positions) are replaced together, so they are read consistently from a single attribute
+        self._state = ([], {})
+        self._empty = 0
+        for uid, policy in items:
+            self[uid] = policy
+
+    def __getitem__(self, uid):
+        slots, positions = self._state
+        slot = slots[positions[uid]]
+        # slot could have been emptied after its position was read
+        if slot is None:
+            raise KeyError(uid)
+        return self._value(slot)
+
+    def __setitem__(self, uid, policy):
+        slots, positions = self._state
+        pos = positions.get(uid)
+        if pos is None:
+            # slot should exist before readers can find its position
+            slots.append((uid, policy))
+            positions[uid] = len(slots) - 1
+        else:
+            self._replace(slots, pos, (uid, policy))
+
+    def __delitem__(self, uid):
+        slots, positions = self._state
+        pos = positions.pop(uid)
+        self._replace(slots, pos, None)
+        self._empty += 1
+        if self._empty > self.min_compact_size and self._empty * 2 > len(slots):
+            self._compact()
+
+    def __contains__(self, uid):
+        return uid in self._state[1]
+
+    def __iter__(self):
+        for slot in self._state[0]:
+            if slot is not None:
+                yield slot[0]
+
+    def __len__(self):
+        return len(self._state[1])
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def values(self):
+        """
+        Get a list of all the policies
+        """
+        value = self._value
+        return [value(slot) for slot in self._state[0] if slot is not None]
+
+    def _value(self, slot):
+        """
+        Get policy from a slot. Is useful for overriding in subclasses that keep policies in another form
+        """
+        return slot[1]
+
+    def _replace(self, slots, pos, slot):
+        slots[pos] = slot
+
+    def _compact(self):
+        slots, positions = [], {}
+        for slot in self._state[0]:
+            if slot is not None:
+                positions[slot[0]] = len(slots)
+                slots.append(slot)
+        self._state = (slots, positions)
+        self._empty = 0
+
+
+def _read_consistent(owner, fn, *args):
+    """
+    Call a read of structures that `owner` modifies in place under its `version` counter (odd while modifying)
+    and its `lock`. The read is retried if a modification overlapped it and is done under the lock
+    after `owner.read_attempts` unsuccessful attempts.
+    """
+    for _ in range(owner.read_attempts):
+        version = owner.version
+        if version % 2:
+            continue
+        try:
+            result = fn(*args)
+        except _CONCURRENT_READ_ERRORS:
+            if version == owner.version:
+                raise
+            continue
+        if version == owner.version:
+            return result
+    with owner.lock:
+        return fn(*args)
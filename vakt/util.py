@@ -2,10 +2,11 @@
 Utility functions and classes for Vakt.
 """
 
+import hashlib
 import logging
 from abc import ABCMeta, abstractmethod
 
-import jsonpickle
+from . import codec
 
 
 log = logging.getLogger(__name__)
@@ -15,6 +16,8 @@ class JsonSerializer:
     """
     Mixin for dumping object to JSON
     """
+    __slots__ = ()
+
     @classmethod
     def from_json(cls, data):
         """
@@ -27,14 +30,13 @@ class JsonSerializer:
         """
         Get JSON representation of an object
         """
-        jsonpickle.set_encoder_options('json', sort_keys=sort)
-        return jsonpickle.encode(self._data())
+        return codec.encode(self._data(), sort=sort)
 
     @classmethod
     def _parse(cls, data):
         """Parse JSON string and return data"""
         try:
-            return jsonpickle.decode(data)
+            return codec.decode(data)
         except ValueError as err:
             log.exception('Error creating %s from json.', cls.__name__)
             raise err
@@ -46,10 +48,73 @@ class JsonSerializer:
         return vars(self)
 
 
+def structural_digest(value):
+    """
+    Get a digest of a value (nested dictionaries, lists, tuples, sets, strings, numbers, etc.) that depends only
+    on its structure and contents: dictionaries with the same items have the same digest regardless
+    of keys order. The digest is the same across python processes.
+    Values of other types are represented by their JSON.
+    """
+    parts = []
+    _encode(value, parts)
+    return hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+
+
+def _encode(value, parts):
+    """
+    Append unambiguous binary representation of a value to parts
+    """
+    value_type = type(value)
+    if value_type is str:
+        data = value.encode('utf-8', 'surrogatepass')
+        parts.append(b's%d:' % len(data))
+        parts.append(data)
+    elif value is None:
+        parts.append(b'N')
+    elif value_type is bool:
+        parts.append(b'T' if value else b'F')
+    elif value_type is int:
+        parts.append(b'i%d;' % value)
+    elif value_type is float:
+        parts.append(b'f%s;' % repr(value).encode())
+    elif value_type is dict:
+        items = []
+        for k, v in value.items():
+            item = []
+            _encode(k, item)
+            _encode(v, item)
+            items.append(b''.join(item))
+        items.sort()
+        parts.append(b'd%d:' % len(items))
+        parts.extend(items)
+    elif value_type in (list, tuple):
+        parts.append(b'%s%d:' % (b'l' if value_type is list else b't', len(value)))
+        for v in value:
+            _encode(v, parts)
+    elif value_type in (set, frozenset):
+        items = []
+        for v in value:
+            item = []
+            _encode(v, item)
+            items.append(b''.join(item))
+        items.sort()
+        parts.append(b'e%d:' % len(items))
+        parts.extend(items)
+    elif value_type is bytes:
+        parts.append(b'b%d:' % len(value))
+        parts.append(value)
+    else:
+        data = codec.encode(value, sort=True).encode('utf-8')
+        parts.append(b'o%d:' % len(data))
+        parts.append(data)
+
+
 class PrettyPrint:
     """
     Allows to log objects with all the fields
     """
+    __slots__ = ()
+
     def __str__(self):
         return "%s <Object ID %s>: %s" % (self.__class__, id(self), vars(self))
 
@@ -73,12 +138,16 @@ class Subject:
         """
         self._listeners.remove(listener)
 
-    def notify(self):
+    def notify(self, event=None):
         """
-        Notify all attached listeners about event
+        Notify all attached listeners about event.
+        Event is an optional payload that describes what has happened.
         """
         for listener in self._listeners:
-            listener.update()
+            if event is None:
+                listener.update()
+            else:
+                listener.update(event)
 
 
 class Observer(metaclass=ABCMeta):
@@ -86,8 +155,9 @@ class Observer(metaclass=ABCMeta):
     Observer of the events in the pub-sub objects relation
     """
     @abstractmethod
-    def update(self):
+    def update(self, event=None):
         """
-        Update observer on notify event
+        Update observer on notify event.
+        Event is an optional payload that describes what has happened, it's None if subject sent no payload.
         """
         pass